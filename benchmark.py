@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+"""
+Grade Server Load Generator
+
+Starts a local Server on a generated roster and drives it with N
+concurrent synthetic clients, each on its own persistent connection,
+mixing GG and the average commands. Reports requests/sec and
+p50/p95/p99 latency.
+
+e.g., python benchmark.py -m thread -c 32 -s 10000 -d 10
+      python benchmark.py -m select --mix GG:1,GMA:1
+      python benchmark.py --sessions
+      python benchmark.py --admission
+
+"""
+
+########################################################################
+
+import os
+import sys
+import csv
+import time
+import random
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from cryptography.fernet import Fernet
+
+from server_client_Grade_Retrieval import (Server, Client, ClientPool, ClientError,
+                                           AdmissionControl, configure_logging)
+
+########################################################################
+# Benchmark class
+########################################################################
+
+class Benchmark:
+
+    PORT = 50001 # Kept off the default server port.
+    CLIENTS = 16
+    ROSTER_SIZE = 1000
+    DURATION = 5.0 # seconds
+    SERVER_START_TIMEOUT = 30.0 # seconds
+
+    # Default command mix, as relative weights.
+    MIX = {"GG": 4, "GMA": 1, "GL1A": 1, "GL2A": 1, "GL3A": 1, "GL4A": 1, "GEA": 1}
+
+    HEADER = ["Name", "ID Number", "Key", "Lab 1", "Lab 2", "Lab 3", "Lab 4",
+              "Midterm", "Exam 1", "Exam 2", "Exam 3", "Exam 4"]
+
+    def __init__(self, mode=Server.CONCURRENCY_MODE, clients=CLIENTS,
+                 roster_size=ROSTER_SIZE, duration=DURATION, mix=MIX, port=PORT,
+                 sessions=False, admission=False):
+        self.mode = mode
+        self.clients = clients
+        self.roster_size = roster_size
+        self.duration = duration
+        self.mix = mix
+        self.port = port
+        # Whether the clients open sessions (see Session).
+        self.sessions = sessions
+        # Whether the server keeps its default rate limits (see
+        # AdmissionControl).
+        self.admission = admission
+
+        # Per-command latencies (in seconds) and the error count,
+        # filled in by the worker threads.
+        self.latencies = {command: [] for command in mix}
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def generate_roster(self, file_path):
+        # Write a roster CSV with random IDs, keys and marks.
+        ids = random.sample(range(1000000, 10000000), self.roster_size)
+        with open(file_path, "w", newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(Benchmark.HEADER)
+            for id_number in ids:
+                marks = [random.randint(0, 10) for _ in range(4)]
+                marks.append(random.randint(0, 20))
+                marks += [random.randint(0, 10) for _ in range(4)]
+                writer.writerow(["Student {}".format(id_number), id_number,
+                                 Fernet.generate_key().decode('ascii')] + marks)
+        return [str(id_number) for id_number in ids]
+
+    @staticmethod
+    def run_server(mode, file_path, port, admission):
+        # Server process body. Only warnings are logged, to keep
+        # logging off the profile. Unless asked to keep them, the rate
+        # limits are off: every benchmark client shares one address
+        # and a small roster, so they would measure the limits rather
+        # than the server.
+        configure_logging("warning")
+        if not admission:
+            AdmissionControl.ADDRESS_RATE = 0
+            AdmissionControl.ID_RATE = 0
+        Server(mode, file_path, port)
+
+    def wait_for_server(self):
+        deadline = time.monotonic() + Benchmark.SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                Client(port=self.port, timeout=1.0, exit_on_error=False, verbose=False).close()
+                return
+            except ClientError:
+                time.sleep(0.1)
+        print("Server did not start on port {}.".format(self.port))
+        sys.exit(1)
+
+    def worker(self, ids, stop_time):
+        commands = list(self.mix)
+        weights = list(self.mix.values())
+        latencies = {command: [] for command in commands}
+        errors = 0
+        client = Client(port=self.port, timeout=ClientPool.TIMEOUT,
+                        exit_on_error=False, verbose=False, sessions=self.sessions)
+        try:
+            while time.monotonic() < stop_time:
+                id_number = random.choice(ids)
+                command = random.choices(commands, weights)[0]
+                start = time.perf_counter()
+                try:
+                    reply = client.request(id_number, command)
+                except ClientError:
+                    reply = None
+                elapsed = time.perf_counter() - start
+                if reply is None:
+                    errors += 1
+                else:
+                    latencies[command].append(elapsed)
+        finally:
+            client.socket.close()
+
+        with self.lock:
+            for command in commands:
+                self.latencies[command] += latencies[command]
+            self.errors += errors
+
+    @staticmethod
+    def percentile(sorted_values, p):
+        # Nearest-rank percentile of an already sorted list.
+        if not sorted_values:
+            return 0.0
+        index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+        return sorted_values[index]
+
+    def run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = os.path.join(directory, "roster.csv")
+            print("Generating a roster of {} students ...".format(self.roster_size))
+            ids = self.generate_roster(file_path)
+
+            # The client looks up its decryption keys in the same file.
+            Client.KEY_FILES = True
+            Client.FILE_PATH = file_path
+            Client.grade_stores = {}
+
+            server = multiprocessing.Process(target=Benchmark.run_server,
+                                             args=(self.mode, file_path, self.port,
+                                                   self.admission),
+                                             daemon=True)
+            server.start()
+            try:
+                self.wait_for_server()
+                print("Running {} clients against the {} server for {} s ...".format(
+                    self.clients, self.mode, self.duration))
+                print("Rate limits: {}".format(
+                    "default" if self.admission else "off"))
+
+                stop_time = time.monotonic() + self.duration
+                threads = [threading.Thread(target=self.worker, args=(ids, stop_time))
+                           for _ in range(self.clients)]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - start
+            finally:
+                server.terminate()
+                server.join()
+
+        self.report(elapsed)
+
+    def report(self, elapsed):
+        print("-" * 72)
+        print("{:<8}{:>10}{:>12}{:>12}{:>12}".format("Command", "Requests", "p50 ms", "p95 ms", "p99 ms"))
+        all_latencies = []
+        for command, latencies in self.latencies.items():
+            latencies.sort()
+            all_latencies += latencies
+            self.print_row(command, latencies)
+        all_latencies.sort()
+        self.print_row("All", all_latencies)
+        print("-" * 72)
+        print("Errors: {} (rate limits {})".format(
+            self.errors, "default" if self.admission else "off"))
+        print("Throughput: {:.1f} requests/sec".format(len(all_latencies) / elapsed))
+
+    def print_row(self, label, latencies):
+        print("{:<8}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}".format(
+            label, len(latencies),
+            Benchmark.percentile(latencies, 50) * 1000,
+            Benchmark.percentile(latencies, 95) * 1000,
+            Benchmark.percentile(latencies, 99) * 1000))
+
+########################################################################
+# Process command line arguments if this module is run directly.
+########################################################################
+
+def parse_mix(text):
+    # "GG:4,GMA:1" -> {"GG": 4, "GMA": 1}
+    mix = {}
+    for item in text.split(","):
+        command, _, weight = item.partition(":")
+        mix[command.strip()] = float(weight) if weight else 1.0
+    return mix
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-m', '--mode',
+                        choices=Server.CONCURRENCY_MODES,
+                        default=Server.CONCURRENCY_MODE,
+                        help='server concurrency mode',
+                        type=str)
+
+    parser.add_argument('-c', '--clients',
+                        default=Benchmark.CLIENTS,
+                        help='number of concurrent clients',
+                        type=int)
+
+    parser.add_argument('-s', '--roster-size',
+                        default=Benchmark.ROSTER_SIZE,
+                        help='number of students in the generated roster',
+                        type=int)
+
+    parser.add_argument('-d', '--duration',
+                        default=Benchmark.DURATION,
+                        help='run time in seconds',
+                        type=float)
+
+    parser.add_argument('--mix',
+                        default=",".join("{}:{}".format(c, w) for c, w in Benchmark.MIX.items()),
+                        help='command mix as COMMAND:WEIGHT pairs',
+                        type=parse_mix)
+
+    parser.add_argument('-p', '--port',
+                        default=Benchmark.PORT,
+                        help='port for the benchmark server',
+                        type=int)
+
+    parser.add_argument('--sessions',
+                        action='store_true',
+                        help='clients open sessions, so replies are AES-GCM sealed')
+
+    parser.add_argument('--admission',
+                        action='store_true',
+                        help='keep the server\'s default rate limits, which '
+                        'count rejected requests as errors')
+
+    args = parser.parse_args()
+
+    Benchmark(args.mode, args.clients, args.roster_size, args.duration,
+              args.mix, args.port, args.sessions, args.admission).run()
+
+########################################################################
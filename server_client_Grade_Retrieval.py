@@ -19,9 +19,2649 @@ e.g., then do EchoClientserver.Server()
 
 import socket
 import argparse
+import logging
+import json
 import sys
+import os
 import csv
-from cryptography.fernet import Fernet
+import io
+import time
+import signal
+import threading
+import random
+import asyncio
+import selectors
+import select
+import re
+import zlib
+import base64
+import bisect
+import struct
+import mmap
+import weakref
+import contextlib
+import itertools
+import queue
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+# The grade store keeps marks in NumPy arrays. If it is not installed,
+# you need to run: pip3 install numpy.
+import numpy as np
+# Journal file locking between prefork workers. Not available on
+# Windows, which has no prefork mode anyway.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+# Optional faster event loop for the "asyncio" mode. If it is not
+# installed, the standard asyncio loop is used.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+# Raising the open file limit for the "asyncio" mode. Not on Windows.
+try:
+    import resource
+except ImportError:
+    resource = None
+# Only needed to read .xlsx grade files. If it is not installed, you
+# need to run: pip3 install openpyxl.
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+########################################################################
+# Grade store classes
+########################################################################
+
+class GradeRecord:
+
+    # One student row of the grades table. __slots__ keeps each
+    # record small when the roster is large.
+    __slots__ = ("name", "id_number", "key", "marks")
+
+    def __init__(self, name, id_number, key, marks):
+        self.name = name
+        self.id_number = id_number
+        self.key = key
+        # [Lab 1,Lab 2,Lab 3,Lab 4,Midterm,Exam 1,Exam 2,Exam 3,Exam 4]
+        self.marks = marks
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row[0], row[1], row[2], [int(mark) for mark in row[3:]])
+
+    def as_row(self):
+        # The record in the same form as a csv.reader row.
+        return [self.name, self.id_number, self.key] + [str(mark) for mark in self.marks]
+
+
+class GradeSnapshot:
+
+    # One loaded copy of the grades table, held column-wise: the mark
+    # columns (Lab 1 through Exam 4) are one NumPy int array with a
+    # row per student, next to an ID-to-row index and the name and
+    # key columns. Aggregates over the whole class or any subset of
+    # IDs are vectorized reductions over that array. Running column
+    # sums are also kept up to date by add, update and remove so
+    # whole-class averages are constant time. A request takes a
+    # reference to the current snapshot once and uses it throughout,
+    # so a reload can never show it a half-loaded table.
+    #
+    # A shard server (see ShardMap) loads the marks of every row, so
+    # class-wide aggregates stay correct, but only keeps the names and
+    # keys of the IDs it owns. The other rows have None in their place
+    # and find() does not return them.
+
+    # Number of mark columns, Lab 1 through Exam 4.
+    MARK_COLUMNS = 9
+
+    MARK_DTYPE = np.int32
+
+    # Column codes used by the statistics commands. "T" is the total
+    # of all marks; "E" is Exam 1, as in GEA.
+    TOTAL_COLUMN = MARK_COLUMNS
+    COLUMN_CODES = {"L1": 0, "L2": 1, "L3": 2, "L4": 3, "M": 4,
+                    "E1": 5, "E2": 6, "E3": 7, "E4": 8, "E": 5,
+                    "T": TOTAL_COLUMN}
+
+    # Approximate bytes per row outside the marks array: the string
+    # objects, list slots and the index dict entry.
+    ROW_OVERHEAD = 250
+
+    def __init__(self, header, names, ids, keys, marks, version, owns=None):
+        self.header = header
+        # owns(id_number) says whether this process serves an ID, None
+        # means it serves them all.
+        self.owns = owns
+        self.names = names
+        self.ids = ids
+        self.keys = keys
+        self.index = {id_number: row for row, id_number in enumerate(ids)}
+        # The array may have spare rows at the end for appends; only
+        # the first count rows are in use.
+        self.marks = marks
+        self.count = len(ids)
+        self.sums = marks[:self.count].sum(axis=0, dtype=np.int64)
+        self.version = version
+        self.lock = threading.Lock()
+        # Sorted copies of columns for the statistics commands, built
+        # on first use and thrown away when the version changes.
+        self.sorted_columns = {}
+        self.sorted_version = version
+
+    @classmethod
+    def from_records(cls, header, records, version, owns=None):
+        records = list(records)
+        marks = np.array([record.marks for record in records], dtype=cls.MARK_DTYPE)
+        if owns is None:
+            names = [record.name for record in records]
+            keys = [record.key for record in records]
+        else:
+            names = [record.name if owns(record.id_number) else None for record in records]
+            keys = [record.key if owns(record.id_number) else None for record in records]
+        return cls(header, names,
+                   [record.id_number for record in records],
+                   keys,
+                   marks.reshape(len(records), cls.MARK_COLUMNS),
+                   version, owns)
+
+    @classmethod
+    def from_csv(cls, file_path, version, owns=None):
+        records = {}
+        with open(file_path, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            header = next(reader)  # Keep the header row
+            for row in reader:
+                if not row:
+                    continue
+                record = GradeRecord.from_row(row)
+                # A repeated ID replaces the earlier row.
+                records[record.id_number] = record
+        return cls.from_records(header, records.values(), version, owns)
+
+    @classmethod
+    def from_xlsx(cls, file_path, version, owns=None):
+        # The first sheet, laid out like the CSV file. Cells past the
+        # last mark column are ignored.
+        if openpyxl is None:
+            raise ImportError("Reading {} needs openpyxl: pip3 install openpyxl".format(file_path))
+        width = 3 + cls.MARK_COLUMNS
+        records = {}
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [cls.cell_text(cell) for cell in next(rows)[:width]]
+            for row in rows:
+                row = row[:width]
+                if all(cell is None for cell in row):
+                    continue
+                record = GradeRecord.from_row([cls.cell_text(cell) for cell in row])
+                records[record.id_number] = record
+        finally:
+            workbook.close()
+        return cls.from_records(header, records.values(), version, owns)
+
+    @staticmethod
+    def cell_text(cell):
+        # Spreadsheets hold whole numbers (IDs and marks) as int or
+        # float.
+        if cell is None:
+            return ""
+        if isinstance(cell, float) and cell.is_integer():
+            return str(int(cell))
+        return str(cell)
+
+    @classmethod
+    def from_file(cls, file_path, version, owns=None):
+        # Load a compiled snapshot, a spreadsheet or a CSV file,
+        # chosen by the file name extension.
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension == MappedGradeSnapshot.SUFFIX:
+            return MappedGradeSnapshot(file_path, version, owns)
+        if extension == ".xlsx":
+            return cls.from_xlsx(file_path, version, owns)
+        return cls.from_csv(file_path, version, owns)
+
+    def record(self, row):
+        return GradeRecord(self.names[row], self.ids[row], self.keys[row],
+                           self.marks[row].tolist())
+
+    def row_of(self, id_number):
+        # Array row of an ID, or None.
+        return self.index.get(id_number)
+
+    def owned(self, row):
+        return self.keys[row] is not None
+
+    def find(self, id_number):
+        row = self.row_of(id_number)
+        if row is None or not self.owned(row):
+            return None
+        return self.record(row)
+
+    def memory_usage(self):
+        # Rough size in bytes, for the course catalog memory budget.
+        return (self.marks.nbytes
+                + self.count * GradeSnapshot.ROW_OVERHEAD
+                + sum(len(name) + len(key) for name, key in zip(self.names, self.keys)
+                      if key is not None))
+
+    def add(self, record):
+        # Add a new record or replace the existing one with the same
+        # ID, adjusting the running sums by the difference.
+        new_marks = np.array(record.marks, dtype=GradeSnapshot.MARK_DTYPE)
+        if self.owns is None or self.owns(record.id_number):
+            name, key = record.name, record.key
+        else:
+            name, key = None, None
+        with self.lock:
+            row = self.index.get(record.id_number)
+            if row is None:
+                row = self.count
+                if row == len(self.marks):
+                    # Out of spare rows: double the array.
+                    marks = np.zeros((max(16, 2 * row), GradeSnapshot.MARK_COLUMNS),
+                                     dtype=GradeSnapshot.MARK_DTYPE)
+                    marks[:row] = self.marks[:row]
+                    self.marks = marks
+                self.names.append(name)
+                self.ids.append(record.id_number)
+                self.keys.append(key)
+                self.marks[row] = new_marks
+                self.index[record.id_number] = row
+                self.count += 1
+                self.sums = self.sums + new_marks
+            else:
+                self.sums = self.sums + (new_marks - self.marks[row])
+                self.names[row] = name
+                self.keys[row] = key
+                self.marks[row] = new_marks
+            self.version += 1
+
+    # Changing a row is the same operation as adding it.
+    update = add
+
+    def copy(self):
+        # An in-memory copy to change and then swap in, so requests
+        # holding this snapshot never see a change half made.
+        with self.lock:
+            return GradeSnapshot(self.header, list(self.names), list(self.ids), list(self.keys),
+                                 self.marks[:self.count].copy(), self.version, self.owns)
+
+    def set_marks(self, updates):
+        # Apply [ID, column, mark] updates as one change (one version
+        # step). Unknown IDs are skipped. Returns how many applied.
+        with self.lock:
+            delta = np.zeros(GradeSnapshot.MARK_COLUMNS, dtype=np.int64)
+            applied = 0
+            for id_number, column, mark in updates:
+                row = self.row_of(id_number)
+                if row is None:
+                    continue
+                delta[column] += mark - int(self.marks[row, column])
+                self.marks[row, column] = mark
+                applied += 1
+            if applied:
+                self.sums = self.sums + delta
+                self.version += 1
+            return applied
+
+    def remove(self, id_number):
+        # Move the last row into the removed row's place, so the used
+        # rows stay contiguous.
+        with self.lock:
+            row = self.index.pop(id_number, None)
+            if row is None:
+                return None
+            old = self.record(row)
+            self.sums = self.sums - self.marks[row]
+            last = self.count - 1
+            if row != last:
+                self.names[row] = self.names[last]
+                self.ids[row] = self.ids[last]
+                self.keys[row] = self.keys[last]
+                self.marks[row] = self.marks[last]
+                self.index[self.ids[row]] = row
+            del self.names[last], self.ids[last], self.keys[last]
+            self.count -= 1
+            self.version += 1
+            return old
+
+    def rows(self, ids=None):
+        # Array row numbers for a list of IDs (unknown IDs skipped),
+        # or all used rows if ids is None.
+        if ids is None:
+            return slice(0, self.count)
+        return np.fromiter((row for row in map(self.row_of, ids) if row is not None),
+                           dtype=np.intp)
+
+    def column_sums(self, ids=None):
+        # Sum of each mark column, over the class or a subset.
+        if ids is None:
+            return self.sums.tolist()
+        return self.marks[self.rows(ids)].sum(axis=0, dtype=np.int64).tolist()
+
+    def column_counts(self, ids=None):
+        if ids is None:
+            return self.count
+        return len(self.rows(ids))
+
+    def column_averages(self, ids=None):
+        '''
+        Array contents = [Lab 1,Lab 2,Lab 3,Lab 4,Midterm,Exam 1,Exam 2,Exam 3,Exam 4]
+        '''
+        marks = self.marks[self.rows(ids)]
+        if len(marks) == 0:
+            return [0.0] * GradeSnapshot.MARK_COLUMNS
+        return marks.mean(axis=0).tolist()
+
+    def averages(self):
+        '''
+        Array contents = [Lab 1,Lab 2,Lab 3,Lab 4,Midterm,Exam 1,Exam 2,Exam 3,Exam 4]
+        '''
+        with self.lock:
+            if self.count == 0:
+                return [0.0] * GradeSnapshot.MARK_COLUMNS
+            return (self.sums / self.count).tolist()
+
+    def column(self, column):
+        # One mark column (or the totals) of the used rows.
+        if column == GradeSnapshot.TOTAL_COLUMN:
+            return self.marks[:self.count].sum(axis=1, dtype=np.int64)
+        return self.marks[:self.count, column]
+
+    def sorted_column(self, column):
+        # Sorted copy of a column. Sorting is done once per column per
+        # version of the data, not once per request.
+        with self.lock:
+            if self.sorted_version != self.version:
+                self.sorted_columns = {}
+                self.sorted_version = self.version
+            values = self.sorted_columns.get(column)
+            if values is None:
+                values = self.sorted_columns[column] = np.sort(self.column(column))
+            return values
+
+    def percentile(self, column, p):
+        # p-th percentile (0-100) with linear interpolation between
+        # the two nearest ranks, the same as numpy.percentile.
+        values = self.sorted_column(column)
+        if len(values) == 0:
+            return 0.0
+        position = p / 100 * (len(values) - 1)
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        fraction = position - lower
+        return float(values[lower] + (values[upper] - values[lower]) * fraction)
+
+    def median(self, column):
+        return self.percentile(column, 50)
+
+    def histogram(self, column, width=1):
+        # [[low, high, count], ...] for buckets of the given width,
+        # from the lowest to the highest mark in the column. Each
+        # bucket is two binary searches in the sorted column.
+        values = self.sorted_column(column)
+        if len(values) == 0:
+            return []
+        low = int(values[0]) // width * width
+        edges = np.arange(low, int(values[-1]) + width + 1, width)
+        counts = np.diff(np.searchsorted(values, edges, side='left'))
+        return [[int(edge), int(edge) + width - 1, int(count)]
+                for edge, count in zip(edges[:-1], counts)]
+
+    def rank(self, id_number, column):
+        # [rank, class size, percentile rank] of a student in a
+        # column. Rank 1 is the highest mark; ties share a rank. The
+        # percentile rank is the percentage of the class at or below
+        # the student's mark.
+        row = self.row_of(id_number)
+        if row is None:
+            return None
+        values = self.sorted_column(column)
+        if column == GradeSnapshot.TOTAL_COLUMN:
+            value = int(self.marks[row].sum())
+        else:
+            value = int(self.marks[row, column])
+        at_or_below = int(np.searchsorted(values, value, side='right'))
+        above = len(values) - int(np.searchsorted(values, value, side='right'))
+        return [above + 1, len(values), round(at_or_below / len(values) * 100, 2)]
+
+    def write_csv(self, file_path):
+        # Write the table as a grades CSV file, under a temporary name
+        # renamed into place.
+        temp_path = file_path + ".tmp"
+        with open(temp_path, "w", newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(self.header)
+            for first in range(0, self.count, Server.EXPORT_CHUNK_ROWS):
+                writer.writerows(self.row_lists(first, first + Server.EXPORT_CHUNK_ROWS))
+            csvfile.flush()
+            os.fsync(csvfile.fileno())
+        os.replace(temp_path, file_path)
+
+    def row_lists(self, start, stop):
+        # Rows start to stop (the owned ones) as [name, ID, key,
+        # marks...] lists, for bulk export. One NumPy call per slice
+        # rather than a GradeRecord per row.
+        return [[name, id_number, key] + marks for name, id_number, key, marks
+                in zip(self.names[start:stop], self.ids[start:stop], self.keys[start:stop],
+                       self.marks[start:stop].tolist())
+                if key is not None]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self.record(row) for row in range(self.count) if self.owned(row))
+
+
+class MappedGradeSnapshot(GradeSnapshot):
+
+    # A grades table compiled ahead of time into a binary file (see
+    # compile) and memory-mapped read-only. Opening one only reads
+    # the file header: the rows are paged in as they are used, and
+    # the pages are shared by every process that maps the file,
+    # including prefork workers. The file holds:
+    #
+    #   file header   FILE_HEADER, then the CSV header row as JSON
+    #   records       fixed-width [ID, name, key, marks] per student
+    #   ID index      the IDs sorted, then their record numbers
+    #
+    # each section starting on an ALIGNMENT byte boundary. Strings
+    # are UTF-8, numbers little-endian. IDs are found by binary search
+    # in the index, so no per-row Python objects are built. A shard
+    # server maps the whole file and only answers find() for the IDs
+    # it owns.
+    #
+    # The mapping is read-only. GradeStore copies it into an ordinary
+    # GradeSnapshot on the first add or remove.
+
+    SUFFIX = ".grades"
+    MAGIC = b"GRDS"
+    FORMAT_VERSION = 1
+
+    # magic, format version, mark columns, rows, ID width, name
+    # width, key width, header length.
+    FILE_HEADER = struct.Struct("<4sHHIHHHI")
+    ALIGNMENT = 8
+
+    def __init__(self, file_path, version, owns=None):
+        with open(file_path, 'rb') as grades_file:
+            self.map = mmap.mmap(grades_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, format_version, mark_columns, count, id_width, name_width,
+             key_width, header_length) = MappedGradeSnapshot.FILE_HEADER.unpack_from(self.map)
+        except struct.error:
+            raise ValueError("{} is not a compiled grades file".format(file_path))
+        if (magic != MappedGradeSnapshot.MAGIC
+                or format_version != MappedGradeSnapshot.FORMAT_VERSION
+                or mark_columns != GradeSnapshot.MARK_COLUMNS):
+            raise ValueError("{} is not a compiled grades file of format {}".format(
+                file_path, MappedGradeSnapshot.FORMAT_VERSION))
+
+        start = MappedGradeSnapshot.FILE_HEADER.size
+        self.header = json.loads(self.map[start:start + header_length].decode('utf-8'))
+        record_type = MappedGradeSnapshot.record_type(id_width, name_width, key_width)
+        records_offset, ids_offset, rows_offset, size = MappedGradeSnapshot.layout(
+            header_length, record_type, count, id_width)
+        if len(self.map) < size:
+            raise ValueError("{} is truncated".format(file_path))
+        self.records = np.frombuffer(self.map, record_type, count, records_offset)
+        self.sorted_ids = np.frombuffer(self.map, "S{}".format(id_width), count, ids_offset)
+        self.sorted_rows = np.frombuffer(self.map, "<u4", count, rows_offset)
+
+        self.owns = owns
+        self.names = self.ids = self.keys = self.index = None
+        self.marks = self.records["marks"]
+        self.count = count
+        self.sums = self.marks.sum(axis=0, dtype=np.int64)
+        self.version = version
+        self.lock = threading.Lock()
+        self.sorted_columns = {}
+        self.sorted_version = version
+
+    @staticmethod
+    def record_type(id_width, name_width, key_width):
+        return np.dtype([("id", "S{}".format(id_width)),
+                         ("name", "S{}".format(name_width)),
+                         ("key", "S{}".format(key_width)),
+                         ("marks", "<i4", (GradeSnapshot.MARK_COLUMNS,))])
+
+    @staticmethod
+    def layout(header_length, record_type, count, id_width):
+        # Offsets of the records, sorted IDs and row numbers, and the
+        # file size.
+        def aligned(offset):
+            return -(-offset // MappedGradeSnapshot.ALIGNMENT) * MappedGradeSnapshot.ALIGNMENT
+        records_offset = aligned(MappedGradeSnapshot.FILE_HEADER.size + header_length)
+        ids_offset = aligned(records_offset + count * record_type.itemsize)
+        rows_offset = aligned(ids_offset + count * id_width)
+        return records_offset, ids_offset, rows_offset, rows_offset + 4 * count
+
+    @classmethod
+    def compile(cls, source_path, target_path=None):
+        # Compile a CSV or XLSX grades file into target_path (by
+        # default the source name with SUFFIX) and return the mapped
+        # result. The file is written under a temporary name and
+        # renamed into place, so a server watching target_path never
+        # maps a half-written file.
+        if target_path is None:
+            target_path = os.path.splitext(source_path)[0] + cls.SUFFIX
+        cls.write(GradeSnapshot.from_file(source_path, 1), target_path)
+        return cls(target_path, 1)
+
+    @classmethod
+    def write(cls, snapshot, target_path):
+        # Write any (unsharded) snapshot in this format.
+        rows = snapshot.row_lists(0, snapshot.count)
+        count = len(rows)
+        ids = [row[1].encode('utf-8') for row in rows]
+        names = [row[0].encode('utf-8') for row in rows]
+        keys = [row[2].encode('utf-8') for row in rows]
+        # NumPy has no zero-width strings.
+        id_width = max(1, max(map(len, ids), default=0))
+        record_type = cls.record_type(id_width, max(1, max(map(len, names), default=0)),
+                                      max(1, max(map(len, keys), default=0)))
+        records = np.zeros(count, dtype=record_type)
+        records["id"] = ids
+        records["name"] = names
+        records["key"] = keys
+        records["marks"] = np.array([row[3:] for row in rows],
+                                    dtype=GradeSnapshot.MARK_DTYPE).reshape(count, cls.MARK_COLUMNS)
+        order = np.argsort(records["id"], kind="stable")
+
+        header = json.dumps(snapshot.header).encode('utf-8')
+        records_offset, ids_offset, rows_offset, size = cls.layout(
+            len(header), record_type, count, id_width)
+        sections = [(0, cls.FILE_HEADER.pack(cls.MAGIC, cls.FORMAT_VERSION, cls.MARK_COLUMNS,
+                                             count, id_width, record_type["name"].itemsize,
+                                             record_type["key"].itemsize, len(header)) + header),
+                    (records_offset, records.tobytes()),
+                    (ids_offset, records["id"][order].tobytes()),
+                    (rows_offset, order.astype("<u4").tobytes())]
+
+        temp_path = target_path + ".tmp"
+        with open(temp_path, 'wb') as grades_file:
+            for offset, data in sections:
+                grades_file.write(b"\0" * (offset - grades_file.tell()))
+                grades_file.write(data)
+            grades_file.flush()
+            os.fsync(grades_file.fileno())
+        os.replace(temp_path, target_path)
+
+    def record(self, row):
+        record = self.records[row]
+        return GradeRecord(record["name"].decode('utf-8'), record["id"].decode('utf-8'),
+                           record["key"].decode('utf-8'), record["marks"].tolist())
+
+    def row_of(self, id_number):
+        key = id_number.encode('utf-8')
+        position = int(np.searchsorted(self.sorted_ids, key))
+        if position == self.count or self.sorted_ids[position] != key:
+            return None
+        return int(self.sorted_rows[position])
+
+    def owned(self, row):
+        return self.owns is None or self.owns(self.records[row]["id"].decode('utf-8'))
+
+    def rows(self, ids=None):
+        # One vectorized binary search for the whole list of IDs.
+        if ids is None:
+            return slice(0, self.count)
+        keys = np.array([id_number.encode('utf-8') for id_number in ids], dtype=bytes)
+        if len(keys) == 0 or self.count == 0:
+            return np.zeros(0, dtype=np.intp)
+        positions = np.minimum(np.searchsorted(self.sorted_ids, keys), self.count - 1)
+        found = self.sorted_ids[positions] == keys
+        return self.sorted_rows[positions[found]].astype(np.intp)
+
+    def row_lists(self, start, stop):
+        records = self.records[start:stop]
+        rows = [[name.decode('utf-8'), id_number.decode('utf-8'), key.decode('utf-8')] + marks
+                for name, id_number, key, marks
+                in zip(records["name"].tolist(), records["id"].tolist(),
+                       records["key"].tolist(), records["marks"].tolist())]
+        if self.owns is not None:
+            rows = [row for row in rows if self.owns(row[1])]
+        return rows
+
+    def memory_usage(self):
+        # The whole mapping, although its pages are shared and the
+        # kernel can drop them.
+        return len(self.map)
+
+    def add(self, record):
+        raise TypeError("A mapped grades snapshot is read-only")
+
+    update = add
+    set_marks = add
+
+    def remove(self, id_number):
+        raise TypeError("A mapped grades snapshot is read-only")
+
+    def thaw(self):
+        # An ordinary in-memory copy that can be changed.
+        return GradeSnapshot.from_records(self.header,
+                                          (self.record(row) for row in range(self.count)),
+                                          self.version, self.owns)
+
+    copy = thaw
+
+
+class GradeJournal:
+
+    # Append-only log of mark updates to one grades file. Each line is
+    # one update request, a JSON object:
+    #
+    #   {"base": [mtime_ns, size], "marks": [[ID, column, mark], ...]}
+    #
+    # Every process serving the file applies the journal in file
+    # order, its own updates included, so prefork workers and a
+    # restarted server all end up with the same marks. Updates only
+    # ever set a mark, so applying a line twice is harmless. base is
+    # the grades file the marks were made on: once a new file is
+    # uploaded and loaded, the lines made on the old one are skipped,
+    # so they cannot override the upload's marks. (A line that is a
+    # bare list of marks, from an older journal, is always applied.)
+    #
+    # Writes are group committed: append() queues a line and waits while
+    # a flusher thread writes everything queued in one write and one
+    # fsync, then applies it. The flusher ends after IDLE_TIMEOUT
+    # without updates, so it does not keep an evicted course's store
+    # alive; the next append() starts another. Once the journal is over
+    # COMPACT_BYTES, or has waited COMPACT_INTERVAL, the store writes
+    # the whole table back over the grades file and the journal starts
+    # again empty (see GradeStore.compact). Take the store's lock before
+    # the file lock.
+
+    SUFFIX = ".journal"
+    FLUSH_INTERVAL = 0.005 # seconds spent gathering a group commit
+    IDLE_TIMEOUT = 5.0 # seconds
+    COMPACT_BYTES = 4 * 1024 * 1024
+    COMPACT_INTERVAL = 300.0 # seconds
+
+    def __init__(self, grade_store, path):
+        self.grade_store = grade_store
+        self.path = path
+        # Queued [line, done event, error] entries.
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.compacted = time.monotonic()
+
+    def append(self, updates):
+        # Returns once the updates are on disk and applied.
+        entry = [updates, threading.Event(), None]
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.pending.append(entry)
+            self.condition.notify()
+        entry[1].wait()
+        if entry[2] is not None:
+            raise entry[2]
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.pending, GradeJournal.IDLE_TIMEOUT):
+                    self.thread = None
+                    return
+            time.sleep(GradeJournal.FLUSH_INTERVAL)
+            with self.condition:
+                batch, self.pending = self.pending, []
+            error = None
+            try:
+                # The store's lock keeps a reload from changing the
+                # base before the batch is applied.
+                with self.grade_store.lock:
+                    base = self.grade_store.loaded_stat
+                    with self.file_lock():
+                        self.write(b"".join(GradeJournal.line(base, entry[0]) for entry in batch))
+                    self.grade_store.catch_up()
+            except Exception as msg:
+                logger.error("Journal write to %s failed: %s", self.path, msg)
+                error = OSError("Journal write failed: {}".format(msg))
+            for entry in batch:
+                entry[2] = error
+                entry[1].set()
+            if error is None and self.should_compact():
+                try:
+                    self.grade_store.compact()
+                except Exception as msg:
+                    logger.error("Compaction of %s failed: %s", self.path, msg)
+                self.compacted = time.monotonic()
+
+    @staticmethod
+    def line(base, updates):
+        return (json.dumps({"base": base, "marks": updates}, separators=(",", ":"))
+                + "\n").encode('utf-8')
+
+    def write(self, data):
+        # Called with the file lock held. The file is opened per
+        # batch, so a journal replaced by compaction in another
+        # process is picked up.
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size and os.pread(fd, 1, size - 1) != b"\n":
+                # A torn line from a crash: end it, so it is skipped
+                # rather than glued to this batch.
+                data = b"\n" + data
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def should_compact(self):
+        size = self.stat()[1]
+        return size > 0 and (size >= GradeJournal.COMPACT_BYTES or
+                             time.monotonic() - self.compacted >= GradeJournal.COMPACT_INTERVAL)
+
+    def stat(self):
+        # (inode, size), or (None, 0) if there is no journal.
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def read(self, offset, base):
+        # The updates of the complete lines from offset on made on the
+        # grades file base (its mtime and size), the offset after
+        # them and the number of lines skipped for another base.
+        try:
+            with open(self.path, 'rb') as journal_file:
+                journal_file.seek(offset)
+                data = journal_file.read()
+        except OSError:
+            return [], offset, 0
+        end = data.rfind(b"\n") + 1
+        base = None if base is None else list(base)
+        updates = []
+        skipped = 0
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+                if isinstance(entry, list):
+                    updates += entry
+                elif entry["base"] == base:
+                    updates += entry["marks"]
+                else:
+                    skipped += 1
+            except (ValueError, TypeError, KeyError):
+                logger.warning("Skipping a damaged line in %s.", self.path)
+        return updates, offset + end, skipped
+
+    def reset(self):
+        # Replace the journal with an empty file. Called with the file
+        # lock held.
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'wb') as journal_file:
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, self.path)
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        # Serializes appends and compaction between processes.
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class GradeStore:
+
+    # Loads the grades file (CSV, XLSX or a compiled snapshot) once
+    # and indexes it by ID number, so lookups never touch the
+    # filesystem. load() parses the file into a new GradeSnapshot and
+    # swaps it in with a single reference assignment, then applies
+    # the file's journal (see GradeJournal) on top. set_marks() is
+    # the write path. Listeners (see ReplicationPublisher) are told
+    # of every change.
+
+    MARK_COLUMNS = GradeSnapshot.MARK_COLUMNS
+    MAX_MARK = 1000
+
+    def __init__(self, file_path, owns=None, journal_suffix=GradeJournal.SUFFIX):
+        self.file_path = file_path
+        self.owns = owns
+        self.snapshot = None
+        self.lock = threading.RLock()
+        self.journal = GradeJournal(self, file_path + journal_suffix)
+        # Inode of the journal and how far into it has been applied.
+        self.journal_inode = None
+        self.journal_offset = 0
+        # File mtime and size as of the last load (see
+        # GradeFileWatcher).
+        self.loaded_stat = None
+        # COMPACT_BYTES steps of a journal that cannot be compacted
+        # already warned about (see compact).
+        self.journal_warned = 0
+        # Callables given (updates, version) after each change, with
+        # the lock held; updates is None when the whole table was
+        # reloaded.
+        self.listeners = []
+        self.load()
+
+    def load(self):
+        with self.lock:
+            version = 1 if self.snapshot is None else self.snapshot.version + 1
+            loaded_stat = self.file_stat()
+            self.snapshot = GradeSnapshot.from_file(self.file_path, version, self.owns)
+            self.loaded_stat = loaded_stat
+            self.journal_inode = None
+            self.journal_offset = 0
+            self.notify(None)
+            self.catch_up()
+
+    def notify(self, updates):
+        for listener in self.listeners:
+            listener(updates, self.snapshot.version)
+
+    def file_stat(self):
+        try:
+            st = os.stat(self.file_path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def catch_up(self):
+        # Apply journal lines written since the last call, by this
+        # process or any other.
+        with self.lock:
+            inode, size = self.journal.stat()
+            if inode is None or (inode == self.journal_inode and size == self.journal_offset):
+                return
+            if self.journal_inode is not None and (inode != self.journal_inode
+                                                   or size < self.journal_offset):
+                # Compacted by another process: the grades file has
+                # the updates now.
+                self.load()
+                return
+            updates, self.journal_offset, skipped = self.journal.read(self.journal_offset,
+                                                                      self.loaded_stat)
+            self.journal_inode = inode
+            if skipped:
+                logger.info("Skipped %d journal lines of %s made on an earlier grades file.",
+                            skipped, self.file_path)
+            if updates:
+                # Apply them to a copy and swap it in, as a reload
+                # does, so a request never sees part of an update.
+                snapshot = self.snapshot.copy()
+                snapshot.set_marks(updates)
+                self.snapshot = snapshot
+                self.notify(updates)
+
+    def set_marks(self, updates):
+        # Journal and apply [ID, column, mark] updates as one change.
+        # Returns once they are on disk. Raises KeyError for an
+        # unknown ID and ValueError for a bad column or mark, before
+        # anything is written.
+        snapshot = self.snapshot
+        for id_number, column, mark in updates:
+            if snapshot.row_of(id_number) is None:
+                raise KeyError(id_number)
+            if not 0 <= column < GradeStore.MARK_COLUMNS:
+                raise ValueError("Invalid column {}".format(column))
+            if type(mark) is not int or not 0 <= mark <= GradeStore.MAX_MARK:
+                raise ValueError("Invalid mark {!r}".format(mark))
+        self.journal.append([list(update) for update in updates])
+        return len(updates)
+
+    def compact(self):
+        # Write the current table over the grades file and empty the
+        # journal. A shard only holds its own students' names and
+        # keys and an XLSX file cannot be written, so those keep
+        # their journal instead, and it only grows: that is warned
+        # about each time it passes another COMPACT_BYTES.
+        extension = os.path.splitext(self.file_path)[1].lower()
+        if self.owns is not None or extension == ".xlsx":
+            steps = self.journal.stat()[1] // GradeJournal.COMPACT_BYTES
+            if steps > self.journal_warned:
+                self.journal_warned = steps
+                logger.warning("Journal %s is over %d MB and is never compacted (%s).",
+                               self.journal.path,
+                               steps * GradeJournal.COMPACT_BYTES // (1024 * 1024),
+                               "a shard" if self.owns is not None else "an XLSX file")
+            return False
+        with self.lock, self.journal.file_lock():
+            self.catch_up()
+            if self.file_stat() != self.loaded_stat:
+                # A new grades file was uploaded and the watcher has
+                # not reloaded it yet; writing this table over it
+                # would lose the upload.
+                logger.info("Not compacting %s, it changed since it was loaded.", self.file_path)
+                return False
+            snapshot = self.snapshot
+            if extension == MappedGradeSnapshot.SUFFIX:
+                MappedGradeSnapshot.write(snapshot, self.file_path)
+                self.snapshot = MappedGradeSnapshot(self.file_path, snapshot.version + 1, self.owns)
+                # Same marks, new version.
+                self.notify([])
+            else:
+                snapshot.write_csv(self.file_path)
+            self.journal.reset()
+            self.journal_inode, self.journal_offset = self.journal.stat()
+            self.loaded_stat = self.file_stat()
+        logger.info("Compacted %s into %s.", self.journal.path, self.file_path)
+        return True
+
+    def writable(self):
+        # The current snapshot, first copied into memory if it is a
+        # read-only mapped one.
+        with self.lock:
+            if isinstance(self.snapshot, MappedGradeSnapshot):
+                self.snapshot = self.snapshot.thaw()
+            return self.snapshot
+
+    @property
+    def header(self):
+        return self.snapshot.header
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    def find(self, id_number):
+        return self.snapshot.find(id_number)
+
+    def add(self, record):
+        self.writable().add(record)
+
+    update = add
+
+    def remove(self, id_number):
+        return self.writable().remove(id_number)
+
+    def averages(self):
+        return self.snapshot.averages()
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def __iter__(self):
+        return iter(self.snapshot)
+
+
+class GradeFileWatcher:
+
+    # Background thread that polls the grades file mtime and size and
+    # reloads the GradeStore when they change. It also applies journal
+    # updates made by other processes (see GradeJournal). A change is
+    # only acted on once the file has stayed the same for one whole poll
+    # interval, so an upload that is still being written is not picked
+    # up half way. If the new file fails to parse, the old snapshot
+    # stays in service.
+
+    POLL_INTERVAL = 2.0 # seconds
+
+    def __init__(self, grade_store, poll_interval=POLL_INTERVAL):
+        self.grade_store = grade_store
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        previous_stat = self.grade_store.loaded_stat
+        while not self.stopped.wait(self.poll_interval):
+            current_stat = self.grade_store.file_stat()
+            if current_stat is None or current_stat == self.grade_store.loaded_stat:
+                previous_stat = current_stat
+                try:
+                    self.grade_store.catch_up()
+                except Exception as msg:
+                    logger.error("Journal replay for %s failed: %s", self.grade_store.file_path, msg)
+                continue
+            if current_stat != previous_stat:
+                # Still changing, wait for it to settle.
+                previous_stat = current_stat
+                continue
+            try:
+                self.grade_store.load()
+                logger.info("Reloaded %s (%d rows, version %d).",
+                            self.grade_store.file_path, len(self.grade_store),
+                            self.grade_store.version)
+            except Exception as msg:
+                logger.error("Reload of %s failed: %s", self.grade_store.file_path, msg)
+                # Do not retry the same broken file on every poll.
+                self.grade_store.loaded_stat = current_stat
+
+
+class ShardMap:
+
+    # Splits the students of every course across several server
+    # processes, by a hash of the ID or by ID ranges. The same map is
+    # given to every shard server (with its own index) and to the
+    # Router in front of them.
+    #
+    # e.g., ShardMap.parse("hash:4")
+    #       ShardMap.parse("range:1850000,1900000")  -> 3 shards
+
+    SCHEMES = ("hash", "range")
+
+    def __init__(self, scheme="hash", count=1, boundaries=()):
+        if scheme not in ShardMap.SCHEMES:
+            raise ValueError("Unknown shard scheme: {}".format(scheme))
+        self.scheme = scheme
+        self.boundaries = sorted(boundaries)
+        self.count = len(self.boundaries) + 1 if scheme == "range" else count
+        if self.count < 1:
+            raise ValueError("A shard map needs at least one shard")
+
+    @classmethod
+    def parse(cls, text):
+        scheme, _, value = text.partition(":")
+        if scheme == "range":
+            return cls("range", boundaries=[int(b) for b in value.split(",") if b])
+        return cls(scheme, int(value))
+
+    def shard_of(self, id_number):
+        if self.scheme == "range":
+            try:
+                return bisect.bisect_right(self.boundaries, int(id_number))
+            except ValueError:
+                return 0
+        return zlib.crc32(id_number.encode('ascii', 'replace')) % self.count
+
+    def owner(self, index):
+        # Predicate for the IDs shard number index serves.
+        return lambda id_number: self.shard_of(id_number) == index
+
+
+class CourseCatalog:
+
+    # The grade tables one server hosts. The default course is the file
+    # the server was started with and is always loaded. Other courses
+    # are <courses_dir>/<course>.grades (compiled, see
+    # MappedGradeSnapshot) or else <course>.csv, loaded the first time a
+    # request names them. When the loaded courses go over the memory
+    # budget the least recently used ones are dropped (and reloaded on
+    # their next request). Each course file has its own journal of mark
+    # updates, <file><journal_suffix>.
+
+    MEMORY_BUDGET = 512 * 1024 * 1024 # bytes
+    COURSE_NAME = re.compile(r"[A-Za-z0-9_-]+\Z")
+
+    def __init__(self, default_file, courses_dir=None, memory_budget=MEMORY_BUDGET, owns=None,
+                 journal_suffix=GradeJournal.SUFFIX):
+        self.courses_dir = courses_dir
+        self.memory_budget = memory_budget
+        self.owns = owns
+        self.journal_suffix = journal_suffix
+        self.default = GradeStore(default_file, owns, journal_suffix)
+        # Loaded courses, least recently used first, and their file
+        # watchers.
+        self.stores = OrderedDict()
+        self.watchers = {}
+        self.reload_interval = 0
+        self.lock = threading.Lock()
+        # One lock per course being loaded, so two requests for the
+        # same cold course only load it once.
+        self.loading = {}
+
+    def get(self, course=None):
+        # The GradeStore for a course. Raises KeyError for an unknown
+        # course, RequestError for one whose file cannot be loaded.
+        if course is None:
+            return self.default
+        with self.lock:
+            store = self.stores.get(course)
+            if store is not None:
+                self.stores.move_to_end(course)
+                return store
+            if self.courses_dir is None or not CourseCatalog.COURSE_NAME.match(course):
+                raise KeyError(course)
+            load_lock = self.loading.setdefault(course, threading.Lock())
+
+        with load_lock:
+            try:
+                with self.lock:
+                    store = self.stores.get(course)
+                if store is None:
+                    file_path = CourseCatalog.course_file(self.courses_dir, course)
+                    if file_path is None:
+                        raise KeyError(course)
+                    try:
+                        store = GradeStore(file_path, self.owns, self.journal_suffix)
+                    except Exception as msg:
+                        logger.error("Cannot load course %s: %s", course, msg)
+                        raise RequestError("Course unavailable.")
+                    logger.info("Loaded course %s (%d rows).", course, len(store))
+                    with self.lock:
+                        self.stores[course] = store
+                        self.start_watcher(course, store)
+                        self.evict()
+            finally:
+                with self.lock:
+                    self.loading.pop(course, None)
+        return store
+
+    @staticmethod
+    def course_file(courses_dir, course):
+        # The file a course is loaded from, or None.
+        for suffix in (MappedGradeSnapshot.SUFFIX, ".csv"):
+            file_path = os.path.join(courses_dir, course + suffix)
+            if os.path.isfile(file_path):
+                return file_path
+        return None
+
+    def memory_usage(self):
+        return (self.default.snapshot.memory_usage()
+                + sum(store.snapshot.memory_usage() for store in self.stores.values()))
+
+    def evict(self):
+        # Called with self.lock held. The most recently loaded course
+        # is never evicted, even if it alone is over budget.
+        while len(self.stores) > 1 and self.memory_usage() > self.memory_budget:
+            course, store = self.stores.popitem(last=False)
+            watcher = self.watchers.pop(course, None)
+            if watcher is not None:
+                watcher.stop()
+            logger.info("Evicted course %s.", course)
+
+    def start_watchers(self, reload_interval):
+        # Watch the default course and every course loaded from now
+        # on. Called once per process (prefork workers call it after
+        # forking).
+        self.reload_interval = reload_interval
+        with self.lock:
+            self.watchers[None] = GradeFileWatcher(self.default, reload_interval).start()
+            for course, store in self.stores.items():
+                self.start_watcher(course, store)
+
+    def start_watcher(self, course, store):
+        if self.reload_interval > 0 and course not in self.watchers:
+            self.watchers[course] = GradeFileWatcher(store, self.reload_interval).start()
+
+########################################################################
+# Fernet and response cache classes
+########################################################################
+
+class FernetCache:
+
+    # Bounded LRU cache of ready-to-use Fernet objects keyed by
+    # student ID. Each entry remembers the key it was built from, so
+    # if the student's key changes in the CSV the stale Fernet is
+    # rebuilt on the next lookup.
+
+    MAX_ENTRIES = 4096
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, id_number, key):
+        with self.lock:
+            entry = self.entries.get(id_number)
+            if entry is not None and entry[0] == key:
+                self.entries.move_to_end(id_number)
+                return entry[1]
+
+        # Build outside the lock, it is the expensive part.
+        fernet = Fernet(key)
+        with self.lock:
+            self.entries[id_number] = (key, fernet)
+            self.entries.move_to_end(id_number)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return fernet
+
+    def invalidate(self, id_number=None):
+        # Drop one student's entry, or everything if no ID is given.
+        with self.lock:
+            if id_number is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(id_number, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Session:
+
+    # One student's session on one persistent connection (see
+    # Protocol): the AES-GCM key both ends derive from the student's
+    # key and the handshake nonces, and the sequence number of the
+    # next reply. Sealing a reply is one AES-GCM pass with 24 bytes of
+    # overhead, where a Fernet token adds AES-CBC padding, an
+    # HMAC-SHA256 and base64, about 100 bytes for a short reply.
+
+    NONCE_SIZE = 16 # Handshake nonces.
+    KEY_SIZE = 32 # AES-256.
+    INFO = b"grade retrieval session "
+    SEQUENCE = struct.Struct("!Q")
+    # The 12 byte GCM nonce is 4 zero bytes and then the sequence.
+    NONCE_PREFIX = bytes(4)
+
+    __slots__ = ("number", "course", "id_number", "key", "aead", "sequence")
+
+    def __init__(self, number, course, id_number, key, client_nonce, server_nonce):
+        # number is the packed session ID, key the student's Fernet
+        # key (base64, as in the grades file).
+        self.number = number
+        self.course = course
+        self.id_number = id_number
+        self.key = key
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=Session.KEY_SIZE,
+                    salt=client_nonce + server_nonce,
+                    info=Session.INFO + "{}/{}".format(course or "", id_number).encode('ascii'))
+        self.aead = AESGCM(hkdf.derive(base64.urlsafe_b64decode(key)))
+        self.sequence = 0
+
+    def seal(self, plaintext):
+        # Server side: the SEALED_RESPONSE payload for a reply.
+        sequence = Session.SEQUENCE.pack(self.sequence)
+        self.sequence += 1
+        return sequence + self.aead.encrypt(Session.NONCE_PREFIX + sequence, plaintext, self.number)
+
+    def open(self, sealed):
+        # Client side: the reply plaintext of a SEALED_RESPONSE
+        # payload. Raises InvalidTag if it was not sealed with this
+        # session's key, or replays an earlier reply.
+        try:
+            (sequence,) = Session.SEQUENCE.unpack_from(sealed)
+        except struct.error:
+            raise InvalidTag()
+        if sequence < self.sequence:
+            raise InvalidTag()
+        plaintext = self.aead.decrypt(Session.NONCE_PREFIX + sealed[:Session.SEQUENCE.size],
+                                      sealed[Session.SEQUENCE.size:], self.number)
+        self.sequence = sequence + 1
+        return plaintext
+
+
+class ResponseCache:
+
+    # Bounded LRU cache of reply plaintexts keyed by (course, ID,
+    # command, protocol version), so a student refreshing the same query
+    # skips the lookup, aggregation and formatting. Each entry remembers
+    # the snapshot and snapshot version it was computed from and is only
+    # used while the request sees that same snapshot at that same
+    # version: a reload, an edit or a course reload after eviction all
+    # make it miss. The snapshot is held by weak reference, so the cache
+    # never keeps an old table alive.
+    #
+    # Only the plaintext and the student's key are cached, never the
+    # Fernet token. A token carries its creation time and a random IV;
+    # replaying one would let anyone watching the wire see that two
+    # replies are identical, and would hand out tokens that look
+    # older than they are to a client checking the token age. Every
+    # reply is still encrypted fresh, which is the cheap part next to
+    # the rest of the request.
+    #
+    # The cache is bounded both by entry count and by approximate
+    # bytes; whichever limit is hit first evicts the least recently
+    # used entries.
+
+    MAX_ENTRIES = 65536
+    MAX_BYTES = 32 * 1024 * 1024
+    # Approximate bytes per entry besides the plaintext and key: the
+    # key tuple, the entry tuple, the weak reference and the dict
+    # slot.
+    ENTRY_OVERHEAD = 300
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, cache_key, snapshot):
+        # (key, plaintext) cached for this snapshot, or None.
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if (entry is not None and entry[0]() is snapshot
+                    and entry[1] == snapshot.version):
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[2], entry[3]
+            self.misses += 1
+            return None
+
+    def put(self, cache_key, snapshot, version, key, plaintext):
+        # version is the snapshot version the reply was computed
+        # from, read before computing it, so a concurrent edit can
+        # only make the entry miss.
+        size = len(key) + len(plaintext) + ResponseCache.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(cache_key, None)
+            if old is not None:
+                self.bytes -= old[4]
+            self.entries[cache_key] = (weakref.ref(snapshot), version, key, plaintext, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted[4]
+
+    def invalidate(self, course=None):
+        # Drop one course's entries, or everything if no course is
+        # given.
+        with self.lock:
+            if course is None:
+                self.entries.clear()
+                self.bytes = 0
+                return
+            for cache_key in [cache_key for cache_key in self.entries if cache_key[0] == course]:
+                self.bytes -= self.entries.pop(cache_key)[4]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+    def __len__(self):
+        return len(self.entries)
+
+########################################################################
+# Wire protocol class
+########################################################################
+
+class ProtocolError(Exception):
+    pass
+
+
+class RequestError(Exception):
+    # Raised by Server.handle_request when a request cannot be
+    # answered. The message is sent back in an ERROR frame.
+    pass
+
+
+class ServerBusy(RequestError):
+
+    # Raised when admission control sheds a request. Sent back as a
+    # BUSY frame (or a BUSY batch result) carrying retry_after.
+
+    def __init__(self, retry_after):
+        super().__init__("Server busy")
+        self.retry_after = retry_after
+
+
+class ClientError(Exception):
+    # Raised by Client (when exit_on_error is off) and the client
+    # pools instead of exiting the process.
+    pass
+
+
+class Protocol:
+
+    # Length-prefixed message framing. Every message is a 6 byte
+    # header followed by the payload:
+    #
+    #   version (1 byte) | type (1 byte) | payload length (4 bytes)
+    #
+    # all in network byte order. A REQUEST payload is the same
+    # "ID + command" ASCII string the original protocol used, a
+    # RESPONSE payload is the Fernet token and an ERROR payload is an
+    # ASCII reason. Many frames can be sent on one connection.
+    #
+    # The server answers in the version of the request. The Fernet
+    # token of a version 1 reply holds str() of the value as ASCII
+    # text (the original format, also sent to legacy clients). A
+    # version 2 reply holds fixed-width fields in network byte order,
+    # after a kind byte:
+    #
+    #   NUMBER     value (8 bytes, signed, in millionths)
+    #   MARKS      count (1 byte) | count x mark (4 bytes, signed)
+    #   HISTOGRAM  count (4 bytes) | count x [low (4 bytes, signed) |
+    #              high (4 bytes, signed) | students (4 bytes)]
+    #   RANK       rank (4 bytes) | class size (4 bytes) |
+    #              percentile rank (8 bytes, signed, in millionths)
+    #
+    # Averages, medians and percentiles are NUMBERs. GG is MARKS: just
+    # the student's marks, not the name, ID and key the client already
+    # has. A client tries version 2 first and drops to version 1 if
+    # the server answers "Unsupported protocol version".
+    #
+    # A BATCH_REQUEST carries many requests in one frame:
+    #
+    #   count (4 bytes) | count x [length (1 byte) | "ID + command"]
+    #
+    # and is answered by one BATCH_RESPONSE with a result per request,
+    # in the same order:
+    #
+    #   count (4 bytes) | count x [status (1 byte) | length (4 bytes) | data]
+    #
+    # where data is the Fernet token (status OK) or an ASCII reason
+    # (status FAILED). Each token is encrypted with its own student's
+    # key.
+    #
+    # An EXPORT_REQUEST asks for a whole course. Its payload is a
+    # Fernet token, made with the instructor key, of the course name
+    # (empty for the default course); the server only accepts tokens
+    # less than EXPORT_TOKEN_TTL seconds old. The reply is a stream of
+    # EXPORT_CHUNK frames, each a Fernet token (instructor key) of
+    # zlib-compressed CSV text, the first starting with the header
+    # row, then one EXPORT_END frame whose payload is the row count
+    # (4 bytes). Frames for other requests pipelined behind the export
+    # are answered after it.
+    #
+    # An UPDATE_REQUEST changes marks. Its payload is a Fernet token,
+    # made with the instructor key (and checked against
+    # EXPORT_TOKEN_TTL), of the JSON object
+    #
+    #   {"course": <name or null>, "updates": [[ID, column, mark], ...]}
+    #
+    # where column is a GradeSnapshot.COLUMN_CODES code other than
+    # "T". The updates are applied all or none. The UPDATE_RESPONSE,
+    # sent once they are journaled to disk, is the JSON object
+    # {"applied": <count>, "version": <snapshot version>}.
+    #
+    # A SUBSCRIBE_REQUEST, sent by a replica to its primary's
+    # replication port, is a Fernet token (instructor key, checked
+    # against EXPORT_TOKEN_TTL) of an empty string. It is answered by
+    # a never-ending stream: the default course's table as EXPORT_CHUNK
+    # frames and an EXPORT_END frame, then REPLICA_DELTA frames. Each
+    # delta is a Fernet token (instructor key) of the JSON object
+    #
+    #   {"version": <version with these updates>, "head": <primary's
+    #    current version>, "updates": [[ID, column index, mark], ...]}
+    #
+    # sent as the primary applies updates. One with no updates is sent
+    # after every snapshot and as a heartbeat when there is nothing
+    # else to send. The primary may send a fresh snapshot at any time
+    # (after a reload, or when a replica has fallen too far behind).
+    #
+    # A SESSION_REQUEST starts a session for one student on this
+    # connection, so that student's replies need not each be a Fernet
+    # token. Its payload is
+    #
+    #   client nonce (16 bytes) | "ID" ASCII (with a "course/" prefix
+    #                                         for another course)
+    #
+    # and the SESSION_RESPONSE is
+    #
+    #   session ID (4 bytes) | server nonce (16 bytes)
+    #
+    # Both ends then derive an AES-256-GCM key from the student's key
+    # with HKDF-SHA256, salted with the two nonces (see Session). A
+    # SEALED_REQUEST is
+    #
+    #   session ID (4 bytes) | command ASCII
+    #
+    # and is answered by a SEALED_RESPONSE,
+    #
+    #   sequence (8 bytes) | AES-GCM ciphertext and tag
+    #
+    # sealing the same plaintext a RESPONSE token would hold, with the
+    # session ID as associated data. The sequence counts the session's
+    # replies from 0 and is the GCM nonce, so no nonce is used twice
+    # under a key. A session lasts as long as its connection (at most
+    # Server.MAX_SESSIONS per connection) or until the student's key
+    # changes, after which SEALED_REQUESTs get a "Session ended" ERROR.
+    # The router holds no keys and refuses sessions; clients then send
+    # plain REQUESTs.
+    #
+    # A client may set the ACCEPT_COMPRESSED flag on a request's type
+    # byte to take a compressed reply. The server then zlib-compresses
+    # any reply payload of at least its compression threshold (see
+    # Server.compress_reply) and sets the COMPRESSED flag on the reply
+    # type. Small replies, such as single GG or average requests, are
+    # sent as they are. A batch response is compressed after its
+    # per-student Fernet tokens are made, winning back most of their
+    # base64 overhead. Export chunks are compressed before they are
+    # encrypted whether or not the flag is set (see above). A server
+    # that does not know the flag answers "Unknown message type", and
+    # the client asks again without it.
+    #
+    # A BUSY frame (or a BUSY batch result) means the server shed the
+    # request under load without looking at it. Its payload is how
+    # long to wait before retrying, in milliseconds, as a 4 byte
+    # integer. It may also arrive unasked as the first frame on a new
+    # connection the server is refusing.
+    #
+    # Legacy clients send the bare ASCII request with no header. Their
+    # first byte is a printable character, which can never be a
+    # protocol version, so the server can tell the two apart.
+
+    VERSION = 2
+    # Every client and server understands version 1, so frames sent
+    # before a request has shown the peer's version use it.
+    BASE_VERSION = 1
+    SUPPORTED_VERSIONS = (1, 2)
+    UNSUPPORTED_VERSION = b"Unsupported protocol version"
+
+    REQUEST = 1
+    RESPONSE = 2
+    ERROR = 3
+    BATCH_REQUEST = 4
+    BATCH_RESPONSE = 5
+    STATS_REQUEST = 6 # Empty payload, only accepted from localhost.
+    STATS_RESPONSE = 7 # JSON encoded ServerMetrics.snapshot().
+    BUSY = 8
+    EXPORT_REQUEST = 9
+    EXPORT_CHUNK = 10
+    EXPORT_END = 11
+    UPDATE_REQUEST = 12
+    UPDATE_RESPONSE = 13
+    SUBSCRIBE_REQUEST = 14
+    REPLICA_DELTA = 15
+    SESSION_REQUEST = 16
+    SESSION_RESPONSE = 17
+    SEALED_REQUEST = 18
+    SEALED_RESPONSE = 19
+
+    # Flags on the type byte (see above).
+    ACCEPT_COMPRESSED = 0x40
+    COMPRESSED = 0x80
+    TYPE_MASK = 0x3f
+
+    UNKNOWN_TYPE = b"Unknown message type"
+    NO_SESSIONS = b"Sessions are not supported"
+    TOO_MANY_SESSIONS = b"Too many sessions"
+    SESSION_ENDED = b"Session ended"
+    INTERNAL_ERROR = b"Internal server error"
+
+    EXPORT_TOKEN_TTL = 60 # seconds
+    MAX_UPDATES = 10000 # per UPDATE_REQUEST
+
+    # Batch result status codes.
+    OK = 0
+    FAILED = 1
+    THROTTLED = 2
+
+    # Version 2 reply kinds.
+    NUMBER = 1
+    MARKS = 2
+    HISTOGRAM = 3
+    RANK = 4
+    MILLIONTHS = 1000000
+
+    RETRY_AFTER = struct.Struct("!I")
+    SESSION_ID = struct.Struct("!I")
+    NUMBER_VALUE = struct.Struct("!Bq")
+    MARK = struct.Struct("!i")
+    BUCKET = struct.Struct("!qqI")
+    RANK_VALUE = struct.Struct("!BIIq")
+
+    COUNT = struct.Struct("!I")
+    ITEM_LENGTH = struct.Struct("!B")
+    RESULT_HEADER = struct.Struct("!BI")
+
+    MAX_BATCH_ITEMS = 100000
+
+    HEADER = struct.Struct("!BBI")
+    HEADER_SIZE = HEADER.size
+
+    MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+    @staticmethod
+    def is_framed(first_bytes):
+        return len(first_bytes) > 0 and first_bytes[0] < 0x20
+
+    @staticmethod
+    def pack(msg_type, payload, version=VERSION):
+        return Protocol.HEADER.pack(version, msg_type, len(payload)) + payload
+
+    @staticmethod
+    def decompress(frame):
+        # A received (version, type, payload) frame with any
+        # compression of its payload undone.
+        version, msg_type, payload = frame
+        if not msg_type & Protocol.COMPRESSED:
+            return frame
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(payload, Protocol.MAX_PAYLOAD_SIZE)
+        except zlib.error:
+            raise ProtocolError("Malformed compressed frame")
+        if decompressor.unconsumed_tail:
+            raise ProtocolError("Frame too large (over {} bytes)".format(Protocol.MAX_PAYLOAD_SIZE))
+        if not decompressor.eof:
+            raise ProtocolError("Malformed compressed frame")
+        return version, msg_type & Protocol.TYPE_MASK, payload
+
+    @staticmethod
+    def pack_batch_request(messages):
+        # messages is a list of "ID + command" bytes objects.
+        parts = [Protocol.COUNT.pack(len(messages))]
+        for message in messages:
+            parts.append(Protocol.ITEM_LENGTH.pack(len(message)))
+            parts.append(message)
+        return b"".join(parts)
+
+    @staticmethod
+    def pack_busy(retry_after):
+        # retry_after in seconds.
+        return Protocol.RETRY_AFTER.pack(max(1, int(retry_after * 1000)))
+
+    @staticmethod
+    def unpack_busy(payload):
+        # Retry delay in seconds.
+        try:
+            return Protocol.RETRY_AFTER.unpack(payload)[0] / 1000
+        except struct.error:
+            raise ProtocolError("Malformed busy reply")
+
+    @staticmethod
+    def pack_reply(kind, value, version):
+        # Reply plaintext for a version (see above). Raises
+        # RequestError if a value does not fit its field.
+        if version == Protocol.BASE_VERSION:
+            return str(value).encode('ascii')
+        try:
+            return Protocol.pack_value(kind, value)
+        except struct.error:
+            raise RequestError("Reply value out of range.")
+
+    @staticmethod
+    def pack_value(kind, value):
+        match kind:
+            case Protocol.NUMBER:
+                return Protocol.NUMBER_VALUE.pack(kind, round(value * Protocol.MILLIONTHS))
+            case Protocol.MARKS:
+                return bytes((kind, len(value))) + b"".join(Protocol.MARK.pack(mark) for mark in value)
+            case Protocol.HISTOGRAM:
+                return (bytes((kind,)) + Protocol.COUNT.pack(len(value))
+                        + b"".join(Protocol.BUCKET.pack(*bucket) for bucket in value))
+            case Protocol.RANK:
+                rank, size, percentile = value
+                return Protocol.RANK_VALUE.pack(kind, rank, size, round(percentile * Protocol.MILLIONTHS))
+
+    @staticmethod
+    def unpack_reply(plaintext):
+        # The value of a version 2 reply plaintext.
+        try:
+            match plaintext[0]:
+                case Protocol.NUMBER:
+                    return Protocol.NUMBER_VALUE.unpack(plaintext)[1] / Protocol.MILLIONTHS
+                case Protocol.MARKS:
+                    return [mark for (mark,) in Protocol.MARK.iter_unpack(plaintext[2:2 + 4 * plaintext[1]])]
+                case Protocol.HISTOGRAM:
+                    (count,) = Protocol.COUNT.unpack_from(plaintext, 1)
+                    end = 1 + Protocol.COUNT.size + count * Protocol.BUCKET.size
+                    return [list(bucket) for bucket in
+                            Protocol.BUCKET.iter_unpack(plaintext[1 + Protocol.COUNT.size:end])]
+                case Protocol.RANK:
+                    kind, rank, size, percentile = Protocol.RANK_VALUE.unpack(plaintext)
+                    return [rank, size, percentile / Protocol.MILLIONTHS]
+        except (IndexError, struct.error):
+            pass
+        raise ProtocolError("Malformed reply")
+
+    @staticmethod
+    def batch_size(payload):
+        # Item count of a batch request, read without unpacking it.
+        try:
+            return Protocol.COUNT.unpack_from(payload)[0]
+        except struct.error:
+            return 1
+
+    @staticmethod
+    def unpack_batch_request(payload):
+        try:
+            (count,) = Protocol.COUNT.unpack_from(payload)
+            if count > Protocol.MAX_BATCH_ITEMS:
+                raise ProtocolError("Batch too large ({} items)".format(count))
+            messages = []
+            offset = Protocol.COUNT.size
+            for _ in range(count):
+                (length,) = Protocol.ITEM_LENGTH.unpack_from(payload, offset)
+                offset += Protocol.ITEM_LENGTH.size
+                messages.append(payload[offset:offset + length])
+                offset += length
+        except struct.error:
+            raise ProtocolError("Malformed batch request")
+        if offset != len(payload):
+            raise ProtocolError("Malformed batch request")
+        return messages
+
+    @staticmethod
+    def pack_batch_response(results):
+        # results is a list of (status, data) tuples.
+        parts = [Protocol.COUNT.pack(len(results))]
+        for status, data in results:
+            parts.append(Protocol.RESULT_HEADER.pack(status, len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    @staticmethod
+    def unpack_batch_response(payload):
+        try:
+            (count,) = Protocol.COUNT.unpack_from(payload)
+            results = []
+            offset = Protocol.COUNT.size
+            for _ in range(count):
+                status, length = Protocol.RESULT_HEADER.unpack_from(payload, offset)
+                offset += Protocol.RESULT_HEADER.size
+                results.append((status, payload[offset:offset + length]))
+                offset += length
+        except struct.error:
+            raise ProtocolError("Malformed batch response")
+        return results
+
+    @staticmethod
+    def split_frames(buffer):
+        # Remove all complete frames from the front of buffer (a
+        # bytearray) and return them as (version, type, payload)
+        # tuples. Any partial frame is left in the buffer for the
+        # next call.
+        frames = []
+        while len(buffer) >= Protocol.HEADER_SIZE:
+            version, msg_type, length = Protocol.HEADER.unpack_from(buffer)
+            if version not in Protocol.SUPPORTED_VERSIONS:
+                raise ProtocolError("{} {}".format(Protocol.UNSUPPORTED_VERSION.decode('ascii'), version))
+            if length > Protocol.MAX_PAYLOAD_SIZE:
+                raise ProtocolError("Frame too large ({} bytes)".format(length))
+            end = Protocol.HEADER_SIZE + length
+            if len(buffer) < end:
+                break
+            frames.append((version, msg_type, bytes(buffer[Protocol.HEADER_SIZE:end])))
+            del buffer[:end]
+        return frames
+
+    @staticmethod
+    def recv_exactly(sock, count):
+        # recv may return fewer bytes than asked for, so keep reading
+        # until we have them all. Returns None if the connection
+        # closes first.
+        chunks = bytearray()
+        while len(chunks) < count:
+            chunk = sock.recv(count - len(chunks))
+            if len(chunk) == 0:
+                return None
+            chunks += chunk
+        return bytes(chunks)
+
+    @staticmethod
+    def recv_frame(sock):
+        # Blocking read of one whole frame. Returns (version, type,
+        # payload), or None if the connection was closed.
+        header = Protocol.recv_exactly(sock, Protocol.HEADER_SIZE)
+        if header is None:
+            return None
+        version, msg_type, length = Protocol.HEADER.unpack(header)
+        if version not in Protocol.SUPPORTED_VERSIONS:
+            raise ProtocolError("{} {}".format(Protocol.UNSUPPORTED_VERSION.decode('ascii'), version))
+        if length > Protocol.MAX_PAYLOAD_SIZE:
+            raise ProtocolError("Frame too large ({} bytes)".format(length))
+        payload = Protocol.recv_exactly(sock, length)
+        if payload is None:
+            return None
+        return version, msg_type, payload
+
+########################################################################
+# Server metrics and logging classes
+########################################################################
+
+# Server log messages go through this logger rather than print, so
+# they can be levelled, rate limited and switched off.
+logger = logging.getLogger("grade_server")
+
+
+class RateLimitFilter(logging.Filter):
+
+    # Lets through at most RATE records per second for each message
+    # template. Suppressed records are counted and the count is added
+    # to the next record of that template that gets through.
+
+    RATE = 20.0 # records per second, per message template.
+
+    def __init__(self, rate=RATE):
+        super().__init__()
+        self.rate = rate
+        # Per template: [tokens, last refill time, suppressed count]
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(record.msg)
+            if bucket is None:
+                bucket = self.buckets[record.msg] = [self.rate, now, 0]
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.msg = "{} ({} similar messages suppressed)".format(record.msg, suppressed)
+        return True
+
+
+def configure_logging(level="info"):
+    # level is one of LOG_LEVELS. "off" disables server logging.
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(RateLimitFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.handlers[:] = [handler]
+    logger.propagate = False
+    if level == "off":
+        logger.setLevel(logging.CRITICAL + 1)
+    else:
+        logger.setLevel(getattr(logging, level.upper()))
+
+LOG_LEVELS = ("debug", "info", "warning", "error", "off")
+
+
+class LatencyHistogram:
+
+    # Fixed log-scale latency histogram. Bucket i counts samples of
+    # at most 2**i microseconds; the last bucket is everything
+    # slower. Recording a sample is O(1) and takes no memory.
+
+    BUCKETS = 24 # 1 us ... ~8 s
+
+    def __init__(self):
+        self.counts = [0] * (LatencyHistogram.BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        microseconds = int(seconds * 1000000)
+        index = min(LatencyHistogram.BUCKETS, max(0, microseconds - 1).bit_length())
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, p):
+        # Upper bound (in seconds) of the bucket holding the p-th
+        # percentile sample.
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return (2 ** index) / 1000000
+        return (2 ** LatencyHistogram.BUCKETS) / 1000000
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 4) if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+        }
+
+
+class ServerMetrics:
+
+    # Request counters and latency histograms, per command code and
+    # per processing stage. Shared by all connections of a server
+    # process (prefork workers each keep their own).
+
+    STAGES = ("recv", "lookup", "aggregate", "encrypt", "send")
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.errors = {}
+        self.latency = {}
+        self.stages = {stage: LatencyHistogram() for stage in ServerMetrics.STAGES}
+        self.connections = 0
+        # Compression per kind ("frames" for reply frames, "export"
+        # for export and replica snapshot chunks): [compressed,
+        # skipped, bytes before, bytes sent, CPU seconds].
+        self.compression = {}
+
+    def record_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def record_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage].record(seconds)
+
+    def record_request(self, command, stage_times, seconds):
+        with self.lock:
+            self.requests[command] = self.requests.get(command, 0) + 1
+            histogram = self.latency.get(command)
+            if histogram is None:
+                histogram = self.latency[command] = LatencyHistogram()
+            histogram.record(seconds)
+            for stage, stage_seconds in stage_times.items():
+                self.stages[stage].record(stage_seconds)
+
+    def record_error(self, command):
+        with self.lock:
+            self.errors[command] = self.errors.get(command, 0) + 1
+
+    def record_compression(self, kind, size, sent_size=None, seconds=0.0):
+        # sent_size is None for a payload skipped as too small to be
+        # worth compressing.
+        with self.lock:
+            counts = self.compression.get(kind)
+            if counts is None:
+                counts = self.compression[kind] = [0, 0, 0, 0, 0.0]
+            if sent_size is None:
+                counts[1] += 1
+                return
+            counts[0] += 1
+            counts[2] += size
+            counts[3] += sent_size
+            counts[4] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            commands = sorted(set(self.requests) | set(self.errors))
+            return {
+                "pid": os.getpid(),
+                "uptime_s": round(time.time() - self.started, 3),
+                "connections": self.connections,
+                "commands": {
+                    command: {
+                        "requests": self.requests.get(command, 0),
+                        "errors": self.errors.get(command, 0),
+                        "latency": (self.latency[command].summary()
+                                    if command in self.latency else LatencyHistogram().summary()),
+                    } for command in commands
+                },
+                "stages": {stage: histogram.summary() for stage, histogram in self.stages.items()},
+                "compression": {
+                    kind: {
+                        "compressed": compressed,
+                        "skipped": skipped,
+                        "bytes_in": size,
+                        "bytes_out": sent_size,
+                        "ratio": round(size / sent_size, 3) if sent_size else None,
+                        "cpu_ms": round(seconds * 1000, 3),
+                        "cpu_us_per_kb": round(seconds * 1e6 / (size / 1024), 3) if size else None,
+                    } for kind, (compressed, skipped, size, sent_size, seconds) in self.compression.items()
+                },
+            }
+
+########################################################################
+# Admission control classes
+########################################################################
+
+class TokenBucket:
+
+    # Allows rate requests per second on average, in bursts of up to
+    # burst requests.
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now, cost=1):
+        # 0 if cost tokens were taken, otherwise how many seconds
+        # until there will be enough.
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (min(cost, self.burst) - self.tokens) / self.rate
+
+
+class RateLimiter:
+
+    # One TokenBucket per key (a source address or a student ID). The
+    # least recently used buckets are dropped past MAX_KEYS; a bucket
+    # that was dropped comes back full, which only ever errs on the
+    # side of letting a request through.
+
+    MAX_KEYS = 100000
+
+    def __init__(self, rate, burst, max_keys=MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, cost=1):
+        # 0 if allowed, otherwise the seconds to wait. A rate of 0
+        # disables the limit.
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket.take(now, cost)
+
+
+class AdmissionControl:
+
+    # Decides which requests a server takes on when it is overloaded,
+    # so one heavy client cannot starve the others and a refused
+    # client finds out at once instead of waiting on a hung
+    # connection. There are four limits:
+    #
+    #   - requests per second from one source address (a batch counts
+    #     each of its items),
+    #   - requests per second for one student ID in one course from
+    #     one source address (requests are not authenticated, so a
+    #     limit shared by all addresses would let any client lock a
+    #     student out),
+    #   - requests being handled at once by this process,
+    #   - connections accepted but still waiting for a worker
+    #     ("thread" mode).
+    #
+    # A shed request gets a BUSY reply straight away; nothing is
+    # queued. Rates of 0 disable the corresponding limit.
+    #
+    # Trusted peers (--trusted-peers) are exempt from the address and
+    # per-ID limits: a Router or a pooled front end (see ClientPool)
+    # sends the traffic of all its own clients from one address. The
+    # Router applies the per-ID limit itself, by client address.
+
+    ADDRESS_RATE = 500.0 # requests/second
+    ADDRESS_BURST = 1000
+    ID_RATE = 10.0 # requests/second
+    ID_BURST = 20
+    MAX_IN_FLIGHT = 64
+    # Suggested retry delay (in seconds) when the in-flight cap is hit.
+    IN_FLIGHT_RETRY_AFTER = 0.01
+    MAX_PENDING_CONNECTIONS = 32
+    # Exports streaming at once. Further ones get BUSY.
+    MAX_EXPORTS = 2
+    EXPORT_RETRY_AFTER = 1.0
+
+    REASONS = ("address", "id", "in_flight", "connections", "exports")
+
+    def __init__(self, trusted_peers=()):
+        self.trusted_peers = frozenset(trusted_peers)
+        self.addresses = RateLimiter(AdmissionControl.ADDRESS_RATE, AdmissionControl.ADDRESS_BURST)
+        self.ids = RateLimiter(AdmissionControl.ID_RATE, AdmissionControl.ID_BURST)
+        self.in_flight = 0
+        self.pending_connections = 0
+        self.exports = 0
+        self.shed = {reason: 0 for reason in AdmissionControl.REASONS}
+        self.lock = threading.Lock()
+
+    def admit(self, address, cost=1):
+        # 0 if admitted, in which case the caller must call release()
+        # when done; otherwise the seconds the client should wait.
+        if address not in self.trusted_peers:
+            retry_after = self.addresses.take(address, cost)
+            if retry_after:
+                return self.refuse("address", retry_after)
+        with self.lock:
+            if self.in_flight >= AdmissionControl.MAX_IN_FLIGHT:
+                self.shed["in_flight"] += 1
+                return AdmissionControl.IN_FLIGHT_RETRY_AFTER
+            self.in_flight += 1
+        return 0.0
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def admit_id(self, address, key):
+        # 0 if one more request for this (course, ID) is allowed from
+        # this address.
+        if address in self.trusted_peers:
+            return 0.0
+        retry_after = self.ids.take((address,) + key)
+        if retry_after:
+            return self.refuse("id", retry_after)
+        return 0.0
+
+    def enqueue_connection(self):
+        # False if too many connections are already waiting.
+        with self.lock:
+            if self.pending_connections >= AdmissionControl.MAX_PENDING_CONNECTIONS:
+                self.shed["connections"] += 1
+                return False
+            self.pending_connections += 1
+            return True
+
+    def dequeue_connection(self):
+        with self.lock:
+            self.pending_connections -= 1
+
+    def start_export(self):
+        with self.lock:
+            if self.exports >= AdmissionControl.MAX_EXPORTS:
+                self.shed["exports"] += 1
+                return False
+            self.exports += 1
+            return True
+
+    def end_export(self):
+        with self.lock:
+            self.exports -= 1
+
+    def refuse(self, reason, retry_after):
+        with self.lock:
+            self.shed[reason] += 1
+        return retry_after
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": self.in_flight,
+                    "pending_connections": self.pending_connections,
+                    "exports": self.exports,
+                    "shed": dict(self.shed)}
+
+########################################################################
+# Replication classes
+########################################################################
+
+class ReplicationPublisher:
+
+    # Primary side of replication. Listens on its own port, so it
+    # works the same in every concurrency mode, and streams the
+    # default course to each subscribed replica: a full snapshot, then
+    # the updates the grade store applies (see GradeStore.listeners),
+    # in order. Updates only set marks, so an update that lands while
+    # a snapshot is being sent and is then sent again as a delta does
+    # no harm. A replica that falls MAX_QUEUED deltas behind gets a
+    # fresh snapshot instead.
+
+    HEARTBEAT_INTERVAL = 1.0 # seconds
+    MAX_QUEUED = 1000 # deltas, per replica
+    MAX_REPLICAS = 16
+
+    def __init__(self, server, grade_store, port):
+        self.server = server
+        self.grade_store = grade_store
+        self.port = port
+        self.fernet = server.instructor_fernet
+        # Subscribed replicas: address -> Subscription.
+        self.replicas = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((Server.HOSTNAME, self.port))
+        self.socket.listen(ReplicationPublisher.MAX_REPLICAS)
+        threading.Thread(target=self.accept_forever, daemon=True).start()
+        logger.info("Replication on port %d ...", self.port)
+        return self
+
+    def accept_forever(self):
+        while True:
+            connection, address = self.socket.accept()
+            threading.Thread(target=self.serve, args=(connection, address), daemon=True).start()
+
+    def serve(self, connection, address):
+        name = "{}:{}".format(*address)
+        subscription = None
+        try:
+            connection.settimeout(Server.CONNECTION_TIMEOUT)
+            frame = Protocol.recv_frame(connection)
+            if frame is None or frame[1] != Protocol.SUBSCRIBE_REQUEST:
+                return
+            try:
+                self.fernet.decrypt(frame[2], ttl=Protocol.EXPORT_TOKEN_TTL)
+            except InvalidToken:
+                logger.warning("Replica %s not authorized.", name)
+                Server.send_buffers(connection, [Protocol.pack(Protocol.ERROR, b"Not authorized")])
+                return
+            with self.lock:
+                if len(self.replicas) >= ReplicationPublisher.MAX_REPLICAS:
+                    Server.send_buffers(connection, [Protocol.pack(Protocol.ERROR, b"Too many replicas")])
+                    return
+                subscription = self.replicas[name] = Subscription()
+            logger.info("Replica %s subscribed.", name)
+            self.stream(connection, subscription)
+        except (OSError, ProtocolError) as msg:
+            logger.info("Replica %s: %s", name, msg)
+        finally:
+            if subscription is not None:
+                with self.grade_store.lock:
+                    if subscription.listener in self.grade_store.listeners:
+                        self.grade_store.listeners.remove(subscription.listener)
+                with self.lock:
+                    self.replicas.pop(name, None)
+                logger.info("Replica %s unsubscribed.", name)
+            connection.close()
+
+    def stream(self, connection, subscription):
+        # Send a snapshot, then deltas and heartbeats, until the
+        # connection fails.
+        resync = True
+        while True:
+            if resync:
+                with self.grade_store.lock:
+                    # Taken together with the (re)registration, so no
+                    # update falls between the snapshot and the deltas.
+                    snapshot, version = subscription.restart(self.grade_store)
+                for buffers in self.server.snapshot_frames(snapshot, Protocol.VERSION):
+                    Server.send_buffers(connection, buffers)
+                subscription.snapshots += 1
+                self.send_delta(connection, subscription, version, [])
+                resync = False
+            try:
+                updates, version = subscription.queue.get(timeout=ReplicationPublisher.HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                self.send_delta(connection, subscription, subscription.version, [])
+                continue
+            resync = updates is None
+            if not resync:
+                self.send_delta(connection, subscription, version, updates)
+
+    def send_delta(self, connection, subscription, version, updates):
+        delta = {"version": version, "head": self.grade_store.version, "updates": updates}
+        token = self.fernet.encrypt(json.dumps(delta, separators=(",", ":")).encode('utf-8'))
+        Server.send_buffers(connection, [Protocol.HEADER.pack(Protocol.VERSION, Protocol.REPLICA_DELTA,
+                                                              len(token)), token])
+        subscription.version = version
+        subscription.deltas += len(updates) > 0
+
+    def stats(self):
+        with self.lock:
+            return {"port": self.port,
+                    "replicas": {name: subscription.stats(self.grade_store.version)
+                                 for name, subscription in self.replicas.items()}}
+
+
+class Subscription:
+
+    # One replica's queue of (updates, version) deltas, filled by its
+    # grade store listener. None for updates asks for a fresh
+    # snapshot.
+
+    def __init__(self):
+        self.queue = queue.Queue(ReplicationPublisher.MAX_QUEUED)
+        self.version = 0 # last version sent
+        self.snapshots = 0
+        self.deltas = 0
+
+    def listener(self, updates, version):
+        try:
+            self.queue.put_nowait((updates, version))
+        except queue.Full:
+            # Too far behind: drop the backlog for a new snapshot.
+            self.clear()
+            self.queue.put_nowait((None, version))
+
+    def clear(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def restart(self, grade_store):
+        # Called with the grade store lock held.
+        self.clear()
+        if self.listener not in grade_store.listeners:
+            grade_store.listeners.append(self.listener)
+        return grade_store.snapshot, grade_store.version
+
+    def stats(self, head):
+        return {"version": self.version, "behind": head - self.version,
+                "queued": self.queue.qsize(), "snapshots": self.snapshots, "deltas": self.deltas}
+
+
+class ReplicaSubscriber:
+
+    # Replica side of replication. Keeps a local copy of the primary's
+    # default course in file_path: each snapshot the primary sends is
+    # written over the file (and its journal emptied), and each delta
+    # goes through GradeStore.set_marks, so it is journaled and reaches
+    # prefork siblings the same way TA updates do on a primary. If the
+    # connection drops the replica keeps serving what it has and
+    # resubscribes, which starts again from a snapshot.
+    #
+    # Lag is reported two ways: how many versions the primary was
+    # ahead in the last delta (primary-side backlog), and how long ago
+    # that delta arrived, which heartbeats keep near
+    # HEARTBEAT_INTERVAL while the primary is reachable.
+
+    TIMEOUT = 5 * ReplicationPublisher.HEARTBEAT_INTERVAL
+
+    def __init__(self, primary, fernet, file_path):
+        self.primary = primary
+        self.fernet = fernet
+        self.file_path = file_path
+        self.grade_store = None
+        self.socket = None
+        self.connected = False
+        self.version = 0 # primary version applied
+        self.head = 0 # primary version as of the last delta
+        self.received = None # time.monotonic() of the last delta
+        self.snapshots = 0
+        self.deltas = 0
+
+    def sync(self):
+        # Block until the first snapshot is in file_path.
+        attempt = 0
+        while not self.subscribe():
+            time.sleep(ClientPool.backoff(attempt))
+            attempt += 1
+
+    def start(self, grade_store):
+        self.grade_store = grade_store
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        attempt = 0
+        while True:
+            try:
+                while True:
+                    self.receive()
+                    attempt = 0
+            except (OSError, ProtocolError, ClientError, KeyError, ValueError) as msg:
+                logger.warning("Replication from %s:%d failed: %s", *self.primary, msg)
+            self.disconnect()
+            while not self.subscribe():
+                time.sleep(ClientPool.backoff(attempt))
+                attempt += 1
+
+    def subscribe(self):
+        # Connect, subscribe and install the first snapshot. Returns
+        # False (after logging) if that fails.
+        try:
+            self.socket = socket.create_connection(self.primary, ReplicaSubscriber.TIMEOUT)
+            self.socket.sendall(Protocol.pack(Protocol.SUBSCRIBE_REQUEST, self.fernet.encrypt(b"")))
+            self.connected = True
+            snapshots = self.snapshots
+            while self.receive() != Protocol.REPLICA_DELTA or self.snapshots == snapshots:
+                pass
+        except (OSError, ProtocolError, ClientError, KeyError, ValueError) as msg:
+            logger.warning("Subscribing to %s:%d failed: %s", *self.primary, msg)
+            self.disconnect()
+            return False
+        logger.info("Replicating %s:%d at version %d.", *self.primary, self.version)
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def receive(self):
+        # Handle one message: a whole snapshot or one delta. Returns
+        # its type.
+        frame = Protocol.recv_frame(self.socket)
+        if frame is None:
+            raise ClientError("Primary closed the connection")
+        version, msg_type, payload = frame
+        match msg_type:
+            case Protocol.EXPORT_CHUNK:
+                self.install(frame)
+                return Protocol.EXPORT_END
+            case Protocol.REPLICA_DELTA:
+                delta = json.loads(self.fernet.decrypt(payload))
+                if delta["updates"] and self.grade_store is not None:
+                    self.grade_store.set_marks(delta["updates"])
+                    self.deltas += 1
+                self.version, self.head = delta["version"], delta["head"]
+                self.received = time.monotonic()
+                return msg_type
+            case _:
+                raise ClientError(payload.decode('ascii', 'replace'))
+
+    def install(self, frame):
+        # Write a snapshot (its first chunk already read) over the
+        # local file, then reload it.
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, 'wb') as grades_file:
+            while frame[1] == Protocol.EXPORT_CHUNK:
+                grades_file.write(zlib.decompress(self.fernet.decrypt(frame[2])))
+                frame = Protocol.recv_frame(self.socket)
+                if frame is None:
+                    raise ClientError("Primary closed the connection")
+            if frame[1] != Protocol.EXPORT_END:
+                raise ProtocolError("Snapshot not ended")
+            grades_file.flush()
+            os.fsync(grades_file.fileno())
+        journal = GradeJournal(self.grade_store, self.file_path + GradeJournal.SUFFIX)
+        if self.grade_store is None:
+            with journal.file_lock():
+                os.replace(temp_path, self.file_path)
+                journal.reset()
+        else:
+            with self.grade_store.lock, journal.file_lock():
+                os.replace(temp_path, self.file_path)
+                journal.reset()
+                self.grade_store.load()
+        self.snapshots += 1
+        logger.info("Installed a snapshot of %d rows from %s:%d.",
+                    Protocol.COUNT.unpack(frame[2])[0], *self.primary)
+
+    def stats(self):
+        return {"primary": "{}:{}".format(*self.primary),
+                "connected": self.connected,
+                "version": self.version,
+                "behind": self.head - self.version,
+                "lag": None if self.received is None else round(time.monotonic() - self.received, 3),
+                "snapshots": self.snapshots,
+                "deltas": self.deltas}
+
+########################################################################
+# Asyncio server classes
+########################################################################
+
+class TransportConnection:
+
+    # Stands in for a client socket where Server code expects one
+    # (peer_address, is_local, the legacy reply path and as the key
+    # of its sessions) in the "asyncio" mode. sendall may be called
+    # from executor threads.
+
+    __slots__ = ("transport", "loop", "__weakref__")
+
+    def __init__(self, transport, loop):
+        self.transport = transport
+        self.loop = loop
+
+    def getpeername(self):
+        peer = self.transport.get_extra_info("peername")
+        if peer is None:
+            raise OSError("Not connected")
+        return peer
+
+    def sendall(self, data):
+        self.loop.call_soon_threadsafe(self.transport.write, bytes(data))
+
+
+class ServerConnection(asyncio.Protocol):
+
+    # One client connection in the "asyncio" mode. Frames are answered
+    # in order as they arrive. Cheap ones are answered on the event
+    # loop. The rest (see Server.offload) go to the server's executor
+    # while reading is paused, so a connection buffers at most one
+    # partial frame plus the replies the transport will hold
+    # (ASYNCIO_WRITE_BUFFER) no matter how much a client pipelines.
+
+    __slots__ = ("server", "transport", "connection", "buffer", "frames", "framed",
+                 "frame_start", "deadline", "busy", "writing_paused", "drained")
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.connection = None
+        self.buffer = bytearray()
+        self.frames = []
+        self.framed = None
+        self.frame_start = None
+        self.deadline = time.monotonic() + Server.CONNECTION_TIMEOUT
+        self.busy = False
+        self.writing_paused = False
+        self.drained = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connection = TransportConnection(transport, asyncio.get_running_loop())
+        transport.set_write_buffer_limits(high=Server.ASYNCIO_WRITE_BUFFER)
+        self.server.connections.add(self)
+        self.server.metrics.record_connection()
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        self.wake()
+
+    def pause_writing(self):
+        self.writing_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.wake()
+        if not self.busy:
+            self.transport.resume_reading()
+
+    def wake(self):
+        if self.drained is not None and not self.drained.done():
+            self.drained.set_result(None)
+
+    async def drain(self):
+        if self.writing_paused and not self.transport.is_closing():
+            self.drained = asyncio.get_running_loop().create_future()
+            await self.drained
+
+    def data_received(self, data):
+        if self.framed is None:
+            self.framed = Protocol.is_framed(data)
+            if not self.framed:
+                # Legacy client: one request per connection.
+                self.start(self.legacy(data))
+                return
+        if not self.buffer:
+            self.frame_start = time.perf_counter()
+        self.buffer += data
+        try:
+            self.frames += Protocol.split_frames(self.buffer)
+        except ProtocolError as msg:
+            logger.warning("%s", msg)
+            self.transport.write(Protocol.pack(Protocol.ERROR, str(msg).encode('ascii'),
+                                               Protocol.BASE_VERSION))
+            self.transport.close()
+            return
+        self.process()
+
+    def process(self):
+        # Answer queued frames until one has to go to the executor.
+        if self.frames and self.frame_start is not None:
+            self.server.metrics.record_stage("recv", time.perf_counter() - self.frame_start)
+            self.frame_start = time.perf_counter() if self.buffer else None
+        replies = []
+        while self.frames and not self.busy:
+            frame = self.frames.pop(0)
+            if self.server.offload(frame[1], frame[2]):
+                self.start(self.answer(frame))
+            else:
+                replies.append(self.server.admit_frame(self.connection, *frame))
+        if replies:
+            start = time.perf_counter()
+            self.transport.write(b"".join(replies))
+            self.server.metrics.record_stage("send", time.perf_counter() - start)
+        # A partially received frame must complete quickly, an idle
+        # connection may wait for its next request, unless the server
+        # is draining.
+        self.deadline = time.monotonic() + (Server.CONNECTION_TIMEOUT if self.buffer or self.busy
+                                            else Server.KEEPALIVE_TIMEOUT)
+        if self.server.draining and self.idle():
+            self.transport.close()
+
+    def start(self, job):
+        self.busy = True
+        self.transport.pause_reading()
+        asyncio.get_running_loop().create_task(self.run(job))
+
+    async def run(self, job):
+        try:
+            await job
+        except Exception as msg:
+            logger.warning("%s", msg)
+            self.transport.abort()
+            return
+        finally:
+            self.busy = False
+        if self.transport.is_closing():
+            return
+        if not self.writing_paused:
+            self.transport.resume_reading()
+        self.process()
+
+    async def answer(self, frame):
+        loop = asyncio.get_running_loop()
+        reply = await loop.run_in_executor(self.server.executor, self.server.admit_frame,
+                                           self.connection, *frame)
+        if isinstance(reply, bytes):
+            self.transport.write(reply)
+            return
+        # A stream (an export): each piece is made on the executor
+        # and written once the client has read the last ones.
+        try:
+            while not self.transport.is_closing():
+                buffers = await loop.run_in_executor(self.server.executor, next, reply, None)
+                if buffers is None:
+                    break
+                self.transport.writelines(buffers)
+                await self.drain()
+        finally:
+            reply.close()
+
+    async def legacy(self, data):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.server.executor, self.server.reply_legacy,
+                                   self.connection, data)
+        # After the reply, which sendall queued ahead of this.
+        self.transport.close()
+
+    def idle(self):
+        return not self.busy and not self.buffer and not self.frames
+
+class SelectConnection:
+
+    # One client connection in the "select" mode (see
+    # Server.serve_select). stream is [reply buffers iterator, unsent
+    # buffers] while replies are waiting to be written; busy while a
+    # frame of the connection is being answered on the executor.
+
+    __slots__ = ("socket", "buffer", "frames", "framed", "frame_start", "deadline",
+                 "stream", "busy")
+
+    def __init__(self, connection):
+        self.socket = connection
+        self.buffer = bytearray()
+        self.frames = []
+        # None until the first bytes show which protocol the client
+        # speaks.
+        self.framed = None
+        self.frame_start = None
+        self.deadline = time.monotonic() + Server.CONNECTION_TIMEOUT
+        self.stream = None
+        self.busy = False
+
+    def idle(self):
+        return not self.busy and not self.buffer and not self.frames and self.stream is None
 
 ########################################################################
 # Echo Server class
@@ -53,199 +2693,1788 @@ class Server:
     # address/hostname and port.
     SOCKET_ADDRESS = (HOSTNAME, PORT)
 
-    def __init__(self):
-        file_path = 'course_grades_2024.csv'
-        self.print_rows(file_path)
-        self.create_listen_socket()
-        self.process_connections_forever()
+    # Server concurrency modes. "inline" handles one connection at a
+    # time on the accept loop, "thread" hands each connection to a
+    # bounded thread pool, "select" multiplexes all connections in a
+    # single selectors event loop, "prefork" forks worker processes
+    # that all accept on the shared listen socket and "asyncio" serves
+    # every connection from one asyncio event loop (uvloop if it is
+    # installed), with slow requests run on a thread pool.
+    CONCURRENCY_MODES = ("inline", "thread", "select", "prefork", "asyncio")
+    CONCURRENCY_MODE = "thread"
+
+    THREAD_POOL_SIZE = 32 # Used for the "thread" mode.
+    PREFORK_WORKERS = 4 # Used for the "prefork" mode.
+    # In the "prefork" mode replication runs in the parent, which
+    # leaves its stats for the workers in <file><this suffix>.
+    REPLICATION_STATUS_SUFFIX = ".replication.json"
+    # Used for the "asyncio" mode: the listen backlog, and how many
+    # reply bytes a connection may have unsent before it is no longer
+    # read from.
+    ASYNCIO_BACKLOG = 1024
+    ASYNCIO_WRITE_BUFFER = 256 * 1024
+
+    # Per-connection timeout (in seconds). A client that connects and
+    # never sends is dropped after this long instead of holding up a
+    # worker.
+    CONNECTION_TIMEOUT = 5.0
+
+    # How long (in seconds) a persistent connection may sit idle
+    # between requests before the server closes it. After each reply,
+    # and every IDLE_POLL_INTERVAL seconds while idle, a connection
+    # checks whether other connections are waiting for a worker, and
+    # if so closes early to make way for them. (Clients reconnect on
+    # their next request.)
+    KEEPALIVE_TIMEOUT = 60.0
+    IDLE_POLL_INTERVAL = 0.5
+
+    # How long (in seconds) a draining worker (see Supervisor) lets
+    # its connections finish before exiting anyway.
+    DRAIN_TIMEOUT = 30.0
+
+    # How often (in seconds) the grades file is checked for changes.
+    # Set to 0 to disable hot reload.
+    RELOAD_INTERVAL = GradeFileWatcher.POLL_INTERVAL
+
+    # Grades file served by default.
+    FILE_PATH = 'course_grades_2024.csv'
+
+    # Rows per EXPORT_CHUNK frame, and the zlib level they are
+    # compressed with (1 is fastest).
+    EXPORT_CHUNK_ROWS = 2000
+    EXPORT_COMPRESSION_LEVEL = 1
+
+    # Reply payloads at least this many bytes are compressed for
+    # clients that accept it (see Protocol), at this zlib level.
+    COMPRESSION_THRESHOLD = 1024
+    COMPRESSION_LEVEL = 1
+
+    # Command codes, for the per-command metrics. Anything else is
+    # counted as "invalid".
+    COMMANDS = ("GMA", "GL1A", "GL2A", "GL3A", "GL4A", "GEA", "GG",
+                "GMED", "GPCT", "GHIST", "GRANK")
+
+    # Statistics commands take ":" separated arguments after the
+    # command name. <col> is a GradeSnapshot.COLUMN_CODES code.
+    #
+    #   GMED:<col>              median of a column
+    #   GPCT:<p>:<col>          p-th percentile of a column
+    #   GHIST:<col>[:<width>]   histogram buckets of a column
+    #   GRANK:<col>             the requesting student's rank
+    STATISTICS_COMMANDS = ("GMED", "GPCT", "GHIST", "GRANK")
+    MAX_HISTOGRAM_BUCKETS = 1000
+    MAX_HISTOGRAM_WIDTH = 1000000
+
+    # Sessions (see Protocol) one connection may open.
+    MAX_SESSIONS = 64
+
+    # A request may name its course with a "<course>/" prefix, e.g.
+    # "4dn4_2024/1803933GG". Without one it goes to the default
+    # course, the file the server was started with. Other courses are
+    # loaded from courses_dir on first use (see CourseCatalog).
+    COURSE_SEPARATOR = "/"
+
+    def __init__(self, mode=CONCURRENCY_MODE, file_path=FILE_PATH, port=PORT,
+                 courses_dir=None, memory_budget=CourseCatalog.MEMORY_BUDGET,
+                 shard_map=None, shard_index=0, instructor_key=None,
+                 primary=None, replication_port=None,
+                 compression_threshold=COMPRESSION_THRESHOLD,
+                 listen_fd=None, ready_fd=None, trusted_peers=()):
+        if mode not in Server.CONCURRENCY_MODES:
+            logger.error("Unknown concurrency mode: %s", mode)
+            sys.exit(1)
+        if (primary is not None or replication_port is not None) and instructor_key is None:
+            logger.error("Replication needs the instructor key.")
+            sys.exit(1)
+        self.mode = mode
+        self.port = port
+        self.compression_threshold = compression_threshold
+        # Under a supervisor, the listen socket it hands down and the
+        # pipe to say this worker is ready on (see Supervisor).
+        self.listen_fd = listen_fd
+        self.ready_fd = ready_fd
+        self.draining = False
+        self.wakeup = None
+        # A shard server only serves the IDs shard_map gives to
+        # shard_index; a Router in front sends it just those.
+        owns = None if shard_map is None else shard_map.owner(shard_index)
+        # Bulk export is refused unless an instructor key is given.
+        self.instructor_fernet = None if instructor_key is None else Fernet(instructor_key)
+        # A replica serves a copy of its primary's default course,
+        # kept in file_path (see ReplicaSubscriber); a primary with a
+        # replication port streams it to replicas.
+        self.replication = None
+        self.subscriber = None
+        if primary is not None:
+            if os.path.splitext(file_path)[1].lower() != ".csv":
+                logger.error("A replica keeps its copy in a .csv file.")
+                sys.exit(1)
+            self.subscriber = ReplicaSubscriber(primary, self.instructor_fernet, file_path)
+            self.subscriber.sync()
+        journal_suffix = GradeJournal.SUFFIX
+        if shard_map is not None:
+            logger.info("Serving shard %d of %d.", shard_index, shard_map.count)
+            # Shards of one file each keep their own journal.
+            journal_suffix = ".shard{}{}".format(shard_index, GradeJournal.SUFFIX)
+        self.catalog = CourseCatalog(file_path, courses_dir, memory_budget, owns, journal_suffix)
+        self.grade_store = self.catalog.default
+        if replication_port is not None:
+            self.replication = ReplicationPublisher(self, self.grade_store, replication_port)
+        self.fernet_cache = FernetCache()
+        self.response_cache = ResponseCache()
+        # Each connection's open sessions, in session ID order. An
+        # entry goes when its connection is closed and dropped.
+        self.sessions = weakref.WeakKeyDictionary()
+        self.sessions_lock = threading.Lock()
+        self.admission = AdmissionControl(trusted_peers)
+        self.metrics = ServerMetrics()
+        self.print_rows()
+        self.create_listen_socket()
+        self.process_connections_forever()
+
+    def create_listen_socket(self):
+        if self.listen_fd is not None:
+            # Already bound and listening, shared with the other
+            # workers.
+            self.socket = socket.socket(fileno=self.listen_fd)
+            logger.info("Accepting on the supervisor's socket, port %d ...", self.port)
+            return
+        try:
+            # Create an IPv4 TCP socket.
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+            # Set socket layer socket options. This one allows us to
+            # reuse the socket address without waiting for any timeouts.
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            # Bind socket to socket address, i.e., IP address and port.
+            self.socket.bind((Server.HOSTNAME, self.port))
+
+            # Set socket to listen state.
+            self.socket.listen(Server.MAX_CONNECTION_BACKLOG)
+            logger.info("Listening on port %d ...", self.port)
+        except Exception as msg:
+            logger.error("%s", msg)
+            sys.exit(1)
+
+    def start_file_watcher(self):
+        # Threads do not survive fork, so prefork workers call this
+        # themselves after forking.
+        if Server.RELOAD_INTERVAL > 0:
+            self.catalog.start_watchers(Server.RELOAD_INTERVAL)
+
+    def start_replication(self):
+        # Threads, so run in the process that keeps them (the parent,
+        # in prefork mode).
+        if self.replication is not None:
+            self.replication.start()
+        if self.subscriber is not None:
+            self.subscriber.start(self.grade_store)
+
+    def process_connections_forever(self):
+        logger.info("Concurrency mode: %s", self.mode)
+        if self.mode != "prefork":
+            self.start_file_watcher()
+            self.start_replication()
+        if self.listen_fd is not None:
+            self.start_worker()
+        try:
+            match self.mode:
+                case "inline":
+                    self.serve_inline()
+                case "thread":
+                    self.serve_thread_pool()
+                case "select":
+                    self.serve_select()
+                case "prefork":
+                    self.serve_prefork()
+                case "asyncio":
+                    self.serve_asyncio()
+        except Exception as msg:
+            logger.error("%s", msg)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            # If something bad happens, make sure that we close the
+            # socket.
+            self.socket.close()
+            if self.draining:
+                logger.info("Drained. Exiting ... ")
+            sys.exit(0 if self.draining else 1)
+
+    def start_worker(self):
+        # Set up a supervisor's worker: SIGTERM drains it, Ctrl-C is
+        # left to the supervisor, and the supervisor is told it is
+        # ready once the grades are loaded.
+        self.wakeup = os.pipe()
+        # The workers race to accept, so a loser must not block.
+        self.socket.setblocking(False)
+        signal.signal(signal.SIGTERM, self.drain)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.ready_fd is not None:
+            try:
+                os.write(self.ready_fd, b"R")
+            except OSError:
+                pass
+            os.close(self.ready_fd)
+
+    def drain(self, signum=None, frame=None):
+        # Stop accepting and exit once the open connections have gone
+        # idle and been closed, or after DRAIN_TIMEOUT. Clients
+        # reconnect (to another worker) on their next request.
+        if not self.draining:
+            logger.info("Draining connections ... ")
+            self.drain_deadline = time.monotonic() + Server.DRAIN_TIMEOUT
+            self.draining = True
+            os.write(self.wakeup[1], b"D")
+
+    def accept(self):
+        # Wait for and accept a connection. Under a supervisor, None
+        # once the worker is draining.
+        if self.wakeup is None:
+            return self.socket.accept()
+        while not self.draining:
+            readable, _, _ = select.select([self.socket, self.wakeup[0]], [], [])
+            if self.socket in readable:
+                try:
+                    return self.socket.accept()
+                except BlockingIOError:
+                    # Another worker got it first.
+                    pass
+        return None
+
+    def serve_inline(self):
+        while True:
+            # Block while waiting for accepting incoming TCP
+            # connections. When one is accepted, pass the new
+            # (cloned) socket info to the connection handler
+            # function. Accept returns a tuple consisting of a
+            # connection reference and the remote socket address.
+            client = self.accept()
+            if client is None:
+                return
+            self.connection_handler(client)
+
+    def serve_thread_pool(self):
+        # The pool bounds the number of connections served at once.
+        # Any more wait in the executor queue rather than on the
+        # accept loop, so a stalled client only ties up one worker
+        # for at most CONNECTION_TIMEOUT seconds. Past
+        # MAX_PENDING_CONNECTIONS waiting, new connections are refused
+        # with a BUSY frame.
+        with ThreadPoolExecutor(max_workers=Server.THREAD_POOL_SIZE) as pool:
+            while True:
+                client = self.accept()
+                if client is None:
+                    # Draining: the pool is waited on for the open
+                    # connections, which close as they go idle.
+                    return
+                if self.admission.enqueue_connection():
+                    pool.submit(self.start_connection, client)
+                else:
+                    self.refuse_connection(client)
+
+    def start_connection(self, client):
+        self.admission.dequeue_connection()
+        self.connection_handler(client)
+
+    def refuse_connection(self, client):
+        connection, address_port = client
+        logger.warning("Busy. Refusing connection from %s.", address_port)
+        try:
+            connection.setblocking(False)
+            connection.send(Protocol.pack(Protocol.BUSY,
+                                          Protocol.pack_busy(Server.IDLE_POLL_INTERVAL),
+                                          Protocol.BASE_VERSION))
+        except OSError:
+            pass
+        connection.close()
+
+    def others_waiting(self):
+        # Whether connections are waiting for this process to take
+        # them on: queued for the thread pool, or in the listen
+        # backlog for the single-connection modes.
+        if self.mode == "thread":
+            return self.admission.pending_connections > 0
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return bool(readable)
+
+    def serve_select(self):
+        # Single threaded event loop. The listen socket and every
+        # client connection are registered with the selector and a
+        # connection is only serviced once request bytes have
+        # arrived, so a silent client never blocks the loop. Replies
+        # are written without blocking: whatever the socket does not
+        # take at once is kept on the connection (see
+        # SelectConnection) and written as the socket becomes
+        # writable, the same way a streamed export is. As in the
+        # "asyncio" mode, frames that may take a while (see offload)
+        # and legacy requests run on an executor; their connection is
+        # not read from until they are done, and the finished jobs
+        # are handed back to the loop through a pipe.
+        sel = selectors.DefaultSelector()
+        self.socket.setblocking(False)
+        sel.register(self.socket, selectors.EVENT_READ, data=None)
+        if self.wakeup is not None:
+            sel.register(self.wakeup[0], selectors.EVENT_READ, data="wakeup")
+        finished_pipe = os.pipe()
+        for fd in finished_pipe:
+            os.set_blocking(fd, False)
+        sel.register(finished_pipe[0], selectors.EVENT_READ, data="finished")
+        finished = queue.SimpleQueue()
+        executor = ThreadPoolExecutor(max_workers=Server.THREAD_POOL_SIZE)
+        connections = {}
+
+        def close(client):
+            if client.socket in sel.get_map():
+                sel.unregister(client.socket)
+            del connections[client.socket]
+            client.socket.close()
+
+        def watch(client):
+            # Write while there is anything to write, otherwise read
+            # unless a job is running.
+            if client.stream is not None:
+                events = selectors.EVENT_WRITE
+            else:
+                events = 0 if client.busy else selectors.EVENT_READ
+            if client.socket in sel.get_map():
+                if events:
+                    sel.modify(client.socket, events, data=client)
+                else:
+                    sel.unregister(client.socket)
+            elif events:
+                sel.register(client.socket, events, data=client)
+            # A partially received frame or reply must complete
+            # quickly, an idle connection may wait for its next
+            # request.
+            client.deadline = time.monotonic() + (
+                Server.CONNECTION_TIMEOUT if client.buffer or client.stream is not None
+                else Server.KEEPALIVE_TIMEOUT)
+
+        def job_done(client, future):
+            # On an executor thread.
+            finished.put((client, future))
+            try:
+                os.write(finished_pipe[1], b"F")
+            except BlockingIOError:
+                # The loop has wakeups pending already.
+                pass
+
+        def submit(client, function, *args):
+            client.busy = True
+            executor.submit(function, *args).add_done_callback(
+                lambda future: job_done(client, future))
+
+        def send(client, replies):
+            # Write the replies, or queue them behind what is queued.
+            if all(isinstance(reply, bytes) for reply in replies):
+                data = b"".join(replies)
+                if client.stream is None:
+                    start = time.perf_counter()
+                    try:
+                        sent = client.socket.send(data)
+                    except BlockingIOError:
+                        sent = 0
+                    self.metrics.record_stage("send", time.perf_counter() - start)
+                    if sent == len(data):
+                        return
+                    data = memoryview(data)[sent:]
+                outgoing = iter([[data]])
+            else:
+                outgoing = Server.reply_buffers(replies)
+            if client.stream is None:
+                client.stream = [outgoing, []]
+            else:
+                client.stream[0] = itertools.chain(client.stream[0], outgoing)
+
+        def process(client):
+            # Answer the client's frames in order until one has to go
+            # to the executor.
+            replies = []
+            while client.frames and not client.busy:
+                frame = client.frames.pop(0)
+                if self.offload(frame[1], frame[2]):
+                    submit(client, self.admit_frame, client.socket, *frame)
+                else:
+                    replies.append(self.admit_frame(client.socket, *frame))
+            if replies:
+                send(client, replies)
+
+        def serve_legacy(client, recvd_bytes):
+            # On an executor thread: one request per connection, with
+            # a bounded blocking write.
+            client.socket.settimeout(Server.CONNECTION_TIMEOUT)
+            self.reply_legacy(client.socket, recvd_bytes)
+
+        while True:
+            for key, mask in sel.select(timeout=1.0):
+                if key.data == "wakeup":
+                    # Draining: stop accepting (see the sweep below).
+                    sel.unregister(self.wakeup[0])
+                    sel.unregister(self.socket)
+                    continue
+                if key.data == "finished":
+                    try:
+                        os.read(finished_pipe[0], Server.RECV_BUFFER_SIZE)
+                    except BlockingIOError:
+                        pass
+                    while not finished.empty():
+                        client, future = finished.get()
+                        client.busy = False
+                        if client.socket not in connections:
+                            continue
+                        try:
+                            reply = future.result()
+                            if reply is None:
+                                # A legacy request, answered.
+                                close(client)
+                                continue
+                            send(client, [reply])
+                            process(client)
+                        except Exception:
+                            logger.exception("Closing client connection ... ")
+                            close(client)
+                            continue
+                        watch(client)
+                    continue
+                if key.data is None:
+                    try:
+                        connection, address_port = self.socket.accept()
+                    except BlockingIOError:
+                        continue
+                    logger.info("Connection received from %s.", address_port)
+                    self.metrics.record_connection()
+                    connection.setblocking(False)
+                    client = connections[connection] = SelectConnection(connection)
+                    watch(client)
+                    continue
+
+                client = key.data
+                if mask & selectors.EVENT_WRITE:
+                    try:
+                        if Server.pump_stream(client.socket, *client.stream):
+                            client.stream = None
+                    except OSError as msg:
+                        logger.warning("%s", msg)
+                        close(client)
+                        continue
+                    except Exception:
+                        logger.exception("Closing client connection ... ")
+                        close(client)
+                        continue
+                    watch(client)
+                    continue
+                try:
+                    recvd_bytes = client.socket.recv(Server.RECV_BUFFER_SIZE)
+                except BlockingIOError:
+                    continue
+                except OSError as msg:
+                    logger.warning("%s", msg)
+                    close(client)
+                    continue
+                if len(recvd_bytes) == 0:
+                    logger.debug("Closing client connection ... ")
+                    close(client)
+                    continue
+
+                if client.framed is None:
+                    client.framed = Protocol.is_framed(recvd_bytes)
+                    if not client.framed:
+                        # Legacy client: one request per connection.
+                        submit(client, serve_legacy, client, recvd_bytes)
+                        watch(client)
+                        continue
+                if not client.buffer:
+                    client.frame_start = time.perf_counter()
+                client.buffer += recvd_bytes
+                try:
+                    frames = Protocol.split_frames(client.buffer)
+                    if frames:
+                        self.metrics.record_stage("recv", time.perf_counter() - client.frame_start)
+                        client.frame_start = time.perf_counter()
+                        client.frames += frames
+                        process(client)
+                except ProtocolError as msg:
+                    logger.warning("%s", msg)
+                    try:
+                        client.socket.send(Protocol.pack(Protocol.ERROR, str(msg).encode('ascii'),
+                                                         Protocol.BASE_VERSION))
+                    except OSError:
+                        pass
+                    close(client)
+                    continue
+                except Exception:
+                    # Only this connection is lost, not the loop.
+                    logger.exception("Closing client connection ... ")
+                    close(client)
+                    continue
+                watch(client)
+
+            # Drop any connections that have been idle for too long.
+            # Those waiting on a job are left to finish it.
+            now = time.monotonic()
+            for client in list(connections.values()):
+                if client.busy:
+                    continue
+                if client.deadline < now:
+                    logger.info("Connection timed out. Closing client connection ... ")
+                    close(client)
+                elif self.draining and client.idle():
+                    close(client)
+            if self.draining and (not connections or now > self.drain_deadline):
+                executor.shutdown(wait=False)
+                return
+
+    def serve_asyncio(self):
+        # One event loop serves every connection (see
+        # ServerConnection). Requests that may take a while run on
+        # the executor, so the loop keeps servicing other clients.
+        self.executor = ThreadPoolExecutor(max_workers=Server.THREAD_POOL_SIZE)
+        self.connections = set()
+        if resource is not None:
+            # Many mostly idle keep-alive connections need many
+            # descriptors.
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY or soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        self.socket.listen(Server.ASYNCIO_BACKLOG)
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("Using uvloop.")
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: ServerConnection(self), sock=self.socket)
+        while True:
+            # Drop any connections that have been idle for too long.
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for connection in [c for c in self.connections if c.deadline < now and not c.busy]:
+                logger.info("Connection timed out. Closing client connection ... ")
+                connection.transport.close()
+                self.connections.discard(connection)
+            if self.draining:
+                server.close()
+                for connection in [c for c in self.connections if c.idle()]:
+                    connection.transport.close()
+                    self.connections.discard(connection)
+                if not self.connections or now > self.drain_deadline:
+                    return
+
+    def offload(self, msg_type, payload):
+        # Whether a frame's work is slow enough that the "asyncio" mode
+        # runs it on the executor: batches, exports and updates (which
+        # wait for the journal), statistics (whose sorted columns are
+        # rebuilt after a change) and anything naming a course that is
+        # not loaded yet.
+        msg_type &= Protocol.TYPE_MASK
+        if msg_type in (Protocol.BATCH_REQUEST, Protocol.EXPORT_REQUEST, Protocol.UPDATE_REQUEST):
+            return True
+        if msg_type == Protocol.SESSION_REQUEST:
+            payload = payload[Session.NONCE_SIZE:]
+        elif msg_type == Protocol.SEALED_REQUEST:
+            # The session's course was loaded when it was opened.
+            payload = b"0000000" + payload[Protocol.SESSION_ID.size:]
+        elif msg_type != Protocol.REQUEST:
+            return False
+        try:
+            course, id_number, command = self.decode_message(payload)
+        except RequestError:
+            return False
+        return (command.partition(":")[0] in Server.STATISTICS_COMMANDS
+                or (course is not None and course not in self.catalog.stores))
+
+    def serve_prefork(self):
+        # Fork the worker processes. Each one inherits the listen
+        # socket and runs its own inline accept loop, so the kernel
+        # spreads incoming connections across the workers.
+        if not hasattr(os, "fork"):
+            logger.error("prefork mode is not supported on this platform.")
+            sys.exit(1)
+
+        # Turn SIGTERM into SystemExit in the parent, so the finally
+        # below takes the workers down with it.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        workers = []
+        for _ in range(Server.PREFORK_WORKERS):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                try:
+                    self.start_file_watcher()
+                    self.serve_inline()
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(0)
+            workers.append(pid)
+        logger.info("Started workers: %s", workers)
+        if self.replication is not None:
+            # Watching the journal is how the parent sees the
+            # workers' updates.
+            self.start_file_watcher()
+        self.start_replication()
+        if self.replication is not None or self.subscriber is not None:
+            threading.Thread(target=self.write_replication_status,
+                             daemon=True).start()
+
+        try:
+            for pid in workers:
+                os.waitpid(pid, 0)
+        finally:
+            with contextlib.suppress(OSError):
+                os.remove(self.replication_status_path())
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def connection_handler(self, client):
+        # Unpack the client socket address tuple.
+        connection, address_port = client
+        logger.info("Connection received from %s.", address_port)
+        self.metrics.record_connection()
+
+        # Bound how long this client may hold on to the connection.
+        connection.settimeout(Server.CONNECTION_TIMEOUT)
+
+        try:
+            # Receive bytes over the TCP connection. This will block
+            # until "at least 1 byte or more" is available.
+            recvd_bytes = connection.recv(Server.RECV_BUFFER_SIZE)
+
+            # If recv returns with zero bytes, the other end of the
+            # TCP connection has closed (The other end is probably in
+            # FIN WAIT 2 and we are in CLOSE WAIT.). If so, close the
+            # server end of the connection and get the next client
+            # connection.
+            if len(recvd_bytes) == 0:
+                logger.debug("Closing client connection ... ")
+                return
+
+            if Protocol.is_framed(recvd_bytes):
+                self.serve_persistent(connection, recvd_bytes)
+            else:
+                # Legacy client: one unframed request per connection.
+                self.reply_legacy(connection, recvd_bytes)
+
+        except socket.timeout:
+            logger.info("Connection timed out. Closing client connection ... ")
+        except (OSError, ProtocolError) as msg:
+            logger.warning("%s", msg)
+        except KeyboardInterrupt:
+            print()
+            logger.info("Closing client connection ... ")
+        except Exception:
+            # Only this connection is lost.
+            logger.exception("Closing client connection ... ")
+        finally:
+            connection.close()
+
+    def serve_persistent(self, connection, recvd_bytes):
+        # Answer framed requests on this connection until the client
+        # closes it or it times out. Between requests, the connection
+        # is given up if others are waiting for this worker, so a
+        # busy keep-alive client cannot hold it forever; the client
+        # reconnects on its next request.
+        buffer = bytearray(recvd_bytes)
+        frame_start = time.perf_counter()
+        idle = 0.0
+        while True:
+            frame_start = self.reply_to_frames(connection, buffer, frame_start)
+            if self.draining and not buffer:
+                logger.debug("Draining. Closing client connection ... ")
+                return
+            if not buffer and self.others_waiting():
+                logger.info("Closing connection for a waiting client ... ")
+                return
+
+            # A partially received frame must complete quickly, an
+            # idle connection may wait for its next request.
+            connection.settimeout(Server.CONNECTION_TIMEOUT if buffer
+                                  else Server.IDLE_POLL_INTERVAL)
+            try:
+                recvd_bytes = connection.recv(Server.RECV_BUFFER_SIZE)
+            except socket.timeout:
+                if buffer:
+                    raise
+                idle += Server.IDLE_POLL_INTERVAL
+                if idle >= Server.KEEPALIVE_TIMEOUT:
+                    raise
+                continue
+            idle = 0.0
+            if len(recvd_bytes) == 0:
+                logger.debug("Closing client connection ... ")
+                return
+            if not buffer:
+                frame_start = time.perf_counter()
+            buffer += recvd_bytes
+
+    def reply_to_frames(self, connection, buffer, frame_start):
+        # Answer every complete frame in buffer. The replies go back
+        # in one sendall, in request order. frame_start is when the
+        # first byte of the oldest buffered frame arrived; the return
+        # value is the same for the frames still left in buffer.
+        #
+        # A reply may also be a stream (an iterator of buffer lists,
+        # see export_stream), in which case everything is written
+        # piece by piece as the stream produces it, blocking on the
+        # socket so a slow reader slows the producer down.
+        try:
+            frames = Protocol.split_frames(buffer)
+        except ProtocolError as msg:
+            connection.sendall(Protocol.pack(Protocol.ERROR, str(msg).encode('ascii'),
+                                             Protocol.BASE_VERSION))
+            raise
+        if not frames:
+            return frame_start
+
+        self.metrics.record_stage("recv", time.perf_counter() - frame_start)
+        replies = [self.admit_frame(connection, *frame) for frame in frames]
+        if not all(isinstance(reply, bytes) for reply in replies):
+            connection.settimeout(Server.CONNECTION_TIMEOUT)
+            for buffers in Server.reply_buffers(replies):
+                Server.send_buffers(connection, buffers)
+            return time.perf_counter()
+        start = time.perf_counter()
+        connection.sendall(b"".join(replies))
+        self.metrics.record_stage("send", time.perf_counter() - start)
+        return time.perf_counter()
+
+    @staticmethod
+    def reply_buffers(replies):
+        # The replies as one iterator of buffer lists.
+        for reply in replies:
+            if isinstance(reply, bytes):
+                yield [reply]
+            else:
+                yield from reply
+
+    @staticmethod
+    def send_buffers(connection, buffers):
+        # sendall for a list of buffers, gathered by sendmsg rather
+        # than joined into one copy.
+        views = [memoryview(buffer) for buffer in buffers]
+        while views:
+            Server.consume(views, connection.sendmsg(views))
+
+    @staticmethod
+    def pump_stream(connection, outgoing, views):
+        # Write to a non-blocking connection until it would block or
+        # one more piece of the stream has gone out, so one fast
+        # reader cannot keep the event loop to itself. True once the
+        # whole stream is written.
+        if not views:
+            buffers = next(outgoing, None)
+            if buffers is None:
+                return True
+            views[:] = [memoryview(buffer) for buffer in buffers]
+        while views:
+            try:
+                Server.consume(views, connection.sendmsg(views))
+            except BlockingIOError:
+                return False
+        return False
+
+    @staticmethod
+    def consume(views, sent):
+        # Drop the first sent bytes from a list of memoryviews.
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+    def admit_frame(self, connection, version, msg_type, payload):
+        # Admission control in front of handle_frame: a request over
+        # its source address rate or the in-flight cap gets a BUSY
+        # frame without being looked at.
+        if msg_type & Protocol.ACCEPT_COMPRESSED:
+            return self.compress_reply(self.admit_frame(connection, version,
+                                                        msg_type & Protocol.TYPE_MASK, payload))
+        if msg_type not in (Protocol.REQUEST, Protocol.BATCH_REQUEST, Protocol.EXPORT_REQUEST,
+                            Protocol.UPDATE_REQUEST, Protocol.SESSION_REQUEST,
+                            Protocol.SEALED_REQUEST):
+            return self.answer_frame(connection, version, msg_type, payload)
+        cost = Protocol.batch_size(payload) if msg_type == Protocol.BATCH_REQUEST else 1
+        retry_after = self.admission.admit(Server.peer_address(connection), cost)
+        if retry_after:
+            return Protocol.pack(Protocol.BUSY, Protocol.pack_busy(retry_after), version)
+        try:
+            return self.answer_frame(connection, version, msg_type, payload)
+        finally:
+            self.admission.release()
+
+    def answer_frame(self, connection, version, msg_type, payload):
+        # handle_frame, with anything it did not expect turned into an
+        # ERROR frame, so one bad request cannot end the connection or
+        # the serving loop.
+        try:
+            return self.handle_frame(connection, version, msg_type, payload)
+        except Exception:
+            logger.exception("Failed to answer a request.")
+            self.metrics.record_error("internal")
+            return Protocol.pack(Protocol.ERROR, Protocol.INTERNAL_ERROR, version)
+
+    def compress_reply(self, reply):
+        # Compress a reply frame's payload if it is at least
+        # compression_threshold bytes and compresses to less. Streams
+        # (exports) are left alone, their chunks are compressed
+        # already.
+        if not isinstance(reply, bytes):
+            return reply
+        version, msg_type, length = Protocol.HEADER.unpack_from(reply)
+        if length < self.compression_threshold:
+            self.metrics.record_compression("frames", length)
+            return reply
+        start = time.perf_counter()
+        compressed = zlib.compress(memoryview(reply)[Protocol.HEADER_SIZE:], Server.COMPRESSION_LEVEL)
+        seconds = time.perf_counter() - start
+        if len(compressed) >= length:
+            self.metrics.record_compression("frames", length, length, seconds)
+            return reply
+        self.metrics.record_compression("frames", length, len(compressed), seconds)
+        return Protocol.pack(msg_type | Protocol.COMPRESSED, compressed, version)
+
+    def handle_frame(self, connection, version, msg_type, payload):
+        # Returns the reply frame for one request frame.
+        match msg_type:
+            case Protocol.REQUEST | Protocol.SEALED_REQUEST:
+                try:
+                    if msg_type == Protocol.REQUEST:
+                        return Protocol.pack(Protocol.RESPONSE,
+                                             self.handle_request(payload, version,
+                                                                 address=Server.peer_address(connection)),
+                                             version)
+                    return Protocol.pack(Protocol.SEALED_RESPONSE,
+                                         self.handle_sealed(connection, payload, version), version)
+                except ServerBusy as busy:
+                    return Protocol.pack(Protocol.BUSY, Protocol.pack_busy(busy.retry_after), version)
+                except RequestError as msg:
+                    logger.info("%s", msg)
+                    return Protocol.pack(Protocol.ERROR, str(msg).encode('ascii'), version)
+            case Protocol.BATCH_REQUEST:
+                try:
+                    messages = Protocol.unpack_batch_request(payload)
+                except ProtocolError as msg:
+                    return Protocol.pack(Protocol.ERROR, str(msg).encode('ascii'), version)
+                return Protocol.pack(Protocol.BATCH_RESPONSE,
+                                     Protocol.pack_batch_response(
+                                         self.handle_batch(messages, version, Server.peer_address(connection))),
+                                     version)
+            case Protocol.SESSION_REQUEST:
+                try:
+                    return Protocol.pack(Protocol.SESSION_RESPONSE,
+                                         self.open_session(connection, payload), version)
+                except RequestError as msg:
+                    logger.info("%s", msg)
+                    return Protocol.pack(Protocol.ERROR, str(msg).encode('ascii'), version)
+            case Protocol.EXPORT_REQUEST:
+                try:
+                    return self.export(payload, version)
+                except RequestError as msg:
+                    logger.warning("Export refused: %s", msg)
+                    return Protocol.pack(Protocol.ERROR, str(msg).encode('ascii'), version)
+            case Protocol.UPDATE_REQUEST:
+                try:
+                    return Protocol.pack(Protocol.UPDATE_RESPONSE, self.update(payload), version)
+                except RequestError as msg:
+                    logger.warning("Update refused: %s", msg)
+                    return Protocol.pack(Protocol.ERROR, str(msg).encode('ascii'), version)
+            case Protocol.STATS_REQUEST:
+                if not Server.is_local(connection):
+                    return Protocol.pack(Protocol.ERROR, b"Stats are only served to localhost", version)
+                return Protocol.pack(Protocol.STATS_RESPONSE,
+                                     json.dumps(self.stats()).encode('ascii'),
+                                     version)
+            case _:
+                return Protocol.pack(Protocol.ERROR, Protocol.UNKNOWN_TYPE, version)
+
+    def open_session(self, connection, payload):
+        # Check a SESSION_REQUEST and open the session on this
+        # connection. Returns the SESSION_RESPONSE payload.
+        client_nonce = payload[:Session.NONCE_SIZE]
+        course, search_ID, command = self.decode_message(payload[Session.NONCE_SIZE:])
+        if len(client_nonce) != Session.NONCE_SIZE or command:
+            raise RequestError("Invalid session request")
+        try:
+            grade_store = self.catalog.get(course)
+        except KeyError:
+            raise RequestError("Unknown course")
+        matching_row = self.find_row_by_ID(search_ID, grade_store.snapshot)
+        if not matching_row:
+            raise RequestError("User Not found")
+        with self.sessions_lock:
+            sessions = self.sessions.setdefault(connection, [])
+        # A connection's frames are handled one at a time, so only the
+        # dictionary of connections needs the lock.
+        if len(sessions) >= Server.MAX_SESSIONS:
+            raise RequestError(Protocol.TOO_MANY_SESSIONS.decode('ascii'))
+        server_nonce = os.urandom(Session.NONCE_SIZE)
+        number = Protocol.SESSION_ID.pack(len(sessions))
+        try:
+            sessions.append(Session(number, course, search_ID, matching_row.key.encode('ascii'),
+                                    client_nonce, server_nonce))
+        except ValueError:
+            raise RequestError("Invalid key")
+        logger.debug("Session %d opened for %s.", len(sessions) - 1, search_ID)
+        return number + server_nonce
+
+    def handle_sealed(self, connection, payload, version):
+        # Returns the SEALED_RESPONSE payload for a SEALED_REQUEST.
+        try:
+            (number,) = Protocol.SESSION_ID.unpack_from(payload)
+            session = self.sessions[connection][number]
+        except (struct.error, KeyError, IndexError):
+            raise RequestError(Protocol.SESSION_ENDED.decode('ascii'))
+        return self.handle_request(payload[Protocol.SESSION_ID.size:], version, session,
+                                   Server.peer_address(connection))
+
+    def export(self, token, version):
+        # Check an EXPORT_REQUEST and return the stream that answers
+        # it. The snapshot is taken now, so the export is consistent
+        # even if the file is reloaded while it streams.
+        if self.instructor_fernet is None:
+            raise RequestError("Export is disabled")
+        try:
+            course = self.instructor_fernet.decrypt(token, ttl=Protocol.EXPORT_TOKEN_TTL)
+        except InvalidToken:
+            raise RequestError("Export not authorized")
+        try:
+            course = course.decode('ascii') or None
+            grade_store = self.catalog.get(course)
+        except (UnicodeDecodeError, KeyError):
+            raise RequestError("Unknown course")
+        logger.info("Exporting course %s.", course or "(default)")
+        return self.export_stream(grade_store.snapshot, version)
+
+    def export_stream(self, snapshot, version):
+        # Generator of [header, payload] frame buffers. Only one
+        # chunk of rows exists at a time, and the generator only
+        # runs as fast as the socket drains.
+        if not self.admission.start_export():
+            yield [Protocol.pack(Protocol.BUSY,
+                                 Protocol.pack_busy(AdmissionControl.EXPORT_RETRY_AFTER), version)]
+            return
+        try:
+            start = time.perf_counter()
+            yield from self.snapshot_frames(snapshot, version)
+            self.metrics.record_request("EXPORT", {}, time.perf_counter() - start)
+        finally:
+            self.admission.end_export()
+
+    def snapshot_frames(self, snapshot, version):
+        # The EXPORT_CHUNK and EXPORT_END frames of a whole table, as
+        # buffer lists. Also used to send replicas their snapshots.
+        rows = 0
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(snapshot.header)
+        for first in range(0, snapshot.count, Server.EXPORT_CHUNK_ROWS):
+            chunk = snapshot.row_lists(first, first + Server.EXPORT_CHUNK_ROWS)
+            writer.writerows(chunk)
+            rows += len(chunk)
+            if text.tell():
+                yield self.export_chunk(text, version)
+                text.seek(0)
+                text.truncate()
+        if text.tell():
+            yield self.export_chunk(text, version)
+        yield [Protocol.pack(Protocol.EXPORT_END, Protocol.COUNT.pack(rows), version)]
+
+    def update(self, token):
+        # Check and apply an UPDATE_REQUEST. Returns the
+        # UPDATE_RESPONSE payload once the updates are journaled; the
+        # new snapshot version drops the course's cached replies.
+        if self.instructor_fernet is None:
+            raise RequestError("Updates are disabled")
+        if self.subscriber is not None:
+            raise RequestError("Send updates to the primary")
+        try:
+            request = json.loads(self.instructor_fernet.decrypt(token, ttl=Protocol.EXPORT_TOKEN_TTL))
+        except InvalidToken:
+            raise RequestError("Update not authorized")
+        except ValueError:
+            raise RequestError("Invalid update")
+        try:
+            grade_store = self.catalog.get(request["course"])
+            updates = [(str(id_number), GradeSnapshot.COLUMN_CODES[column], mark)
+                       for id_number, column, mark in request["updates"]]
+        except KeyError as msg:
+            raise RequestError("Unknown course or column {}".format(msg))
+        except (TypeError, ValueError):
+            raise RequestError("Invalid update")
+        if len(updates) > Protocol.MAX_UPDATES:
+            raise RequestError("Too many updates")
+        try:
+            applied = grade_store.set_marks(updates)
+        except KeyError as msg:
+            raise RequestError("Unknown ID {}".format(msg))
+        except ValueError as msg:
+            raise RequestError(str(msg))
+        except OSError:
+            # Already logged by the journal.
+            raise RequestError("Update not saved")
+        logger.info("Updated %d marks in course %s.", applied, request["course"] or "(default)")
+        return json.dumps({"applied": applied, "version": grade_store.version}).encode('ascii')
+
+    def export_chunk(self, text, version):
+        chunk = text.getvalue().encode('utf-8')
+        start = time.perf_counter()
+        compressed = zlib.compress(chunk, Server.EXPORT_COMPRESSION_LEVEL)
+        self.metrics.record_compression("export", len(chunk), len(compressed), time.perf_counter() - start)
+        token = self.instructor_fernet.encrypt(compressed)
+        return [Protocol.HEADER.pack(version, Protocol.EXPORT_CHUNK, len(token)), token]
+
+    def stats(self):
+        stats = self.metrics.snapshot()
+        stats["compression_threshold"] = self.compression_threshold
+        stats["response_cache"] = self.response_cache.stats()
+        stats["admission"] = self.admission.stats()
+        if self.mode == "asyncio":
+            stats["open_connections"] = len(self.connections)
+        if self.mode != "prefork":
+            stats.update(self.replication_stats())
+        elif self.replication is not None or self.subscriber is not None:
+            stats.update(self.read_replication_status())
+        return stats
+
+    def replication_stats(self):
+        # The replication part of stats(), from the process that runs
+        # replication.
+        stats = {}
+        if self.replication is not None:
+            stats["replication"] = self.replication.stats()
+        if self.subscriber is not None:
+            stats["replica"] = self.subscriber.stats()
+        return stats
+
+    def replication_status_path(self):
+        return self.grade_store.file_path + Server.REPLICATION_STATUS_SUFFIX
+
+    def write_replication_status(self):
+        # Prefork parent: every HEARTBEAT_INTERVAL, leave the
+        # replication stats where the workers' stats() can read them.
+        path = self.replication_status_path()
+        while True:
+            status = self.replication_stats()
+            status["written"] = time.time()
+            try:
+                with open(path + ".tmp", "w") as status_file:
+                    json.dump(status, status_file)
+                os.replace(path + ".tmp", path)
+            except OSError as msg:
+                logger.warning("Cannot write %s: %s", path, msg)
+            time.sleep(ReplicationPublisher.HEARTBEAT_INTERVAL)
 
-    def create_listen_socket(self):
+    def read_replication_status(self):
+        # Prefork worker: the parent's replication stats, with the
+        # replica lag brought up to now.
         try:
-            # Create an IPv4 TCP socket.
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            with open(self.replication_status_path()) as status_file:
+                status = json.load(status_file)
+        except (OSError, ValueError):
+            return {}
+        age = max(0.0, time.time() - status.pop("written", 0.0))
+        replica = status.get("replica")
+        if replica is not None and replica["lag"] is not None:
+            replica["lag"] = round(replica["lag"] + age, 3)
+        return status
 
-            # Set socket layer socket options. This one allows us to
-            # reuse the socket address without waiting for any timeouts.
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    @staticmethod
+    def peer_address(connection):
+        try:
+            return connection.getpeername()[0]
+        except OSError:
+            return ""
 
-            # Bind socket to socket address, i.e., IP address and port.
-            self.socket.bind(Server.SOCKET_ADDRESS)
+    @staticmethod
+    def is_local(connection):
+        try:
+            address = connection.getpeername()[0]
+        except OSError:
+            return False
+        return address.startswith("127.") or address == "::1"
 
-            # Set socket to listen state.
-            self.socket.listen(Server.MAX_CONNECTION_BACKLOG)
-            print("Listening on port {} ...".format(Server.PORT))
-        except Exception as msg:
-            print(msg)
-            sys.exit(1)
+    def handle_batch(self, messages, version=Protocol.BASE_VERSION, address=""):
+        # Answer each request of a batch independently, one failing
+        # does not fail the others.
+        logger.debug("Batch of %d requests.", len(messages))
+        results = []
+        for message in messages:
+            try:
+                results.append((Protocol.OK, self.handle_request(message, version, address=address)))
+            except ServerBusy as busy:
+                results.append((Protocol.THROTTLED, Protocol.pack_busy(busy.retry_after)))
+            except RequestError as msg:
+                results.append((Protocol.FAILED, str(msg).encode('ascii')))
+        return results
 
-    def process_connections_forever(self):
+    def reply_legacy(self, connection, recvd_bytes):
+        # Legacy clients have no busy reply, so a shed request just
+        # has its connection closed.
+        if self.admission.admit(Server.peer_address(connection)):
+            logger.info("Busy. Closing client connection ... ")
+            return
         try:
-            while True:
-                # Block while waiting for accepting incoming TCP
-                # connections. When one is accepted, pass the new
-                # (cloned) socket info to the connection handler
-                # function. Accept returns a tuple consisting of a
-                # connection reference and the remote socket address.
-                self.connection_handler(self.socket.accept())
-        except Exception as msg:
-            print(msg)
-        except KeyboardInterrupt:
-            print()
+            self.reply(connection, recvd_bytes)
         finally:
-            # If something bad happens, make sure that we close the
-            # socket.
-            self.socket.close()
-            sys.exit(1)
+            self.admission.release()
 
-    def connection_handler(self, client):
-        # Unpack the client socket address tuple.
-        connection, address_port = client
-        print("-" * 72)
-        print("Connection received from {}.".format(address_port))
-        # Output the socket address.
-        print(client)
-        
+    def reply(self, connection, recvd_bytes):
+        # Build the encrypted response for a legacy (unframed) request
+        # and send it back to the client.
         try:
-            # Receive bytes over the TCP connection. This will block
-            # until "at least 1 byte or more" is available.
-            recvd_bytes = connection.recv(Server.RECV_BUFFER_SIZE)
+            encrypted_message_bytes = self.handle_request(recvd_bytes,
+                                                          address=Server.peer_address(connection))
+        except RequestError as msg:
+            logger.info("%s. Closing client connection ... ", msg)
+            return
 
-            # If recv returns with zero bytes, the other end of the
-            # TCP connection has closed (The other end is probably in
-            # FIN WAIT 2 and we are in CLOSE WAIT.). If so, close the
-            # server end of the connection and get the next client
-            # connection.
-            if len(recvd_bytes) == 0:
-                print("Closing client connection ... ")
-                connection.close()
-                
-                        
-            search_ID,command = self.decode_message(recvd_bytes)
+        # Send the received bytes back to the client. We are
+        # sending back the raw data.
+        start = time.perf_counter()
+        connection.sendall(encrypted_message_bytes)
+        self.metrics.record_stage("send", time.perf_counter() - start)
+        logger.debug("Sent: %s", encrypted_message_bytes)
 
-            file_path = 'course_grades_2024.csv'
+    def handle_request(self, recvd_bytes, version=Protocol.BASE_VERSION, session=None, address=""):
+        # Returns the encrypted reply bytes, in the reply format of
+        # the protocol version. Raises RequestError if the request
+        # cannot be answered. In a session, recvd_bytes is just the
+        # command and the reply is sealed with the session key.
+        # address is the client's, for the per-ID rate limit.
+        start = time.perf_counter()
+        if session is None:
+            course,search_ID,command = self.decode_message(recvd_bytes)
+        else:
+            course, search_ID = session.course, session.id_number
+            try:
+                command = recvd_bytes.decode('ascii')
+            except UnicodeDecodeError:
+                raise RequestError("Request is not ASCII")
+        name = command.partition(":")[0]
+        label = name if name in Server.COMMANDS else "invalid"
 
+        retry_after = self.admission.admit_id(address, (course, search_ID))
+        if retry_after:
+            raise ServerBusy(retry_after)
 
-            matching_row = self.find_row_by_ID(file_path, search_ID)
+        try:
+            try:
+                grade_store = self.catalog.get(course)
+            except KeyError:
+                raise RequestError("Unknown course")
 
-            if matching_row:
-                print("User Found: ", matching_row)
-            else:
-                print("User Not found Closing Connection")
-                connection.close()
-                return
+            # Use one snapshot for the whole request, even if the file
+            # watcher swaps in a new one meanwhile.
+            snapshot = grade_store.snapshot
+            snapshot_version = snapshot.version
 
+            cache_key = (course, search_ID, command, version)
+            cached = self.response_cache.get(cache_key, snapshot)
+            if cached is not None:
+                encryption_key_bytes, data_bytes = cached
+                looked_up = aggregated = time.perf_counter()
+            else:
+                encryption_key_bytes, data_bytes, looked_up = self.compute_reply(
+                    snapshot, search_ID, command, version)
+                aggregated = time.perf_counter()
+                self.response_cache.put(cache_key, snapshot, snapshot_version,
+                                        encryption_key_bytes, data_bytes)
+        except RequestError:
+            self.metrics.record_error(label)
+            raise
 
+        if session is None:
+            fernet = self.fernet_cache.get((course, search_ID), encryption_key_bytes)
+            encrypted_message_bytes = fernet.encrypt(data_bytes)
+        elif encryption_key_bytes == session.key:
+            encrypted_message_bytes = session.seal(data_bytes)
+        else:
+            raise RequestError(Protocol.SESSION_ENDED.decode('ascii'))
+        encrypted = time.perf_counter()
 
-            match command:
-                case "GMA":
-                    print("Fetching Midterm average.")
-                    data = self.get_averages(file_path)[4]
-                case "GL1A":
-                    print("Fetching Lab 1 average.")
-                    data = self.get_averages(file_path)[0]                    
-                case "GL2A":
-                    print("Fetching Lab 2 average.")
-                    data = self.get_averages(file_path)[1] 
-                case "GL3A":
-                    print("Fetching Lab 3 average.")
-                    data = self.get_averages(file_path)[2] 
-                case "GL4A":
-                    print("Fetching Lab 4average.")
-                    data = self.get_averages(file_path)[3] 
-                case "GEA":
-                    print("Fetching Exam average.")
-                    data = self.get_averages(file_path)[5] 
-                case "GG":
-                    print("Getting Grades.")
-                    data = matching_row
-                case _:
-                    print("Invalid command entered.")
-                    print("Closing client connection ... ")
-                    connection.close()
+        self.metrics.record_request(label, {"lookup": looked_up - start,
+                                            "aggregate": aggregated - looked_up,
+                                            "encrypt": encrypted - aggregated},
+                                    encrypted - start)
+        return encrypted_message_bytes
 
+    def compute_reply(self, snapshot, search_ID, command, version=Protocol.BASE_VERSION):
+        # The student's key, the reply plaintext (see
+        # Protocol.pack_reply) and the time the lookup finished, for a
+        # request that missed the response cache.
+        name, _, arguments = command.partition(":")
+        matching_row = self.find_row_by_ID(search_ID, snapshot)
 
-            encryption_key_bytes= matching_row[2].encode('ascii')
-            fernet = Fernet(encryption_key_bytes)
-            data_str = str(data)  
-            data_bytes = data_str.encode('ascii')
-            encrypted_message_bytes = fernet.encrypt(data_bytes)
+        if matching_row:
+            logger.debug("User Found: %s", search_ID)
+        else:
+            raise RequestError("User Not found")
+        looked_up = time.perf_counter()
 
-            # Send the received bytes back to the client. We are
-            # sending back the raw data.
-            connection.sendall(encrypted_message_bytes)
-            print("Sent: ", encrypted_message_bytes)
+        kind = Protocol.NUMBER
+        match command:
+            case "GMA":
+                logger.debug("Fetching Midterm average.")
+                data = self.get_averages(snapshot)[4]
+            case "GL1A":
+                logger.debug("Fetching Lab 1 average.")
+                data = self.get_averages(snapshot)[0]
+            case "GL2A":
+                logger.debug("Fetching Lab 2 average.")
+                data = self.get_averages(snapshot)[1]
+            case "GL3A":
+                logger.debug("Fetching Lab 3 average.")
+                data = self.get_averages(snapshot)[2]
+            case "GL4A":
+                logger.debug("Fetching Lab 4 average.")
+                data = self.get_averages(snapshot)[3]
+            case "GEA":
+                logger.debug("Fetching Exam average.")
+                data = self.get_averages(snapshot)[5]
+            case "GG":
+                logger.debug("Getting Grades.")
+                kind = Protocol.MARKS
+                data = (matching_row.as_row() if version == Protocol.BASE_VERSION
+                        else matching_row.marks)
+            case _ if name in Server.STATISTICS_COMMANDS:
+                logger.debug("Getting statistic %s.", command)
+                data = self.get_statistic(snapshot, search_ID, name, arguments)
+                kind = {"GHIST": Protocol.HISTOGRAM, "GRANK": Protocol.RANK}.get(name, Protocol.NUMBER)
+            case _:
+                raise RequestError("Invalid command entered.")
 
-        except KeyboardInterrupt:
-            print()
-            print("Closing client connection ... ")
-            connection.close()
+        encryption_key_bytes= matching_row.key.encode('ascii')
+        data_bytes = Protocol.pack_reply(kind, data, version)
+        return encryption_key_bytes, data_bytes, looked_up
     
     def decode_message(self, message):
 
         # Decode the message (if necessary)
-        decoded_message = message.decode('ascii')
+        try:
+            decoded_message = message.decode('ascii')
+        except UnicodeDecodeError:
+            raise RequestError("Request is not ASCII")
 
-        # Parsing the ID and command
+        # Parsing the optional course, the ID and command
+        course = None
+        if Server.COURSE_SEPARATOR in decoded_message:
+            course, _, decoded_message = decoded_message.partition(Server.COURSE_SEPARATOR)
         id_number = decoded_message[:7]  # first 7 bytes is the id number
         command = decoded_message[7:]    
 
-        # Printing the results
-        print("Full Message :", decoded_message)
-    #    print("Command:", command)
+        # Logging the results
+        logger.debug("Full Message : %s %s", course, decoded_message)
 
-        return id_number, command
+        return course, id_number, command
     
 
-    def find_row_by_ID(self, file_path, search_ID):
+    def get_statistic(self, snapshot, search_ID, name, arguments):
+        # Answer one of the STATISTICS_COMMANDS from the snapshot's
+        # sorted column indexes.
+        arguments = arguments.split(":") if arguments else []
+        try:
+            match name:
+                case "GMED":
+                    (column,) = arguments
+                    return snapshot.median(GradeSnapshot.COLUMN_CODES[column])
+                case "GPCT":
+                    p, column = arguments
+                    p = float(p)
+                    if not 0 <= p <= 100:
+                        raise RequestError("Percentile must be between 0 and 100.")
+                    return snapshot.percentile(GradeSnapshot.COLUMN_CODES[column], p)
+                case "GHIST":
+                    column = GradeSnapshot.COLUMN_CODES[arguments[0]]
+                    width = int(arguments[1]) if len(arguments) > 1 else 1
+                    if not 1 <= width <= Server.MAX_HISTOGRAM_WIDTH or len(arguments) > 2:
+                        raise RequestError("Invalid histogram bucket width.")
+                    histogram = snapshot.histogram(column, width)
+                    if len(histogram) > Server.MAX_HISTOGRAM_BUCKETS:
+                        raise RequestError("Too many histogram buckets.")
+                    return histogram
+                case "GRANK":
+                    (column,) = arguments
+                    return snapshot.rank(search_ID, GradeSnapshot.COLUMN_CODES[column])
+        except (KeyError, IndexError):
+            raise RequestError("Invalid column.")
+        except ValueError:
+            raise RequestError("Invalid statistics arguments.")
 
-        with open(file_path, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            next(reader)  # Skip the header row
-            for row in reader:
-                if row[1] == search_ID:
-                    return row
-        return None
+    def find_row_by_ID(self, search_ID, snapshot=None):
+        # O(1) lookup in the in-memory grade store.
+        if snapshot is None:
+            snapshot = self.grade_store.snapshot
+        return snapshot.find(search_ID)
     
-    def get_averages(self,file_path):
+    def get_averages(self, snapshot=None):
         '''
         Array contents = [Lab 1,Lab 2,Lab 3,Lab 4,Midterm,Exam 1,Exam 2,Exam 3,Exam 4]
         '''
-        grades = [0] * 9
+        # Constant time: the snapshot keeps running sums and counts.
+        if snapshot is None:
+            snapshot = self.grade_store.snapshot
+        return snapshot.averages()
 
-        i = 3
-        count =0
-        with open(file_path, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            next(reader)  # Skip the header row
-            for row in reader:
-                i = 3
-                count = count + 1
-                for j in range(9):
-                    grades[j] += int(row[i])
-                    #print(j)
-                    i = i + 1
 
-        
-        for i in range (len(grades)):
-            grades[i] = grades[i] / count
+    def print_rows(self):
+        logger.info("Data read from %s: %d rows.", self.grade_store.file_path, len(self.grade_store))
+        if logger.isEnabledFor(logging.DEBUG):
+            for record in self.grade_store:
+                logger.debug("%s", record.as_row())
+
+        return None
+########################################################################
+# Shard router class
+########################################################################
 
+class Router(Server):
 
-        return grades
+    # Front end for a course split across several shard servers (see
+    # ShardMap). It speaks the same protocol as Server, on the same
+    # concurrency modes, and forwards each request to the shard that
+    # owns the student over pooled persistent connections. A batch is
+    # split into one sub-batch per shard, sent in parallel and put
+    # back together in request order. The shards should trust the
+    # router's address (--trusted-peers), or all its traffic counts
+    # against one address's rate limit.
+    #
+    # e.g., shards:
+    #   python server_client_Grade_Retrieval.py -r server -p 50001 \
+    #       --shards hash:2 --shard-index 0 --trusted-peers localhost
+    #   python server_client_Grade_Retrieval.py -r server -p 50002 \
+    #       --shards hash:2 --shard-index 1 --trusted-peers localhost
+    #       router:
+    #   python server_client_Grade_Retrieval.py -r router --shards hash:2 \
+    #       --backends localhost:50001,localhost:50002
+
+    def __init__(self, backends, shard_map, mode=Server.CONCURRENCY_MODE, port=Server.PORT,
+                 compression_threshold=Server.COMPRESSION_THRESHOLD, trusted_peers=()):
+        if mode not in Server.CONCURRENCY_MODES:
+            logger.error("Unknown concurrency mode: %s", mode)
+            sys.exit(1)
+        if len(backends) != shard_map.count:
+            logger.error("%d backends given for %d shards.", len(backends), shard_map.count)
+            sys.exit(1)
+        self.mode = mode
+        self.port = port
+        self.compression_threshold = compression_threshold
+        self.listen_fd = None
+        self.ready_fd = None
+        self.draining = False
+        self.wakeup = None
+        self.shard_map = shard_map
+        self.pools = [ClientPool(host, backend_port) for host, backend_port in backends]
+        self.fanout = ThreadPoolExecutor(max_workers=max(1, shard_map.count))
+        # Per-ID limits are applied here, where the client addresses
+        # are known; the shards trust the router.
+        self.admission = AdmissionControl(trusted_peers)
+        # Replication is between shard servers and their replicas.
+        self.replication = None
+        self.subscriber = None
+        self.metrics = ServerMetrics()
+        logger.info("Routing %d shards: %s", shard_map.count, backends)
+        self.create_listen_socket()
+        self.process_connections_forever()
+
+    def start_file_watcher(self):
+        # The router holds no grade data.
+        pass
+
+    def offload(self, msg_type, payload):
+        # Forwarding waits on the shards.
+        return msg_type != Protocol.STATS_REQUEST
+
+    def stats(self):
+        stats = self.metrics.snapshot()
+        stats["compression_threshold"] = self.compression_threshold
+        stats["admission"] = self.admission.stats()
+        return stats
+
+    def shard_for(self, message, address=None):
+        # The shard that owns the student. Given the client's address,
+        # the request is first checked against the per-ID limit
+        # (raising ServerBusy).
+        course, id_number, command = self.decode_message(message)
+        if address is not None:
+            retry_after = self.admission.admit_id(address, (course, id_number))
+            if retry_after:
+                raise ServerBusy(retry_after)
+        return self.shard_map.shard_of(id_number)
+
+    def forward(self, shard, msg_type, payload, version=Protocol.BASE_VERSION):
+        # Returns the (type, payload) reply of a shard, to a request
+        # of the given protocol version.
+        start = time.perf_counter()
+        version, reply_type, reply = self.pools[shard].call("exchange", msg_type, payload, version)
+        self.metrics.record_request("shard{}".format(shard), {}, time.perf_counter() - start)
+        return reply_type, reply
+
+    def handle_frame(self, connection, version, msg_type, payload):
+        try:
+            match msg_type:
+                case Protocol.REQUEST:
+                    shard = self.shard_for(payload, Server.peer_address(connection))
+                    reply_type, reply = self.forward(shard, msg_type, payload, version)
+                    return Protocol.pack(reply_type, reply, version)
+                case Protocol.BATCH_REQUEST:
+                    return Protocol.pack(Protocol.BATCH_RESPONSE,
+                                         Protocol.pack_batch_response(
+                                             self.route_batch(Protocol.unpack_batch_request(payload), version,
+                                                              Server.peer_address(connection))),
+                                         version)
+                case Protocol.EXPORT_REQUEST:
+                    # Each shard only holds its own students' keys.
+                    return Protocol.pack(Protocol.ERROR, b"Export from each shard server", version)
+                case Protocol.SESSION_REQUEST | Protocol.SEALED_REQUEST:
+                    # So do sessions, and a router connection reaches
+                    # the shards over pooled connections.
+                    return Protocol.pack(Protocol.ERROR, Protocol.NO_SESSIONS, version)
+                case Protocol.UPDATE_REQUEST:
+                    reply_type, reply = self.broadcast(msg_type, payload, version)
+                    return Protocol.pack(reply_type, reply, version)
+        except ServerBusy as busy:
+            return Protocol.pack(Protocol.BUSY, Protocol.pack_busy(busy.retry_after), version)
+        except (RequestError, ProtocolError) as msg:
+            return Protocol.pack(Protocol.ERROR, str(msg).encode('ascii'), version)
+        except ClientError as msg:
+            logger.warning("%s", msg)
+            self.metrics.record_error("route")
+            return Protocol.pack(Protocol.ERROR, b"Shard unavailable", version)
+        return super().handle_frame(connection, version, msg_type, payload)
+
+    def broadcast(self, msg_type, payload, version):
+        # Send a request to every shard in parallel. Every shard keeps
+        # all the marks (for the averages), so an update goes to all
+        # of them. Returns the first failed reply, or else shard 0's.
+        futures = [self.fanout.submit(self.forward, shard, msg_type, payload, version)
+                   for shard in range(self.shard_map.count)]
+        replies = [future.result() for future in futures]
+        for reply_type, reply in replies:
+            if reply_type != Protocol.UPDATE_RESPONSE:
+                return reply_type, reply
+        return replies[0]
+
+    def route_batch(self, messages, version=Protocol.BASE_VERSION, address=None):
+        # Group the requests by shard, send the groups in parallel and
+        # scatter the results back into request order.
+        groups = {}
+        results = [None] * len(messages)
+        for position, message in enumerate(messages):
+            try:
+                groups.setdefault(self.shard_for(message, address), []).append(position)
+            except ServerBusy as busy:
+                results[position] = (Protocol.THROTTLED, Protocol.pack_busy(busy.retry_after))
+            except RequestError as msg:
+                results[position] = (Protocol.FAILED, str(msg).encode('ascii'))
+
+        def send(shard, positions):
+            return self.forward(shard, Protocol.BATCH_REQUEST,
+                                Protocol.pack_batch_request([messages[i] for i in positions]), version)
+
+        futures = {shard: self.fanout.submit(send, shard, positions)
+                   for shard, positions in groups.items()}
+        for shard, future in futures.items():
+            try:
+                reply_type, reply = future.result()
+                replies = (Protocol.unpack_batch_response(reply)
+                           if reply_type == Protocol.BATCH_RESPONSE else None)
+            except (ClientError, ProtocolError) as msg:
+                logger.warning("%s", msg)
+                replies = None
+            for i, position in enumerate(groups[shard]):
+                results[position] = (replies[i] if replies is not None
+                                     else (Protocol.FAILED, b"Shard unavailable"))
+        return results
+
+    def reply(self, connection, recvd_bytes):
+        # Legacy (unframed) request: forward it framed, answer raw.
+        try:
+            shard = self.shard_for(recvd_bytes, Server.peer_address(connection))
+            reply_type, reply = self.forward(shard, Protocol.REQUEST, recvd_bytes)
+        except ServerBusy:
+            logger.info("Busy. Closing client connection ... ")
+            return
+        except (RequestError, ClientError) as msg:
+            logger.info("%s. Closing client connection ... ", msg)
+            return
+        if reply_type == Protocol.RESPONSE:
+            connection.sendall(reply)
+
+########################################################################
+# Supervisor class
+########################################################################
+
+class Supervisor:
+
+    # Runs a number of server processes (one per core by default) that
+    # all accept on one listen socket. The supervisor opens it and
+    # hands it down (--listen-fd), so the port stays open for as long
+    # as the supervisor runs: connections wait in its backlog while
+    # workers come and go, and are never refused.
+    #
+    # SIGHUP does a rolling restart. One worker at a time, a new one
+    # is started, and once it has loaded its grades and says so
+    # (--ready-fd) an old one is sent SIGTERM: it stops accepting,
+    # closes its connections as they go idle and exits (see
+    # Server.drain). New workers run the script as it is on disk, so
+    # this also deploys new code. A worker that dies is respawned,
+    # after a growing delay if it keeps dying as it starts. SIGTERM or
+    # Ctrl-C drains all the workers and exits.
+    #
+    # Each worker keeps its own stats (the "stats" role reports one
+    # worker's). Replicas and primaries are not supported, as each
+    # worker would replicate on its own.
+    #
+    # e.g., python server_client_Grade_Retrieval.py -r supervisor \
+    #           -m asyncio --workers 8
+    #       kill -HUP <supervisor pid>
+
+    WORKERS = os.cpu_count() or 1
+    BACKLOG = 1024
+    # How long (in seconds) a new worker may take to load its grades.
+    READY_TIMEOUT = 120.0
+    # A worker that dies within MIN_UPTIME seconds of starting is
+    # respawned after RESPAWN_DELAY seconds, doubling up to
+    # MAX_RESPAWN_DELAY while it keeps doing so.
+    MIN_UPTIME = 5.0
+    RESPAWN_DELAY = 0.5
+    MAX_RESPAWN_DELAY = 30.0
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, worker_args, workers=WORKERS, port=Server.PORT):
+        # worker_args are the command line arguments of a worker.
+        self.worker_args = worker_args
+        self.script = os.path.abspath(__file__)
+        self.port = port
+        # Running workers: Popen -> [start time, ready pipe or None].
+        self.workers = {}
+        self.respawn_delay = 0.0
+        self.respawn_times = []
+        self.restart_requested = False
+        self.stopping = False
+        self.create_listen_socket()
+        signal.signal(signal.SIGHUP, self.request_restart)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(workers):
+            self.spawn()
+        logger.info("Supervising %d workers on port %d.", workers, port)
+        self.supervise_forever()
+
+    def create_listen_socket(self):
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((Server.HOSTNAME, self.port))
+            self.socket.listen(Supervisor.BACKLOG)
+            logger.info("Listening on port %d ...", self.port)
+        except Exception as msg:
+            logger.error("%s", msg)
+            sys.exit(1)
+
+    def request_restart(self, signum, frame):
+        self.restart_requested = True
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def spawn(self):
+        ready_read, ready_write = os.pipe()
+        fds = (self.socket.fileno(), ready_write)
+        try:
+            process = subprocess.Popen([sys.executable, self.script] + self.worker_args
+                                       + ["--listen-fd", str(fds[0]), "--ready-fd", str(fds[1])],
+                                       pass_fds=fds)
+        finally:
+            os.close(ready_write)
+        self.workers[process] = [time.monotonic(), ready_read]
+        logger.info("Started worker %d.", process.pid)
+        return process
+
+    def supervise_forever(self):
+        try:
+            while not self.stopping:
+                if self.restart_requested:
+                    self.restart_requested = False
+                    self.rolling_restart()
+                self.wait_ready(Supervisor.POLL_INTERVAL)
+                self.reap()
+        finally:
+            self.stop_workers(list(self.workers))
+            self.socket.close()
+        logger.info("Supervisor exiting.")
+        sys.exit(0)
+
+    def wait_ready(self, timeout, process=None):
+        # Wait up to timeout for workers to say they are ready (or
+        # die, which closes the pipe). With a process given, returns
+        # whether that one is ready.
+        deadline = time.monotonic() + timeout
+        while True:
+            pipes = {state[1]: worker for worker, state in self.workers.items() if state[1] is not None}
+            if process is not None and process not in pipes.values():
+                return process in self.workers and process.poll() is None
+            remaining = deadline - time.monotonic()
+            if not pipes or remaining <= 0:
+                if not pipes:
+                    time.sleep(max(0.0, remaining))
+                return False
+            readable, _, _ = select.select(list(pipes), [], [], remaining)
+            for ready_read in readable:
+                worker = pipes[ready_read]
+                if os.read(ready_read, 1):
+                    logger.info("Worker %d is ready.", worker.pid)
+                os.close(ready_read)
+                self.workers[worker][1] = None
+            if process is None and readable:
+                return False
+
+    def reap(self):
+        # Respawn workers that died, and any respawns now due.
+        now = time.monotonic()
+        for process, (started, ready_read) in list(self.workers.items()):
+            code = process.poll()
+            if code is None:
+                continue
+            del self.workers[process]
+            if ready_read is not None:
+                os.close(ready_read)
+            if now - started < Supervisor.MIN_UPTIME:
+                self.respawn_delay = min(max(2 * self.respawn_delay, Supervisor.RESPAWN_DELAY),
+                                         Supervisor.MAX_RESPAWN_DELAY)
+            else:
+                self.respawn_delay = 0.0
+            logger.warning("Worker %d exited with status %d, respawning in %.1f s.",
+                           process.pid, code, self.respawn_delay)
+            self.respawn_times.append(now + self.respawn_delay)
+        for due in [due for due in self.respawn_times if due <= now]:
+            self.respawn_times.remove(due)
+            self.spawn()
+
+    def rolling_restart(self):
+        logger.info("Rolling restart of %d workers ...", len(self.workers))
+        for old in list(self.workers):
+            if self.stopping:
+                return
+            if old not in self.workers:
+                # Died and was respawned meanwhile.
+                continue
+            new = self.spawn()
+            if not self.wait_ready(Supervisor.READY_TIMEOUT, new):
+                logger.error("Worker %d did not become ready, stopping the restart.", new.pid)
+                self.stop_workers([new])
+                return
+            self.stop_workers([old])
+        logger.info("Rolling restart done.")
+
+    def stop_workers(self, processes):
+        # Drain workers in parallel, killing any still running after
+        # Server.DRAIN_TIMEOUT (plus some slack).
+        for process in processes:
+            state = self.workers.pop(process, None)
+            if state is not None and state[1] is not None:
+                os.close(state[1])
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + Server.DRAIN_TIMEOUT + 5.0
+        for process in processes:
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning("Worker %d did not drain, killing it.", process.pid)
+                process.kill()
+                process.wait()
+            logger.info("Worker %d stopped.", process.pid)
 
-    
-    def print_rows(self, file_path):
-        print('Data read from CSV file: \n')
-        with open(file_path, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            next(reader)  # Skip the header row
-            for row in reader:
-                print(row)
-                    
-        return None
 ########################################################################
 # Echo Client class
 ########################################################################
 
+class Keyring:
+
+    # A client's decryption keys, and nothing else: the (course, ID,
+    # key) rows of the students it asks about, in a small CSV file
+    #
+    #   Course,ID Number,Key
+    #   ,1803933,M7E8erO15CIh902P8DQsHxKbOADTgEPGHdiY0MplTuY=
+    #
+    # where an empty course is the server's default course. The file
+    # is read once into a dict, so finding a reply's key is one dict
+    # lookup with no I/O, and a client never holds other students'
+    # marks or keys. The "keyring" role copies keys out of a grades
+    # file into one; clients read keyring.csv unless given -k.
+    #
+    # e.g., python server_client_Grade_Retrieval.py -r keyring \
+    #           --ids 1803933,1884159
+    #       python server_client_Grade_Retrieval.py -r client
+
+    HEADER = ["Course", "ID Number", "Key"]
+    PATH = "keyring.csv"
+
+    def __init__(self, keys=None):
+        # (course, ID) -> key bytes.
+        self.keys = {} if keys is None else keys
+
+    @classmethod
+    def load(cls, file_path):
+        keys = {}
+        with open(file_path, newline='') as csvfile:
+            for line_number, row in enumerate(csv.reader(csvfile), 1):
+                if not row or row == Keyring.HEADER:
+                    continue
+                try:
+                    course, id_number, key = (field.strip() for field in row)
+                except ValueError:
+                    raise ValueError("{}:{}: expected course, ID and key".format(file_path, line_number))
+                keys[(course or None, id_number)] = key.encode('ascii')
+        return cls(keys)
+
+    def get(self, id_number, course=None):
+        return self.keys.get((course, id_number))
+
+    def add(self, id_number, key, course=None):
+        self.keys[(course, id_number)] = key
+
+    def save(self, file_path):
+        # Written readable by its owner only, under a temporary name
+        # and renamed into place.
+        temp_path = file_path + ".tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(Keyring.HEADER)
+            for (course, id_number), key in sorted(self.keys.items(),
+                                                   key=lambda item: (item[0][0] or "", item[0][1])):
+                writer.writerow([course or "", id_number, key.decode('ascii')])
+        os.replace(temp_path, file_path)
+
+    @staticmethod
+    def extract(file_path, ids, keyring_path, course=None):
+        # Copy the keys of ids from a grades file (any format the
+        # server reads) into the keyring at keyring_path, creating it
+        # or adding to it. Raises KeyError for an ID not in the file.
+        snapshot = GradeStore(file_path).snapshot
+        keyring = Keyring.load(keyring_path) if os.path.exists(keyring_path) else Keyring()
+        for id_number in ids:
+            matching_row = snapshot.find(id_number)
+            if matching_row is None:
+                raise KeyError(id_number)
+            keyring.add(id_number, matching_row.key.encode('ascii'), course)
+        keyring.save(keyring_path)
+        return keyring
+
 class Client:
 
     # Set the server to connect to. If the server and client are running
@@ -261,13 +4490,66 @@ class Client:
     RECV_BUFFER_SIZE = 1024 # Used for recv.    
     # RECV_BUFFER_SIZE = 5 # Used for recv.    
 
+    # Decryption keys come from the keyring at KEYRING_PATH (see
+    # Keyring), loaded on first use and shared by all Client
+    # instances. With KEY_FILES set (--key-files) they are looked up
+    # in the grades files themselves instead, which puts every
+    # student's name, marks and key in the client's memory; only for
+    # tests and benchmarks run next to the server. There is one grade
+    # store per course, also shared and loaded on first use: the
+    # default course is FILE_PATH, any other course is
+    # <COURSES_DIR>/<course>.grades or .csv, as on the server.
+    KEYRING_PATH = Keyring.PATH
+    KEY_FILES = False
+    keyring = None
+    FILE_PATH = 'course_grades_2024.csv'
+    COURSES_DIR = None
+    grade_stores = {}
+
+    # Fernet objects for decrypting replies, shared by all Client
+    # instances.
+    fernet_cache = FernetCache()
 
-    def __init__(self,message,id):
+
+    def __init__(self,message=None,id=None,host=SERVER_HOSTNAME,port=None,
+                 timeout=None,exit_on_error=True,verbose=True,sessions=False):
+        # Client(message, id) sends one request and closes, as
+        # before. Client() opens a persistent connection that carries
+        # any number of request() calls.
+        #
+        # With exit_on_error=False, errors raise ClientError instead
+        # of exiting the process, so the class can be embedded in a
+        # long-running service (see ClientPool).
+        #
+        # With sessions=True, request() opens a session (see Session)
+        # for each student it asks about, if the server supports them.
         self.ID_num = id
+        self.course = None
         self.full_message = message
+        self.host = host
+        self.port = Server.PORT if port is None else port
+        self.timeout = timeout
+        self.exit_on_error = exit_on_error
+        self.verbose = verbose
+        # Protocol version to speak, lowered if the server is older,
+        # and whether to ask for compressed replies (see Protocol).
+        self.version = Protocol.VERSION
+        self.compression = True
+        # Sessions open on this connection, by (course, ID), and
+        # whether the server will open more.
+        self.use_sessions = sessions
+        self.sessions = {}
+        self.sessions_full = False
         self.get_socket()
         self.connect_to_server()
-        self.send_message()
+        if message is not None:
+            self.send_message()
+
+    def fail(self, msg):
+        if self.exit_on_error:
+            print(msg)
+            sys.exit(1)
+        raise ClientError(msg)
 
     def get_socket(self):
         try:
@@ -278,19 +4560,30 @@ class Client:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             # Bind the client socket to a particular address/port.
             # self.socket.bind((Server.HOSTNAME, 40000))
+
+            # Bound connect, send and recv (None blocks forever).
+            self.socket.settimeout(self.timeout)
                 
         except Exception as msg:
-            print(msg)
-            sys.exit(1)
+            self.fail(msg)
 
     def connect_to_server(self):
         try:
             # Connect to the server using its socket address tuple.
-            self.socket.connect((Client.SERVER_HOSTNAME, Server.PORT))
-            print("Connected to \"{}\" on port {}".format(Client.SERVER_HOSTNAME, Server.PORT))
+            self.socket.connect((self.host, self.port))
+            if self.verbose:
+                print("Connected to \"{}\" on port {}".format(self.host, self.port))
         except Exception as msg:
-            print(msg)
-            sys.exit(1)
+            self.socket.close()
+            self.fail(msg)
+
+    def reconnect(self):
+        # Sessions end with their connection.
+        self.sessions.clear()
+        self.sessions_full = False
+        self.socket.close()
+        self.get_socket()
+        self.connect_to_server()
 
     
     def send_message(self):
@@ -307,75 +4600,589 @@ class Client:
             # that we close the socket.
             self.socket.close()
             sys.exit(1)
+
+    def exchange(self, msg_type, payload, version=None):
+        # Send one frame and return the reply frame. Unless a version
+        # is given, a server that does not speak self.version is
+        # asked again in version 1, which is then used from here on.
+        frame = self.send_frame(msg_type, payload, version or self.version)
+        if (version is None and self.version != Protocol.BASE_VERSION and frame is not None
+                and frame[1] == Protocol.ERROR and frame[2].startswith(Protocol.UNSUPPORTED_VERSION)):
+            if self.verbose:
+                print("Server only speaks protocol version {}.".format(Protocol.BASE_VERSION))
+            self.version = Protocol.BASE_VERSION
+            self.reconnect()
+            frame = self.send_frame(msg_type, payload, self.version)
+        if (self.compression and frame is not None and frame[1] == Protocol.ERROR
+                and frame[2] == Protocol.UNKNOWN_TYPE):
+            # Perhaps only the compression flag is unknown.
+            self.compression = False
+            frame = self.send_frame(msg_type, payload, version or self.version)
+        return frame
+
+    def send_frame(self, msg_type, payload, version):
+        # If the server has closed the idle connection (or the reply
+        # timed out), reconnect and retry once.
+        for attempt in range(2):
+            if self.compression:
+                msg_type |= Protocol.ACCEPT_COMPRESSED
+            try:
+                self.socket.sendall(Protocol.pack(msg_type, payload, version))
+                frame = Protocol.recv_frame(self.socket)
+                if frame is not None:
+                    frame = Protocol.decompress(frame)
+            except (OSError, ProtocolError) as msg:
+                if self.verbose:
+                    print(msg)
+                frame = None
+            if frame is not None:
+                return frame
+            if attempt == 0:
+                if self.verbose:
+                    print("Server closed the connection, reconnecting ... ")
+                self.reconnect()
+        if not self.exit_on_error:
+            raise ClientError("No reply from {}:{}".format(self.host, self.port))
+        return None
+
+    @staticmethod
+    def encode_request(id_number, command, course=None):
+        message = id_number + command
+        if course is not None:
+            message = course + Server.COURSE_SEPARATOR + message
+        return message.encode('ascii')
+
+    def request(self, id_number, command, course=None):
+        # Send one request on the persistent connection and return the
+        # decrypted reply (None if the server refused it). course
+        # selects a course other than the server's default.
+        self.ID_num = id_number
+        self.course = course
+        self.full_message = Client.encode_request(id_number, command, course)
+        session = None
+        for attempt in range(2):
+            if self.use_sessions:
+                session = self.open_session(id_number, course)
+            if session is None:
+                frame = self.exchange(Protocol.REQUEST, self.full_message)
+                break
+            frame = self.exchange(Protocol.SEALED_REQUEST, session.number + command.encode('ascii'))
+            if (frame is None or frame[1] != Protocol.ERROR
+                    or not frame[2].startswith(Protocol.SESSION_ENDED)):
+                break
+            # The connection was replaced or the student's key
+            # changed: open a new session and ask again.
+            self.sessions.pop((course, id_number), None)
+        if frame is None:
+            return None
+        return self.handle_frame(frame, session)
+
+    def open_session(self, id_number, course=None):
+        # The session for a student on this connection, opened with a
+        # SESSION_REQUEST on first use. None if there is no key for the
+        # student or the server refused; a server without sessions, or
+        # a connection with all the sessions it may have, is not asked
+        # again.
+        session = self.sessions.get((course, id_number))
+        if session is not None or self.sessions_full:
+            return session
+        key = Client.find_key(id_number, course)
+        if key is None:
+            return None
+        client_nonce = os.urandom(Session.NONCE_SIZE)
+        frame = self.exchange(Protocol.SESSION_REQUEST,
+                              client_nonce + Client.encode_request(id_number, "", course))
+        if frame is None:
+            return None
+        version, msg_type, payload = frame
+        if msg_type != Protocol.SESSION_RESPONSE:
+            if msg_type == Protocol.ERROR and payload in (Protocol.UNKNOWN_TYPE, Protocol.NO_SESSIONS):
+                if self.verbose:
+                    print("Server does not support sessions.")
+                self.use_sessions = False
+            elif msg_type == Protocol.ERROR and payload == Protocol.TOO_MANY_SESSIONS:
+                self.sessions_full = True
+            return None
+        number, server_nonce = payload[:Protocol.SESSION_ID.size], payload[Protocol.SESSION_ID.size:]
+        session = Session(number, course, id_number, key, client_nonce, server_nonce)
+        self.sessions[(course, id_number)] = session
+        return session
+
+    def request_batch(self, requests):
+        # Send many (ID, command) or (ID, command, course) tuples in one
+        # BATCH_REQUEST and return the decrypted replies in the same
+        # order. A request the server refused gives None in its place.
+        messages = [Client.encode_request(*request) for request in requests]
+        frame = self.exchange(Protocol.BATCH_REQUEST, Protocol.pack_batch_request(messages))
+        if frame is None:
+            return [None] * len(requests)
+
+        version, msg_type, payload = frame
+        if msg_type == Protocol.ERROR:
+            print("Server error: ", payload.decode('ascii'))
+            return [None] * len(requests)
+        if msg_type == Protocol.BUSY:
+            if self.verbose:
+                print("Server busy, retry in {:.2f} s.".format(Protocol.unpack_busy(payload)))
+            return [None] * len(requests)
+
+        return Client.decrypt_batch(requests, payload, self.verbose, version)
+
+    def export(self, instructor_key, course=None):
+        # Generator of the rows of a whole course, header row first,
+        # as lists of strings like csv.reader gives. Needs the
+        # server's instructor key.
+        fernet = Fernet(instructor_key)
+        token = fernet.encrypt((course or "").encode('ascii'))
+        frame = self.exchange(Protocol.EXPORT_REQUEST, token)
+        while True:
+            if frame is None:
+                self.fail("Connection closed during export")
+                return
+            version, msg_type, payload = frame
+            match msg_type:
+                case Protocol.EXPORT_CHUNK:
+                    text = zlib.decompress(fernet.decrypt(payload)).decode('utf-8')
+                    yield from csv.reader(io.StringIO(text))
+                case Protocol.EXPORT_END:
+                    return
+                case Protocol.BUSY:
+                    self.fail("Server busy, retry in {:.2f} s.".format(Protocol.unpack_busy(payload)))
+                    return
+                case _:
+                    self.fail(payload.decode('ascii', 'replace'))
+                    return
+            frame = Protocol.recv_frame(self.socket)
+
+    def update(self, instructor_key, updates, course=None):
+        # Set marks from (ID, column code, mark) tuples, in requests
+        # of up to Protocol.MAX_UPDATES. Needs the server's
+        # instructor key. Returns the number of marks applied, or
+        # None if the server refused a request (earlier requests
+        # stay applied).
+        fernet = Fernet(instructor_key)
+        applied = 0
+        for first in range(0, len(updates), Protocol.MAX_UPDATES):
+            request = {"course": course,
+                       "updates": [list(update) for update in updates[first:first + Protocol.MAX_UPDATES]]}
+            frame = self.exchange(Protocol.UPDATE_REQUEST,
+                                  fernet.encrypt(json.dumps(request).encode('ascii')))
+            if frame is None:
+                return None
+            version, msg_type, payload = frame
+            if msg_type == Protocol.BUSY:
+                self.fail("Server busy, retry in {:.2f} s.".format(Protocol.unpack_busy(payload)))
+                return None
+            if msg_type != Protocol.UPDATE_RESPONSE:
+                self.fail(payload.decode('ascii', 'replace'))
+                return None
+            applied += json.loads(payload)["applied"]
+        return applied
+
+    def stats(self):
+        # Fetch the server metrics (only served to localhost).
+        frame = self.exchange(Protocol.STATS_REQUEST, b"")
+        if frame is None:
+            return None
+        version, msg_type, payload = frame
+        if msg_type != Protocol.STATS_RESPONSE:
+            self.fail(payload.decode('ascii'))
+        return json.loads(payload)
+
+    def close(self):
+        if self.verbose:
+            print("Closing server connection ... ")
+        self.socket.close()
                 
     def connection_send(self):
         try:
             # Send string objects over the connection. The string must
-            # be encoded into bytes objects first.
-            self.socket.sendall(self.full_message)
+            # be encoded into bytes objects first, then framed.
+            self.socket.sendall(Protocol.pack(Protocol.REQUEST, self.full_message, self.version))
         except Exception as msg:
-            print(msg)
-            sys.exit(1)
+            self.fail(msg)
 
     def connection_receive(self):
         try:
-            # Receive and print out text. The received bytes objects
-            # must be decoded into string objects.
-            recvd_bytes = self.socket.recv(Client.RECV_BUFFER_SIZE)
+            # Receive one whole response frame, however many recv
+            # calls that takes.
+            frame = Protocol.recv_frame(self.socket)
 
-            # recv will block if nothing is available. If we receive
-            # zero bytes, the connection has been closed from the
-            # other end. In that case, close the connection on this
-            # end and exit.
-            if len(recvd_bytes) == 0:
+            # If the connection was closed from the other end before
+            # a whole frame arrived, close this end too.
+            if frame is None:
                 print("Closing server connection ... ")
                 self.socket.close()
                 return
 
+            self.handle_frame(frame)
 
+            #print("Received: ", recvd_bytes.decode(Server.MSG_ENCODING))
 
-            file_path = 'course_grades_2024.csv'
+        except Exception as msg:
+            self.fail(msg)
 
+    def handle_frame(self, frame, session=None):
+        version, msg_type, payload = frame
+        if msg_type == Protocol.ERROR:
+            if self.verbose:
+                print("Server error: ", payload.decode('ascii'))
+            return None
+        if msg_type == Protocol.BUSY:
+            if self.verbose:
+                print("Server busy, retry in {:.2f} s.".format(Protocol.unpack_busy(payload)))
+            return None
 
-            matching_row = self.find_row_by_ID(file_path, self.ID_num)
-            
-            if not matching_row:
-                print("User Not found closing connection.")
-                self.socket.close()
-                return
-            
-            encryption_key_bytes = matching_row[2].encode('ascii')
-            
-            self.decrypt_message(recvd_bytes,encryption_key_bytes)
+        if msg_type == Protocol.SEALED_RESPONSE:
+            try:
+                decrypted_message = Client.decode_reply(session.open(payload), version)
+            except (InvalidTag, ProtocolError):
+                self.fail("Reply for ID {} failed to decrypt".format(self.ID_num))
+            if self.verbose:
+                print("decrypted_message = ", decrypted_message)
+            return decrypted_message
 
-            #print("Received: ", recvd_bytes.decode(Server.MSG_ENCODING))
+        encryption_key_bytes = Client.find_key(self.ID_num, self.course)
 
-        except Exception as msg:
-            print(msg)
-            sys.exit(1)
+        if encryption_key_bytes is None:
+            if self.verbose:
+                print("User Not found.")
+            return None
 
+        return self.decrypt_message(payload,encryption_key_bytes,version)
 
-    def decrypt_message(self, encrypted_message_bytes,key):
+
+    def decrypt_message(self, encrypted_message_bytes,key,version=Protocol.BASE_VERSION):
 
 
         # Decrypt the message after reception at the client.
 
-        fernet = Fernet(key)
-        decrypted_message_bytes = fernet.decrypt(encrypted_message_bytes)
-        decrypted_message = decrypted_message_bytes.decode('ascii')
-        print("decrypted_message = ", decrypted_message)
+        fernet = Client.fernet_cache.get((self.course, self.ID_num), key)
+        try:
+            decrypted_message_bytes = fernet.decrypt(encrypted_message_bytes)
+            decrypted_message = Client.decode_reply(decrypted_message_bytes, version)
+        except InvalidToken:
+            self.fail("Reply for ID {} failed to decrypt".format(self.ID_num))
+        except ProtocolError:
+            self.fail("Reply for ID {} is malformed".format(self.ID_num))
+        if self.verbose:
+            print("decrypted_message = ", decrypted_message)
+        return decrypted_message
 
+    @staticmethod
+    def decode_reply(plaintext, version):
+        # A version 1 reply is its text, a version 2 reply the value
+        # itself (a float, or a list, see Protocol.unpack_reply).
+        if version == Protocol.BASE_VERSION:
+            return plaintext.decode('ascii')
+        return Protocol.unpack_reply(plaintext)
 
-    def find_row_by_ID(self, file_path, search_ID):
 
-        with open(file_path, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            next(reader)  # Skip the header row
-            for row in reader:
-                if row[1] == search_ID:
-                    return row
-        return None
+    @staticmethod
+    def find_key(search_ID, course=None):
+        # The key a student's replies are encrypted with, as bytes, or
+        # None if there is none.
+        if not Client.KEY_FILES:
+            if Client.keyring is None:
+                try:
+                    Client.keyring = Keyring.load(Client.KEYRING_PATH)
+                except (OSError, ValueError) as msg:
+                    raise ClientError("Cannot read keyring: {}".format(msg))
+            return Client.keyring.get(search_ID, course)
+        matching_row = Client.key_store(course).find(search_ID)
+        return None if matching_row is None else matching_row.key.encode('ascii')
+
+    @staticmethod
+    def keys_loaded(course=None):
+        # Whether find_key can answer for a course without reading a
+        # file.
+        if not Client.KEY_FILES:
+            return Client.keyring is not None
+        return course in Client.grade_stores
+
+    @staticmethod
+    def key_store(course=None):
+        store = Client.grade_stores.get(course)
+        if store is None:
+            if course is None:
+                file_path = Client.FILE_PATH
+            elif Client.COURSES_DIR is not None and CourseCatalog.COURSE_NAME.match(course):
+                file_path = CourseCatalog.course_file(Client.COURSES_DIR, course)
+            else:
+                file_path = None
+            if file_path is None:
+                raise ClientError("No key file for course {}".format(course))
+            store = Client.grade_stores[course] = GradeStore(file_path)
+        return store
+
+    @staticmethod
+    def decrypt_token(id_number, token, course=None, version=Protocol.BASE_VERSION):
+        # Decrypt one reply for a student without a Client instance.
+        # Used by the connection pools.
+        key = Client.find_key(id_number, course)
+        if key is None:
+            raise ClientError("No key for ID {}".format(id_number))
+        fernet = Client.fernet_cache.get((course, id_number), key)
+        try:
+            return Client.decode_reply(fernet.decrypt(token), version)
+        except InvalidToken:
+            raise ClientError("Reply for ID {} failed to decrypt".format(id_number))
+        except ProtocolError:
+            raise ClientError("Reply for ID {} is malformed".format(id_number))
+
+    @staticmethod
+    def decrypt_batch(requests, payload, verbose=False, version=Protocol.BASE_VERSION):
+        # Decrypt the results of a BATCH_RESPONSE, None for refused
+        # requests.
+        replies = []
+        for request, (status, data) in zip(requests, Protocol.unpack_batch_response(payload)):
+            if status != Protocol.OK:
+                if verbose and status == Protocol.THROTTLED:
+                    print("Server busy, retry in {:.2f} s.".format(Protocol.unpack_busy(data)))
+                elif verbose:
+                    print("Server error: ", data.decode('ascii'))
+                replies.append(None)
+                continue
+            id_number, course = request[0], (request[2] if len(request) > 2 else None)
+            replies.append(Client.decrypt_token(id_number, data, course, version))
+        return replies
+
+########################################################################
+# Client connection pool classes
+########################################################################
+
+class ClientPool:
+
+    # A thread-safe pool of persistent Client connections. Connections
+    # are opened on demand up to POOL_SIZE and reused after each
+    # request. A broken connection is dropped and the request is
+    # retried on a fresh one, with exponential backoff between
+    # attempts. Nothing here exits the process: failures raise
+    # ClientError.
+    #
+    # e.g.,
+    #   pool = ClientPool()
+    #   pool.request("1803933", "GMA")
+    #   pool.request_batch([("1803933", "GG"), ("1884159", "GG")])
+
+    POOL_SIZE = 8
+    TIMEOUT = 5.0 # seconds, for connect, request and pool checkout.
+    MAX_ATTEMPTS = 4
+    BACKOFF_INITIAL = 0.05 # seconds
+    BACKOFF_MAX = 2.0 # seconds
+
+    def __init__(self, host=Client.SERVER_HOSTNAME, port=None, size=POOL_SIZE, timeout=TIMEOUT):
+        self.host = host
+        self.port = Server.PORT if port is None else port
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.closed = False
 
+    @staticmethod
+    def backoff(attempt):
+        # Exponential backoff with jitter, so reconnecting clients do
+        # not all retry at the same moment.
+        delay = min(ClientPool.BACKOFF_MAX, ClientPool.BACKOFF_INITIAL * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def connect(self):
+        for attempt in range(ClientPool.MAX_ATTEMPTS):
+            try:
+                return Client(host=self.host, port=self.port, timeout=self.timeout,
+                              exit_on_error=False, verbose=False)
+            except ClientError as msg:
+                error = msg
+                time.sleep(ClientPool.backoff(attempt))
+        raise ClientError("Could not connect to {}:{}: {}".format(self.host, self.port, error))
+
+    def acquire(self):
+        if self.closed:
+            raise ClientError("Pool is closed")
+        if not self.slots.acquire(timeout=self.timeout):
+            raise ClientError("No free connection in the pool")
+        with self.lock:
+            client = self.idle.pop() if self.idle else None
+        if client is None:
+            try:
+                client = self.connect()
+            except ClientError:
+                self.slots.release()
+                raise
+        return client
+
+    def release(self, client, broken=False):
+        if broken or self.closed:
+            client.socket.close()
+        else:
+            with self.lock:
+                self.idle.append(client)
+        self.slots.release()
+
+    def call(self, method, *args):
+        for attempt in range(ClientPool.MAX_ATTEMPTS):
+            client = self.acquire()
+            try:
+                result = getattr(client, method)(*args)
+            except (OSError, ProtocolError, ClientError) as msg:
+                error = msg
+                self.release(client, broken=True)
+                time.sleep(ClientPool.backoff(attempt))
+                continue
+            self.release(client)
+            return result
+        raise ClientError("Request failed after {} attempts: {}".format(ClientPool.MAX_ATTEMPTS, error))
+
+    def request(self, id_number, command, course=None):
+        return self.call("request", id_number, command, course)
+
+    def request_batch(self, requests):
+        return self.call("request_batch", requests)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for client in idle:
+            client.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncClientPool:
+
+    # The asyncio version of ClientPool, for use from a coroutine
+    # based front-end. Connections are asyncio streams speaking the
+    # same framed protocol.
+    #
+    # e.g.,
+    #   async with AsyncClientPool() as pool:
+    #       average = await pool.request("1803933", "GMA")
+
+    def __init__(self, host=Client.SERVER_HOSTNAME, port=None,
+                 size=ClientPool.POOL_SIZE, timeout=ClientPool.TIMEOUT):
+        self.host = host
+        self.port = Server.PORT if port is None else port
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(size)
+        self.idle = []
+        self.closed = False
+        # Protocol version to speak, lowered if the server is older,
+        # and whether to ask for compressed replies (see
+        # Client.exchange).
+        self.version = Protocol.VERSION
+        self.compression = True
+
+    async def connect(self):
+        for attempt in range(ClientPool.MAX_ATTEMPTS):
+            try:
+                return await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                              self.timeout)
+            except (OSError, asyncio.TimeoutError) as msg:
+                error = msg
+                await asyncio.sleep(ClientPool.backoff(attempt))
+        raise ClientError("Could not connect to {}:{}: {}".format(self.host, self.port, error))
+
+    async def exchange(self, msg_type, payload):
+        # Send one frame and return the reply (version, type,
+        # payload).
+        reply = await self.send_frame(msg_type, payload, self.version)
+        if (self.version != Protocol.BASE_VERSION and reply[1] == Protocol.ERROR
+                and reply[2].startswith(Protocol.UNSUPPORTED_VERSION)):
+            self.version = Protocol.BASE_VERSION
+            reply = await self.send_frame(msg_type, payload, self.version)
+        if self.compression and reply[1] == Protocol.ERROR and reply[2] == Protocol.UNKNOWN_TYPE:
+            self.compression = False
+            reply = await self.send_frame(msg_type, payload, self.version)
+        return reply
+
+    async def send_frame(self, msg_type, payload, version):
+        if self.closed:
+            raise ClientError("Pool is closed")
+        if self.compression:
+            msg_type |= Protocol.ACCEPT_COMPRESSED
+        frame = Protocol.pack(msg_type, payload, version)
+        for attempt in range(ClientPool.MAX_ATTEMPTS):
+            async with self.slots:
+                reader, writer = self.idle.pop() if self.idle else await self.connect()
+                try:
+                    writer.write(frame)
+                    await asyncio.wait_for(writer.drain(), self.timeout)
+                    header = await asyncio.wait_for(reader.readexactly(Protocol.HEADER_SIZE),
+                                                    self.timeout)
+                    reply_version, reply_type, length = Protocol.HEADER.unpack(header)
+                    if length > Protocol.MAX_PAYLOAD_SIZE:
+                        raise ProtocolError("Frame too large ({} bytes)".format(length))
+                    reply = await asyncio.wait_for(reader.readexactly(length), self.timeout)
+                    reply_version, reply_type, reply = Protocol.decompress((reply_version, reply_type, reply))
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        ProtocolError) as msg:
+                    error = msg
+                    writer.close()
+                else:
+                    if reply_type == Protocol.ERROR and reply.startswith(Protocol.UNSUPPORTED_VERSION):
+                        # The server closes the connection after this.
+                        writer.close()
+                    else:
+                        self.idle.append((reader, writer))
+                    return reply_version, reply_type, reply
+            await asyncio.sleep(ClientPool.backoff(attempt))
+        raise ClientError("Request failed after {} attempts: {}".format(ClientPool.MAX_ATTEMPTS, error))
+
+    async def request(self, id_number, command, course=None):
+        message = Client.encode_request(id_number, command, course)
+        for attempt in range(ClientPool.MAX_ATTEMPTS):
+            version, reply_type, reply = await self.exchange(Protocol.REQUEST, message)
+            if reply_type != Protocol.RESPONSE:
+                return None
+            try:
+                return await self.decrypt([course], Client.decrypt_token,
+                                          id_number, reply, course, version)
+            except ClientError as msg:
+                error = msg
+                await asyncio.sleep(ClientPool.backoff(attempt))
+        raise ClientError("Request failed after {} attempts: {}".format(ClientPool.MAX_ATTEMPTS, error))
+
+    async def request_batch(self, requests):
+        messages = [Client.encode_request(*request) for request in requests]
+        courses = {request[2] if len(request) > 2 else None for request in requests}
+        for attempt in range(ClientPool.MAX_ATTEMPTS):
+            version, reply_type, reply = await self.exchange(Protocol.BATCH_REQUEST,
+                                                             Protocol.pack_batch_request(messages))
+            if reply_type != Protocol.BATCH_RESPONSE:
+                return [None] * len(requests)
+            try:
+                return await self.decrypt(courses, Client.decrypt_batch, requests, reply,
+                                          False, version)
+            except (ClientError, ProtocolError) as msg:
+                error = msg
+                await asyncio.sleep(ClientPool.backoff(attempt))
+        raise ClientError("Request failed after {} attempts: {}".format(ClientPool.MAX_ATTEMPTS, error))
+
+    async def decrypt(self, courses, function, *args):
+        # Decrypt on the event loop once the courses' keys are loaded;
+        # the first time, reading the keyring or key files is left to
+        # the default executor.
+        if all(Client.keys_loaded(course) for course in courses):
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def close(self):
+        self.closed = True
+        idle, self.idle = self.idle, []
+        for reader, writer in idle:
+            writer.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
 
 
 ########################################################################
@@ -388,7 +5195,9 @@ class Client:
 # then __name__ will be set to that module's name.
 
 if __name__ == '__main__':
-    roles = {'client': Client,'server': Server}
+    roles = {'client': Client,'server': Server,'router': Router,'stats': Client.stats,
+             'compile': MappedGradeSnapshot.compile,'export': Client.export,'update': Client.update,
+             'keyring': Keyring.extract,'supervisor': Supervisor}
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-r', '--role',
@@ -396,24 +5205,244 @@ if __name__ == '__main__':
                         help='server or client role',
                         required=True, type=str)
 
+    parser.add_argument('-m', '--mode',
+                        choices=Server.CONCURRENCY_MODES,
+                        default=Server.CONCURRENCY_MODE,
+                        help='server concurrency mode',
+                        type=str)
+
+    parser.add_argument('-p', '--port',
+                        default=Server.PORT,
+                        help='port to listen on (server, router) or connect to (client)',
+                        type=int)
+
+    parser.add_argument('-f', '--file',
+                        default=Server.FILE_PATH,
+                        help='grades file (.csv, .xlsx or compiled .grades) to serve, compile, '
+                             'copy keys from (keyring) or read keys from (client, with --key-files)',
+                        type=str)
+
+    parser.add_argument('-o', '--output',
+                        help='compiled snapshot to write (compile), default FILE with .grades, '
+                             'or CSV file to export to (export), default stdout',
+                        type=str)
+
+    parser.add_argument('-k', '--keyring',
+                        default=Keyring.PATH,
+                        help='keyring file to read keys from (client) or add keys to (keyring)',
+                        type=str)
+
+    parser.add_argument('--key-files',
+                        action='store_true',
+                        help='read keys from the grades files (-f, -c) instead of a keyring; '
+                             'loads every student\'s data, for testing only (client)')
+
+    parser.add_argument('--ids',
+                        help='IDs whose keys to copy into the keyring (keyring), e.g. 1803933,1804021',
+                        type=str)
+
+    parser.add_argument('-c', '--courses-dir',
+                        help='directory of <course>.grades or .csv files served next to the '
+                             'default course',
+                        type=str)
+
+    parser.add_argument('--memory-budget',
+                        default=CourseCatalog.MEMORY_BUDGET // (1024 * 1024),
+                        help='MB of loaded courses before least recently used ones are evicted',
+                        type=int)
+
+    parser.add_argument('--shards',
+                        help='shard map, e.g. "hash:4" or "range:1850000,1900000"; a '
+                             "shard's journal of mark updates is never compacted",
+                        type=ShardMap.parse)
+
+    parser.add_argument('--shard-index',
+                        default=0,
+                        help='which shard of --shards this server serves',
+                        type=int)
+
+    parser.add_argument('--backends',
+                        help='router shard servers, host:port,host:port,... in shard order',
+                        type=str)
+
+    parser.add_argument('--instructor-key',
+                        help='file holding the instructor Fernet key that enables (server) or '
+                             'makes (export, update) bulk export and mark update requests',
+                        type=str)
+
+    parser.add_argument('--replication-port',
+                        help='port to stream the default course to replicas on (server); '
+                             'needs --instructor-key',
+                        type=int)
+
+    parser.add_argument('--primary',
+                        help='run as a read replica of the primary at HOST:REPLICATION_PORT, '
+                             'keeping the copy in FILE (server); needs --instructor-key',
+                        type=str)
+
+    parser.add_argument('--course',
+                        help='course to export, update or file keys under (keyring) '
+                             '(default: the server\'s default course)',
+                        type=str)
+
+    parser.add_argument('--set',
+                        action='append',
+                        default=[],
+                        help='mark to set (update), ID:COLUMN:MARK, e.g. 1803933:E2:9; repeatable',
+                        type=str)
+
+    parser.add_argument('--column',
+                        help='column code to upload a whole column of marks to (update)',
+                        type=str)
+
+    parser.add_argument('--marks',
+                        help='CSV file of ID,mark rows to upload to --column (update)',
+                        type=str)
+
+    parser.add_argument('--compression-threshold',
+                        default=Server.COMPRESSION_THRESHOLD,
+                        help='compress reply payloads of at least this many bytes for clients '
+                             'that accept it (server, router)',
+                        type=int)
+
+    parser.add_argument('--trusted-peers',
+                        help='addresses exempt from the per-address rate limit, e.g. the '
+                             'router or a pooled front end: host,host,... (server, router)',
+                        type=str)
+
+    parser.add_argument('--sessions',
+                        action='store_true',
+                        help='open a session per student on the connection, so replies are '
+                             'sealed with AES-GCM rather than sent as Fernet tokens (client)')
+
+    parser.add_argument('--workers',
+                        default=Supervisor.WORKERS,
+                        help='server processes to run (supervisor), default one per core',
+                        type=int)
+
+    parser.add_argument('--listen-fd',
+                        help='inherited listen socket to accept on (set by the supervisor '
+                             'for its workers)',
+                        type=int)
+
+    parser.add_argument('--ready-fd',
+                        help='pipe to report readiness on (set by the supervisor for its workers)',
+                        type=int)
+
+    parser.add_argument('-l', '--log-level',
+                        choices=LOG_LEVELS,
+                        default='info',
+                        help='server log level ("off" disables logging)',
+                        type=str)
+
     args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    instructor_key = None
+    if args.instructor_key is not None:
+        with open(args.instructor_key, 'rb') as key_file:
+            instructor_key = key_file.read().strip()
+
+    trusted_peers = []
+    if args.trusted_peers is not None:
+        try:
+            trusted_peers = [socket.gethostbyname(host.strip()) for host in args.trusted_peers.split(",")]
+        except OSError as msg:
+            parser.error("--trusted-peers: {}".format(msg))
 
     if (roles[args.role] == Client):
-        while True:
-            id_number_input = input("Please Enter ID Number: ")
-            command_input = input("Please Enter Command: GMA, GL1A, GL2A, GL3A, GL4A, GEA, GG: ")
-
-
-            # encoding
-            id_number_bytes = id_number_input.encode('ascii')
-            command_bytes = command_input.encode('ascii')
-            full_message = id_number_bytes + command_bytes
-            print("Command Entered:", command_input)
-            print("Full message to be sent (in bytes):", full_message)
-            #creating a new instance of the client
-            Client(full_message, id_number_input)
+        if not args.key_files and not os.path.exists(args.keyring):
+            parser.error("no keyring at {} (make one with -r keyring)".format(args.keyring))
+        Client.KEYRING_PATH = args.keyring
+        Client.KEY_FILES = args.key_files
+        Client.FILE_PATH = args.file
+        Client.COURSES_DIR = args.courses_dir
+        # One persistent connection carries every query.
+        client = Client(port=args.port, sessions=args.sessions)
+        try:
+            while True:
+                course_input = input("Please Enter Course (blank for default): ") if args.courses_dir else ""
+                id_number_input = input("Please Enter ID Number: ")
+                command_input = input("Please Enter Command: GMA, GL1A, GL2A, GL3A, GL4A, GEA, GG, "
+                                      "GMED:<col>, GPCT:<p>:<col>, GHIST:<col>[:<width>], GRANK:<col>: ")
+
+                print("Command Entered:", command_input)
+                client.request(id_number_input, command_input, course_input or None)
+        except (KeyboardInterrupt, EOFError):
+            print()
+        finally:
+            client.close()
+    elif (roles[args.role] == Client.stats):
+        client = Client(port=args.port, verbose=False)
+        print(json.dumps(client.stats(), indent=2))
+        client.close()
+    elif (roles[args.role] == Router):
+        if args.shards is None or args.backends is None:
+            parser.error("the router needs --shards and --backends")
+        backends = [(host, int(port)) for host, _, port in
+                    (backend.rpartition(":") for backend in args.backends.split(","))]
+        Router(backends, args.shards, args.mode, args.port, args.compression_threshold, trusted_peers)
+    elif (roles[args.role] == Client.export):
+        if instructor_key is None:
+            parser.error("export needs --instructor-key")
+        client = Client(port=args.port, verbose=False)
+        output = sys.stdout if args.output is None else open(args.output, 'w', newline='')
+        try:
+            csv.writer(output).writerows(client.export(instructor_key, args.course))
+        finally:
+            if output is not sys.stdout:
+                output.close()
+            client.close()
+    elif (roles[args.role] == Client.update):
+        if instructor_key is None:
+            parser.error("update needs --instructor-key")
+        try:
+            updates = [(id_number, column, int(mark)) for id_number, column, mark in
+                       (item.split(":") for item in args.set)]
+            if args.marks is not None:
+                if args.column is None:
+                    parser.error("--marks needs --column")
+                with open(args.marks, newline='') as csvfile:
+                    updates += [(row[0].strip(), args.column, int(row[1])) for row in csv.reader(csvfile)
+                                if row and row[0].strip().isdigit()]
+        except ValueError:
+            parser.error("updates are ID:COLUMN:MARK with an integer mark")
+        client = Client(port=args.port, verbose=False)
+        try:
+            applied = client.update(instructor_key, updates, args.course)
+            print("Applied {} marks.".format(applied))
+        finally:
+            client.close()
+    elif (roles[args.role] == Keyring.extract):
+        if args.ids is None:
+            parser.error("keyring needs --ids")
+        try:
+            keyring = Keyring.extract(args.file, [id_number.strip() for id_number in args.ids.split(",")],
+                                      args.keyring, args.course)
+        except KeyError as msg:
+            parser.error("ID {} is not in {}".format(msg.args[0], args.file))
+        print("Keyring {} holds {} keys.".format(args.keyring, len(keyring.keys)))
+    elif (roles[args.role] == Supervisor):
+        if args.mode == "prefork":
+            parser.error("supervisor workers cannot use the prefork mode")
+        if args.primary is not None or args.replication_port is not None:
+            parser.error("replication is not supported under the supervisor")
+        if args.workers < 1:
+            parser.error("--workers must be at least 1")
+        # Workers run with the same arguments, the last --role wins.
+        Supervisor(sys.argv[1:] + ["-r", "server"], args.workers, args.port)
+    elif (roles[args.role] == MappedGradeSnapshot.compile):
+        snapshot = MappedGradeSnapshot.compile(args.file, args.output)
+        print("Compiled {} rows from {}.".format(len(snapshot), args.file))
     else:
-        roles[args.role]()
+        primary = None
+        if args.primary is not None:
+            host, _, port = args.primary.rpartition(":")
+            primary = (host, int(port))
+        Server(args.mode, args.file, args.port, args.courses_dir,
+               args.memory_budget * 1024 * 1024, args.shards, args.shard_index,
+               instructor_key, primary, args.replication_port, args.compression_threshold,
+               args.listen_fd, args.ready_fd, trusted_peers)
 
 
 
@@ -0,0 +1,74 @@
+import os
+import sys
+import shutil
+import socket
+import subprocess
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import server_client_Grade_Retrieval as grades
+
+GRADES_FILE = os.path.join(ROOT, "course_grades_2024.csv")
+SERVER_START_TIMEOUT = 20.0 # seconds
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def grades_file(tmp_path):
+    # A private copy, since servers journal and compact next to it.
+    file_path = tmp_path / "course_grades_2024.csv"
+    shutil.copy(GRADES_FILE, file_path)
+    return str(file_path)
+
+
+@pytest.fixture
+def client_keys(grades_file, monkeypatch):
+    # Clients look up their decryption keys in the grades file.
+    monkeypatch.setattr(grades.Client, "FILE_PATH", grades_file)
+    monkeypatch.setattr(grades.Client, "KEY_FILES", True)
+    monkeypatch.setattr(grades.Client, "grade_stores", {})
+    return grades_file
+
+
+@pytest.fixture
+def start_server(grades_file):
+    # start_server(*args) runs a server on a free port in its own
+    # process and returns the port once it accepts connections. The
+    # last -r wins, so start_server("-r", "supervisor") works too.
+    processes = []
+
+    def start(*args):
+        port = free_port()
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, "server_client_Grade_Retrieval.py"),
+                                    "-r", "server", "-f", grades_file, "-p", str(port), "-l", "warning"]
+                                   + list(args))
+        processes.append(process)
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            assert process.poll() is None, "server exited with status {}".format(process.returncode)
+            try:
+                socket.create_connection(("localhost", port), timeout=1.0).close()
+                return port
+            except OSError:
+                time.sleep(0.1)
+        pytest.fail("server did not start on port {}".format(port))
+
+    start.processes = processes
+    yield start
+    for process in processes:
+        # Gracefully, so a supervisor stops its workers.
+        process.terminate()
+        try:
+            process.wait(10.0)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
@@ -0,0 +1,39 @@
+from server_client_Grade_Retrieval import AdmissionControl
+
+
+def test_address_limit_sheds_past_the_burst(monkeypatch):
+    monkeypatch.setattr(AdmissionControl, "ADDRESS_BURST", 5)
+    admission = AdmissionControl()
+    results = []
+    for _ in range(6):
+        results.append(admission.admit("10.0.0.1"))
+        if not results[-1]:
+            admission.release()
+    assert results[:5] == [0.0] * 5
+    assert results[5] > 0
+    assert admission.stats()["shed"]["address"] == 1
+
+
+def test_trusted_peers_skip_the_address_limit(monkeypatch):
+    monkeypatch.setattr(AdmissionControl, "ADDRESS_BURST", 5)
+    admission = AdmissionControl(["10.0.0.2"])
+    for _ in range(50):
+        assert admission.admit("10.0.0.2") == 0.0
+        admission.release()
+    assert admission.stats()["shed"]["address"] == 0
+
+
+def test_id_limit_is_per_address(monkeypatch):
+    monkeypatch.setattr(AdmissionControl, "ID_BURST", 3)
+    admission = AdmissionControl()
+    key = (None, "1803933")
+    assert [admission.admit_id("10.0.0.1", key) for _ in range(3)] == [0.0] * 3
+    assert admission.admit_id("10.0.0.1", key) > 0
+    # Another client still gets the student's marks.
+    assert admission.admit_id("10.0.0.3", key) == 0.0
+
+
+def test_trusted_peers_skip_the_id_limit(monkeypatch):
+    monkeypatch.setattr(AdmissionControl, "ID_BURST", 3)
+    admission = AdmissionControl(["10.0.0.2"])
+    assert all(admission.admit_id("10.0.0.2", (None, "1803933")) == 0.0 for _ in range(50))
@@ -0,0 +1,89 @@
+import gc
+import weakref
+
+from cryptography.fernet import Fernet
+
+from server_client_Grade_Retrieval import FernetCache, GradeSnapshot, GradeStore, ResponseCache
+
+STUDENT = "1803933"
+MIDTERM = 4
+KEY = (None, STUDENT, "GMA", 2)
+
+
+def test_reply_cached_for_its_snapshot_version(grades_file):
+    snapshot = GradeSnapshot.from_file(grades_file, 1)
+    cache = ResponseCache()
+    assert cache.get(KEY, snapshot) is None
+    cache.put(KEY, snapshot, snapshot.version, b"key", b"10.45")
+    assert cache.get(KEY, snapshot) == (b"key", b"10.45")
+    # An edit bumps the version.
+    snapshot.set_marks([(STUDENT, MIDTERM, 20)])
+    assert cache.get(KEY, snapshot) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_reply_computed_before_an_edit_is_never_served(grades_file):
+    snapshot = GradeSnapshot.from_file(grades_file, 1)
+    cache = ResponseCache()
+    version = snapshot.version
+    snapshot.set_marks([(STUDENT, MIDTERM, 20)])
+    cache.put(KEY, snapshot, version, b"key", b"10.45")
+    assert cache.get(KEY, snapshot) is None
+
+
+def test_updates_and_reloads_miss(grades_file):
+    store = GradeStore(grades_file)
+    cache = ResponseCache()
+    cache.put(KEY, store.snapshot, store.version, b"key", b"10.45")
+    store.set_marks([(STUDENT, MIDTERM, 20)])
+    assert cache.get(KEY, store.snapshot) is None
+    cache.put(KEY, store.snapshot, store.version, b"key", b"11.1")
+    store.load()
+    assert cache.get(KEY, store.snapshot) is None
+
+
+def test_cache_does_not_keep_snapshots_alive(grades_file):
+    snapshot = GradeSnapshot.from_file(grades_file, 1)
+    cache = ResponseCache()
+    cache.put(KEY, snapshot, snapshot.version, b"key", b"10.45")
+    dropped = weakref.ref(snapshot)
+    del snapshot
+    gc.collect()
+    assert dropped() is None
+
+
+def test_cache_is_bounded_by_bytes(grades_file):
+    snapshot = GradeSnapshot.from_file(grades_file, 1)
+    entry_size = ResponseCache.ENTRY_OVERHEAD + 3 + 100
+    cache = ResponseCache(max_bytes=3 * entry_size)
+    for command in ("GL1A", "GL2A", "GL3A", "GL4A"):
+        cache.put((None, STUDENT, command, 2), snapshot, snapshot.version, b"key", bytes(100))
+    assert len(cache) == 3
+    assert cache.bytes == 3 * entry_size
+    assert cache.get((None, STUDENT, "GL1A", 2), snapshot) is None
+    assert cache.get((None, STUDENT, "GL4A", 2), snapshot) is not None
+
+
+def test_fernet_cache_rebuilds_on_a_key_change():
+    cache = FernetCache()
+    old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+    fernet = cache.get((None, STUDENT), old_key)
+    assert cache.get((None, STUDENT), old_key) is fernet
+    # The student's key was changed in the grades file.
+    rebuilt = cache.get((None, STUDENT), new_key)
+    assert rebuilt is not fernet
+    assert rebuilt.decrypt(Fernet(new_key).encrypt(b"10.45")) == b"10.45"
+    assert len(cache) == 1
+
+
+def test_fernet_cache_is_bounded():
+    cache = FernetCache(max_entries=2)
+    key = Fernet.generate_key()
+    first = cache.get((None, "1"), key)
+    cache.get((None, "2"), key)
+    cache.get((None, "1"), key)
+    cache.get((None, "3"), key)
+    assert len(cache) == 2
+    assert cache.get((None, "1"), key) is first
+    cache.invalidate((None, "1"))
+    assert cache.get((None, "1"), key) is not first
@@ -0,0 +1,58 @@
+import shutil
+
+import pytest
+
+from server_client_Grade_Retrieval import CourseCatalog, GradeStore, RequestError, ShardMap
+
+
+def test_malformed_course_is_unavailable(grades_file, tmp_path):
+    (tmp_path / "broken.csv").write_text("Name,ID\nx,y,z\n")
+    catalog = CourseCatalog(grades_file, str(tmp_path))
+    for _ in range(2):
+        with pytest.raises(RequestError):
+            catalog.get("broken")
+    assert catalog.loading == {}
+    assert "broken" not in catalog.stores
+
+
+def test_shard_maps():
+    shards = ShardMap.parse("range:1850000,1900000")
+    assert shards.count == 3
+    assert [shards.shard_of(id_number) for id_number in ("1803933", "1850000", "1999999")] == [0, 1, 2]
+    shards = ShardMap.parse("hash:4")
+    owners = [shards.owner(index) for index in range(4)]
+    for id_number in ("1803933", "1884159", "1000000"):
+        assert sum(owns(id_number) for owns in owners) == 1
+
+
+def test_shard_only_holds_its_own_keys(grades_file):
+    shards = ShardMap.parse("hash:2")
+    store = GradeStore(grades_file, shards.owner(0))
+    full = GradeStore(grades_file)
+    assert len(store) == len(full)
+    for record in full:
+        row = store.find(record.id_number)
+        if shards.shard_of(record.id_number) == 0:
+            assert row.key == record.key
+        else:
+            assert row is None
+    # The averages still cover every student.
+    assert store.averages() == full.averages()
+
+
+def test_least_recently_used_course_is_evicted(grades_file, tmp_path):
+    courses = tmp_path / "courses"
+    courses.mkdir()
+    for course in ("c1", "c2", "c3"):
+        shutil.copy(grades_file, courses / (course + ".csv"))
+    size = GradeStore(grades_file).snapshot.memory_usage()
+    # Room for the default course and two others.
+    catalog = CourseCatalog(grades_file, str(courses), memory_budget=int(3.5 * size))
+    first = catalog.get("c1")
+    catalog.get("c2")
+    assert catalog.get("c1") is first
+    catalog.get("c3")
+    assert list(catalog.stores) == ["c1", "c3"]
+    # An evicted course is loaded again on its next request.
+    assert catalog.get("c2").find("1803933") is not None
+    assert list(catalog.stores) == ["c3", "c2"]
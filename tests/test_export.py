@@ -0,0 +1,84 @@
+import csv
+import socket
+import time
+import zlib
+
+import pytest
+from cryptography.fernet import Fernet
+
+from server_client_Grade_Retrieval import Client, ClientError, Protocol, Server
+
+ROWS = 2 * Server.EXPORT_CHUNK_ROWS + 10
+
+
+@pytest.fixture
+def instructor_key(tmp_path):
+    key = Fernet.generate_key()
+    (tmp_path / "instructor.key").write_bytes(key)
+    return key
+
+
+@pytest.fixture
+def exporting_server(start_server, instructor_key, tmp_path):
+    # The default course, and a "big" course of ROWS students.
+    courses = tmp_path / "courses"
+    courses.mkdir()
+    with open(courses / "big.csv", "w", newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(["Name", "ID", "Key"] + ["Mark"] * 9)
+        for number in range(ROWS):
+            writer.writerow(["Student {}".format(number), str(1000000 + number),
+                             Fernet.generate_key().decode('ascii')] + [number % 20] * 9)
+    return start_server("--instructor-key", str(tmp_path / "instructor.key"),
+                        "-c", str(courses))
+
+
+def export_frames(port, token):
+    with socket.create_connection(("localhost", port), timeout=10.0) as sock:
+        sock.sendall(Protocol.pack(Protocol.EXPORT_REQUEST, token))
+        frames = [Protocol.recv_frame(sock)]
+        while frames[-1][1] == Protocol.EXPORT_CHUNK:
+            frames.append(Protocol.recv_frame(sock))
+    return frames
+
+
+def test_export_default_course(exporting_server, instructor_key, client_keys):
+    client = Client(port=exporting_server, timeout=5.0, exit_on_error=False, verbose=False)
+    try:
+        rows = list(client.export(instructor_key))
+    finally:
+        client.socket.close()
+    with open(client_keys, newline='') as csvfile:
+        expected = list(csv.reader(csvfile))
+    assert rows[0] == expected[0]
+    assert sorted(rows[1:]) == sorted(expected[1:])
+
+
+def test_export_streams_chunks(exporting_server, instructor_key):
+    fernet = Fernet(instructor_key)
+    frames = export_frames(exporting_server, fernet.encrypt(b"big"))
+    chunks = [frame for frame in frames if frame[1] == Protocol.EXPORT_CHUNK]
+    assert len(chunks) == 3
+    assert frames[-1] == (Protocol.VERSION, Protocol.EXPORT_END, Protocol.COUNT.pack(ROWS))
+    text = "".join(zlib.decompress(fernet.decrypt(chunk[2])).decode('utf-8') for chunk in chunks)
+    rows = list(csv.reader(text.splitlines()))
+    assert len(rows) == ROWS + 1
+    assert rows[1][:2] == ["Student 0", "1000000"]
+
+
+def test_expired_or_foreign_export_token_is_refused(exporting_server, instructor_key):
+    expired = Fernet(instructor_key).encrypt_at_time(
+        b"", int(time.time() - Protocol.EXPORT_TOKEN_TTL - 10))
+    foreign = Fernet(Fernet.generate_key()).encrypt(b"")
+    for token in (expired, foreign):
+        frames = export_frames(exporting_server, token)
+        assert frames == [(Protocol.VERSION, Protocol.ERROR, b"Export not authorized")]
+
+
+def test_export_of_an_unknown_course(exporting_server, instructor_key):
+    client = Client(port=exporting_server, timeout=5.0, exit_on_error=False, verbose=False)
+    try:
+        with pytest.raises(ClientError):
+            list(client.export(instructor_key, "nope"))
+    finally:
+        client.socket.close()
@@ -0,0 +1,114 @@
+import csv
+import gc
+import os
+import weakref
+
+from server_client_Grade_Retrieval import GradeJournal, GradeStore
+
+STUDENT = "1803933" # Lab 1 = 3, Midterm = 7 in the grades file
+OTHER = "1884159"
+LAB_1 = 0
+MIDTERM = 4
+
+
+def marks(store, id_number):
+    return list(store.find(id_number).marks)
+
+
+def upload(file_path, id_number, column, mark):
+    # Replace the grades file the way an upload does, with a new
+    # mtime.
+    with open(file_path, newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+    for row in rows:
+        if row[1] == id_number:
+            row[3 + column] = str(mark)
+    temp_path = file_path + ".upload"
+    with open(temp_path, "w", newline='') as csvfile:
+        csv.writer(csvfile).writerows(rows)
+    stat = os.stat(file_path)
+    os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    os.replace(temp_path, file_path)
+
+
+def test_compaction_writes_the_marks_back(grades_file):
+    store = GradeStore(grades_file)
+    store.set_marks([(STUDENT, MIDTERM, 20)])
+    assert store.compact()
+    assert os.path.getsize(store.journal.path) == 0
+    assert marks(GradeStore(grades_file), STUDENT)[MIDTERM] == 20
+
+
+def test_compaction_keeps_an_uploaded_file(grades_file):
+    store = GradeStore(grades_file)
+    upload(grades_file, STUDENT, LAB_1, 1)
+    # A mark posted before the watcher reloads the upload.
+    store.set_marks([(OTHER, MIDTERM, 20)])
+    assert not store.compact()
+    assert marks(GradeStore(grades_file), STUDENT)[LAB_1] == 1
+
+
+def test_journal_replays_on_restart(grades_file):
+    store = GradeStore(grades_file)
+    store.set_marks([(STUDENT, MIDTERM, 20)])
+    store.set_marks([(STUDENT, LAB_1, 9), (OTHER, LAB_1, 0)])
+    restarted = GradeStore(grades_file)
+    assert marks(restarted, STUDENT)[MIDTERM] == 20
+    assert marks(restarted, STUDENT)[LAB_1] == 9
+    assert marks(restarted, OTHER)[LAB_1] == 0
+
+
+def test_upload_overrides_earlier_journal_marks(grades_file):
+    store = GradeStore(grades_file)
+    store.set_marks([(STUDENT, MIDTERM, 20)])
+    upload(grades_file, STUDENT, MIDTERM, 7)
+    store.load()
+    assert marks(store, STUDENT)[MIDTERM] == 7
+    # Marks made on the upload still apply, after a restart too.
+    store.set_marks([(OTHER, MIDTERM, 19)])
+    restarted = GradeStore(grades_file)
+    assert marks(restarted, STUDENT)[MIDTERM] == 7
+    assert marks(restarted, OTHER)[MIDTERM] == 19
+
+
+def test_older_journal_lines_still_apply(grades_file):
+    with open(grades_file + ".journal", "w") as journal_file:
+        journal_file.write('[["{}",4,15]]\n'.format(STUDENT))
+    assert marks(GradeStore(grades_file), STUDENT)[MIDTERM] == 15
+
+
+def test_idle_flusher_ends_and_frees_the_store(grades_file, monkeypatch):
+    monkeypatch.setattr(GradeJournal, "IDLE_TIMEOUT", 0.05)
+    store = GradeStore(grades_file)
+    store.set_marks([(STUDENT, MIDTERM, 20)])
+    thread = store.journal.thread
+    thread.join(5.0)
+    assert not thread.is_alive()
+    assert store.journal.thread is None
+    # The next update starts another flusher.
+    store.set_marks([(STUDENT, MIDTERM, 19)])
+    assert marks(store, STUDENT)[MIDTERM] == 19
+    store.journal.thread.join(5.0)
+    evicted = weakref.ref(store)
+    del store
+    gc.collect()
+    assert evicted() is None
+
+
+def test_updates_swap_in_a_new_snapshot(grades_file):
+    store = GradeStore(grades_file)
+    before = store.snapshot
+    store.set_marks([(STUDENT, MIDTERM, 20), (OTHER, MIDTERM, 20)])
+    assert store.snapshot is not before
+    assert before.find(STUDENT).marks[MIDTERM] == 7
+    assert marks(store, STUDENT)[MIDTERM] == 20
+    assert marks(store, OTHER)[MIDTERM] == 20
+
+
+def test_shard_journal_warns_past_compact_bytes(grades_file, monkeypatch, caplog):
+    monkeypatch.setattr(GradeJournal, "COMPACT_BYTES", 100)
+    store = GradeStore(grades_file, owns=lambda id_number: True)
+    for mark in range(3):
+        store.set_marks([(STUDENT, MIDTERM, mark)])
+    assert not store.compact()
+    assert "never compacted" in caplog.text
@@ -0,0 +1,32 @@
+import pytest
+
+from server_client_Grade_Retrieval import Client, ClientError, Keyring
+
+
+@pytest.fixture
+def keyring_client(tmp_path, monkeypatch):
+    # Client class state as the interactive client has it by default.
+    monkeypatch.setattr(Client, "KEY_FILES", False)
+    monkeypatch.setattr(Client, "keyring", None)
+    monkeypatch.setattr(Client, "grade_stores", {})
+    keyring_path = str(tmp_path / Keyring.PATH)
+    monkeypatch.setattr(Client, "KEYRING_PATH", keyring_path)
+    return keyring_path
+
+
+def test_keys_come_from_the_keyring_by_default(grades_file, keyring_client):
+    Keyring.extract(grades_file, ["1803933"], keyring_client)
+    assert Client.find_key("1803933") == b"M7E8erO15CIh902P8DQsHxKbOADTgEPGHdiY0MplTuY="
+    assert Client.find_key("1884159") is None
+    # The grades file was never loaded.
+    assert Client.grade_stores == {}
+
+
+def test_missing_keyring_is_an_error(keyring_client):
+    with pytest.raises(ClientError):
+        Client.find_key("1803933")
+
+
+def test_extract_rejects_unknown_ids(grades_file, keyring_client):
+    with pytest.raises(KeyError):
+        Keyring.extract(grades_file, ["999"], keyring_client)
@@ -0,0 +1,61 @@
+import asyncio
+import csv
+
+import pytest
+from cryptography.fernet import Fernet
+
+import server_client_Grade_Retrieval as grades
+from server_client_Grade_Retrieval import AsyncClientPool, ClientError, ClientPool
+
+STUDENT = "1803933"
+MIDTERM_AVERAGE = 10.45
+
+
+@pytest.fixture
+def wrong_key(client_keys, tmp_path, monkeypatch):
+    # The client's copy of the grades file has another key for
+    # STUDENT, so the replies fail to decrypt.
+    with open(client_keys, newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+    for row in rows:
+        if row[1] == STUDENT:
+            row[2] = Fernet.generate_key().decode('ascii')
+    file_path = tmp_path / "client_keys.csv"
+    with open(file_path, "w", newline='') as csvfile:
+        csv.writer(csvfile).writerows(rows)
+    monkeypatch.setattr(grades.Client, "FILE_PATH", str(file_path))
+
+
+def test_pool_request(start_server, client_keys):
+    with ClientPool(port=start_server()) as pool:
+        assert pool.request(STUDENT, "GMA") == MIDTERM_AVERAGE
+        assert pool.request_batch([(STUDENT, "GMA")]) == [MIDTERM_AVERAGE]
+
+
+def test_pool_reply_that_fails_to_decrypt(start_server, wrong_key):
+    with ClientPool(port=start_server()) as pool:
+        with pytest.raises(ClientError):
+            pool.request(STUDENT, "GMA")
+
+
+def test_async_pool_loads_keys_off_the_event_loop(start_server, client_keys):
+    port = start_server()
+
+    async def main():
+        async with AsyncClientPool(port=port) as pool:
+            first = await pool.request(STUDENT, "GMA")
+            assert grades.Client.keys_loaded()
+            return first, await pool.request_batch([(STUDENT, "GMA")])
+
+    assert asyncio.run(main()) == (MIDTERM_AVERAGE, [MIDTERM_AVERAGE])
+
+
+def test_async_pool_reply_that_fails_to_decrypt(start_server, wrong_key):
+    port = start_server()
+
+    async def main():
+        async with AsyncClientPool(port=port) as pool:
+            await pool.request(STUDENT, "GMA")
+
+    with pytest.raises(ClientError):
+        asyncio.run(main())
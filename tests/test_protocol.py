@@ -0,0 +1,111 @@
+import socket
+import threading
+import zlib
+
+import pytest
+
+from server_client_Grade_Retrieval import Protocol, ProtocolError, RequestError
+
+
+def test_split_frames_leaves_a_partial_frame():
+    first = Protocol.pack(Protocol.REQUEST, b"1803933GG")
+    second = Protocol.pack(Protocol.REQUEST, b"1884159GMA", Protocol.BASE_VERSION)
+    third = Protocol.pack(Protocol.STATS_REQUEST, b"")
+    buffer = bytearray(first + second + third[:3])
+    assert Protocol.split_frames(buffer) == [(Protocol.VERSION, Protocol.REQUEST, b"1803933GG"),
+                                             (Protocol.BASE_VERSION, Protocol.REQUEST, b"1884159GMA")]
+    assert buffer == third[:3]
+    buffer += third[3:]
+    assert Protocol.split_frames(buffer) == [(Protocol.VERSION, Protocol.STATS_REQUEST, b"")]
+    assert buffer == b""
+
+
+def test_split_frames_one_byte_at_a_time():
+    data = Protocol.pack(Protocol.REQUEST, b"1803933GG") * 3
+    buffer = bytearray()
+    frames = []
+    for i in range(len(data)):
+        buffer += data[i:i + 1]
+        frames += Protocol.split_frames(buffer)
+    assert frames == [(Protocol.VERSION, Protocol.REQUEST, b"1803933GG")] * 3
+
+
+def test_split_frames_rejects_bad_headers():
+    with pytest.raises(ProtocolError):
+        Protocol.split_frames(bytearray(Protocol.HEADER.pack(9, Protocol.REQUEST, 0)))
+    with pytest.raises(ProtocolError):
+        Protocol.split_frames(bytearray(Protocol.HEADER.pack(Protocol.VERSION, Protocol.REQUEST,
+                                                             Protocol.MAX_PAYLOAD_SIZE + 1)))
+
+
+def test_recv_frame_over_partial_reads():
+    frame = Protocol.pack(Protocol.RESPONSE, b"x" * 5000)
+    reader, writer = socket.socketpair()
+
+    def trickle():
+        for i in range(0, len(frame), 7):
+            writer.sendall(frame[i:i + 7])
+        writer.close()
+
+    sender = threading.Thread(target=trickle)
+    sender.start()
+    try:
+        assert Protocol.recv_frame(reader) == (Protocol.VERSION, Protocol.RESPONSE, b"x" * 5000)
+        # Closed before another frame.
+        assert Protocol.recv_frame(reader) is None
+    finally:
+        sender.join()
+        reader.close()
+
+
+def test_recv_frame_closed_mid_frame():
+    reader, writer = socket.socketpair()
+    writer.sendall(Protocol.pack(Protocol.RESPONSE, b"abcdef")[:-2])
+    writer.close()
+    assert Protocol.recv_frame(reader) is None
+    reader.close()
+
+
+def test_version_1_replies_are_text():
+    assert Protocol.pack_reply(Protocol.NUMBER, 10.45, Protocol.BASE_VERSION) == b"10.45"
+
+
+@pytest.mark.parametrize("kind, value", [
+    (Protocol.NUMBER, 10.578947),
+    (Protocol.MARKS, [3, 9, 9, 0, 7, 4, 5, 8, 10]),
+    (Protocol.HISTOGRAM, [[0, 4, 2], [5, 9, 7]]),
+    (Protocol.HISTOGRAM, [[0, 999999999999, 20]]),
+    (Protocol.RANK, [8, 20, 65.0]),
+])
+def test_version_2_reply_round_trip(kind, value):
+    assert Protocol.unpack_reply(Protocol.pack_reply(kind, value, Protocol.VERSION)) == value
+
+
+def test_reply_value_out_of_range():
+    with pytest.raises(RequestError):
+        Protocol.pack_reply(Protocol.HISTOGRAM, [[0, 2 ** 63, 20]], Protocol.VERSION)
+
+
+def test_malformed_version_2_reply():
+    with pytest.raises(ProtocolError):
+        Protocol.unpack_reply(bytes((Protocol.NUMBER, 1)))
+
+
+def test_batch_round_trip():
+    messages = [b"1803933GG", b"1884159GMA", b""]
+    assert Protocol.unpack_batch_request(Protocol.pack_batch_request(messages)) == messages
+    results = [(Protocol.OK, b"token"), (Protocol.FAILED, b"User Not found"),
+               (Protocol.THROTTLED, Protocol.pack_busy(0.25))]
+    assert Protocol.unpack_batch_response(Protocol.pack_batch_response(results)) == results
+    assert Protocol.unpack_busy(results[2][1]) == 0.25
+    with pytest.raises(ProtocolError):
+        Protocol.unpack_batch_request(Protocol.pack_batch_request(messages) + b"x")
+
+
+def test_compressed_frames():
+    payload = b"0123456789" * 1000
+    frame = Protocol.pack(Protocol.RESPONSE | Protocol.COMPRESSED, zlib.compress(payload))
+    (frame,) = Protocol.split_frames(bytearray(frame))
+    assert Protocol.decompress(frame) == (Protocol.VERSION, Protocol.RESPONSE, payload)
+    with pytest.raises(ProtocolError):
+        Protocol.decompress((Protocol.VERSION, Protocol.RESPONSE | Protocol.COMPRESSED, b"not zlib"))
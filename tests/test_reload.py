@@ -0,0 +1,74 @@
+import csv
+import io
+import os
+import time
+
+from server_client_Grade_Retrieval import GradeFileWatcher, GradeStore
+
+STUDENT = "1803933" # Midterm = 7 in the grades file
+MIDTERM = 4
+POLL_INTERVAL = 0.05 # seconds
+RELOAD_TIMEOUT = 5.0 # seconds
+
+
+def rewrite(file_path, text):
+    # Replace the grades file the way an upload does, with a new
+    # mtime.
+    stat = os.stat(file_path)
+    temp_path = file_path + ".upload"
+    with open(temp_path, "w", newline='') as csvfile:
+        csvfile.write(text)
+    os.utime(temp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    os.replace(temp_path, file_path)
+
+
+def with_mark(file_path, id_number, column, mark):
+    with open(file_path, newline='') as csvfile:
+        rows = list(csv.reader(csvfile))
+    for row in rows:
+        if row[1] == id_number:
+            row[3 + column] = str(mark)
+    text = io.StringIO()
+    csv.writer(text).writerows(rows)
+    return text.getvalue()
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + RELOAD_TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, "not reloaded"
+        time.sleep(POLL_INTERVAL)
+
+
+def test_upload_is_reloaded(grades_file):
+    store = GradeStore(grades_file)
+    before = store.snapshot
+    watcher = GradeFileWatcher(store, POLL_INTERVAL).start()
+    try:
+        rewrite(grades_file, with_mark(grades_file, STUDENT, MIDTERM, 20))
+        wait_for(lambda: store.snapshot is not before)
+        assert store.find(STUDENT).marks[MIDTERM] == 20
+        assert store.version > before.version
+        # Requests still holding the old snapshot see the old table.
+        assert before.find(STUDENT).marks[MIDTERM] == 7
+    finally:
+        watcher.stop()
+
+
+def test_broken_upload_keeps_the_old_table(grades_file):
+    store = GradeStore(grades_file)
+    good = with_mark(grades_file, STUDENT, MIDTERM, 20)
+    before = store.snapshot
+    watcher = GradeFileWatcher(store, POLL_INTERVAL).start()
+    try:
+        rewrite(grades_file, "Name,ID\nx,y,z\n")
+        broken_stat = store.file_stat()
+        wait_for(lambda: store.loaded_stat == broken_stat)
+        assert store.snapshot is before
+        assert store.find(STUDENT).marks[MIDTERM] == 7
+        # The next good upload is loaded.
+        rewrite(grades_file, good)
+        wait_for(lambda: store.snapshot is not before)
+        assert store.find(STUDENT).marks[MIDTERM] == 20
+    finally:
+        watcher.stop()
@@ -0,0 +1,70 @@
+import socket
+import time
+
+import pytest
+from cryptography.fernet import Fernet
+
+from server_client_Grade_Retrieval import Client, ClientError
+
+STUDENT = "1803933"
+OTHER = "1884159"
+MIDTERM_AVERAGE = 10.45
+CONVERGE_TIMEOUT = 10.0 # seconds
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def connect(client_keys):
+    clients = []
+
+    def connect(port):
+        client = Client(port=port, timeout=5.0, exit_on_error=False, verbose=False)
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        client.socket.close()
+
+
+@pytest.mark.parametrize("mode", ["thread", "prefork"])
+def test_replica_converges_on_the_primary(mode, start_server, connect,
+                                          tmp_path):
+    key = Fernet.generate_key()
+    key_file = tmp_path / "instructor.key"
+    key_file.write_bytes(key)
+    replication_port = free_port()
+    primary = connect(start_server("--instructor-key", str(key_file),
+                                   "--replication-port", str(replication_port)))
+    # The replica starts from the primary's snapshot ...
+    replica = connect(start_server("-m", mode,
+                                   "-f", str(tmp_path / "replica.csv"),
+                                   "--instructor-key", str(key_file),
+                                   "--primary", "localhost:{}".format(replication_port)))
+    assert replica.request(STUDENT, "GMA") == MIDTERM_AVERAGE
+    assert replica.request(OTHER, "GG") == primary.request(OTHER, "GG")
+
+    # ... and follows its updates.
+    assert primary.update(key, [(STUDENT, "M", 0), (OTHER, "M", 0)]) == 2
+    average = primary.request(STUDENT, "GMA")
+    assert average != MIDTERM_AVERAGE
+    deadline = time.monotonic() + CONVERGE_TIMEOUT
+    while replica.request(STUDENT, "GMA") != average:
+        assert time.monotonic() < deadline, "replica did not converge"
+        # Under the per-ID rate limit.
+        time.sleep(0.2)
+    assert replica.request(OTHER, "GG")[4] == 0
+    # A prefork replica's workers report the parent's replication.
+    while not replica.stats().get("replica", {}).get("connected"):
+        assert time.monotonic() < deadline, "replica lag not reported"
+        time.sleep(0.2)
+    assert replica.stats()["replica"]["lag"] < CONVERGE_TIMEOUT
+
+    # Updates only go to the primary.
+    with pytest.raises(ClientError):
+        replica.update(key, [(STUDENT, "M", 1)])
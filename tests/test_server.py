@@ -0,0 +1,161 @@
+import signal
+import socket
+import threading
+import time
+
+import pytest
+
+from server_client_Grade_Retrieval import Client, GradeStore, Protocol, Server, ShardMap
+
+STUDENT = "1803933"
+MARKS = [3, 9, 9, 0, 7, 4, 5, 8, 10]
+MIDTERM_AVERAGE = 10.45
+
+
+@pytest.fixture
+def connect(client_keys):
+    clients = []
+
+    def connect(port, **kwargs):
+        client = Client(port=port, timeout=5.0, exit_on_error=False, verbose=False, **kwargs)
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        client.socket.close()
+
+
+@pytest.mark.parametrize("mode", Server.CONCURRENCY_MODES)
+def test_request_in_each_mode(mode, start_server, connect):
+    client = connect(start_server("-m", mode))
+    assert client.request(STUDENT, "GG") == MARKS
+    assert client.request(STUDENT, "GMA") == MIDTERM_AVERAGE
+    assert client.request("999", "GG") is None
+    assert client.request_batch([(STUDENT, "GG"), (STUDENT, "GMA")]) == [MARKS, MIDTERM_AVERAGE]
+
+
+def test_select_mode_serves_requests(start_server, connect):
+    # A select server not started by a supervisor (see Server.drain).
+    client = connect(start_server("-m", "select"))
+    assert client.request(STUDENT, "GG") == MARKS
+    assert client.request(STUDENT, "GL1A") is not None
+
+
+def test_select_mode_slow_reader(start_server, connect):
+    # Replies a client is not reading must not hold up the loop.
+    port = start_server("-m", "select", "--trusted-peers", "localhost")
+    batch = Protocol.pack(Protocol.BATCH_REQUEST,
+                          Protocol.pack_batch_request([(STUDENT + "GG").encode()] * 5000))
+    with socket.create_connection(("localhost", port), timeout=10.0) as slow:
+        for _ in range(40):
+            slow.sendall(batch)
+        time.sleep(0.5)
+        start = time.monotonic()
+        assert connect(port).request(STUDENT, "GMA") == MIDTERM_AVERAGE
+        assert time.monotonic() - start < 1.0
+        for _ in range(40):
+            assert Protocol.recv_frame(slow)[1] == Protocol.BATCH_RESPONSE
+
+
+def test_version_1_replies_are_text(start_server, connect):
+    client = connect(start_server())
+    client.version = Protocol.BASE_VERSION
+    assert client.request(STUDENT, "GMA") == str(MIDTERM_AVERAGE)
+
+
+def test_sealed_replies(start_server, connect):
+    client = connect(start_server(), sessions=True)
+    assert client.request(STUDENT, "GG") == MARKS
+    assert client.request(STUDENT, "GMA") == MIDTERM_AVERAGE
+    assert len(client.sessions) == 1
+
+
+def test_histogram_width_limit(start_server, connect):
+    client = connect(start_server())
+    assert client.request(STUDENT, "GHIST:M:5") == [[0, 4, 2], [5, 9, 7], [10, 14, 6], [15, 19, 5]]
+    assert client.request(STUDENT, "GHIST:M:%d" % Server.MAX_HISTOGRAM_WIDTH) == [[0, 999999, 20]]
+    assert client.request(STUDENT, "GHIST:M:%d" % (Server.MAX_HISTOGRAM_WIDTH + 1)) is None
+    assert client.request(STUDENT, "GHIST:M:99999999999999999999") is None
+
+
+@pytest.mark.parametrize("mode", ["inline", "thread"])
+def test_wide_histogram_keeps_serving(mode, start_server, connect):
+    # A bucket wider than 32 bits once killed the serving loop.
+    client = connect(start_server("-m", mode))
+    client.request(STUDENT, "GHIST:M:1000000000000")
+    client.request(STUDENT, "GHIST:M:99999999999999999999")
+    assert client.request(STUDENT, "GMA") == MIDTERM_AVERAGE
+
+
+@pytest.mark.parametrize("mode", ["inline", "thread", "select"])
+def test_unexpected_error_keeps_serving(mode, tmp_path, start_server, connect):
+    # A malformed course file fails to load with a ValueError.
+    (tmp_path / "broken.csv").write_text("Name,ID\nx,y,z\n")
+    port = start_server("-m", mode, "-c", str(tmp_path))
+    with socket.create_connection(("localhost", port), timeout=5.0) as sock:
+        sock.sendall(Protocol.pack(Protocol.REQUEST, b"broken/" + STUDENT.encode() + b"GG"))
+        assert Protocol.recv_frame(sock)[1] == Protocol.ERROR
+    assert connect(port).request(STUDENT, "GMA") == MIDTERM_AVERAGE
+
+
+def test_busy_keep_alive_client_makes_way(start_server, connect):
+    # An inline server serves one connection at a time.
+    port = start_server("-m", "inline")
+    busy, waiting = connect(port), connect(port)
+    assert busy.request(STUDENT, "GMA") == MIDTERM_AVERAGE
+    stop = threading.Event()
+    replies = []
+
+    def keep_busy():
+        while not stop.wait(0.2):
+            replies.append(busy.request(STUDENT, "GMA"))
+
+    thread = threading.Thread(target=keep_busy)
+    thread.start()
+    try:
+        time.sleep(0.5)
+        start = time.monotonic()
+        assert waiting.request(STUDENT, "GG") == MARKS
+        assert time.monotonic() - start < 2.0
+    finally:
+        stop.set()
+        thread.join()
+    assert replies and all(reply == MIDTERM_AVERAGE for reply in replies)
+
+
+def test_router_splits_requests_across_shards(grades_file, start_server, connect):
+    shards = ShardMap.parse("hash:2")
+    backends = [start_server("--shards", "hash:2", "--shard-index", str(index),
+                             "--trusted-peers", "localhost")
+                for index in range(shards.count)]
+    port = start_server("-r", "router", "--shards", "hash:2",
+                        "--backends", ",".join("localhost:{}".format(backend) for backend in backends))
+    records = {}
+    for record in GradeStore(grades_file):
+        records.setdefault(shards.shard_of(record.id_number), record)
+    assert len(records) == 2
+    # A shard only answers for its own students.
+    for index, record in records.items():
+        assert connect(backends[index]).request(record.id_number, "GG") == record.marks
+        assert connect(backends[1 - index]).request(record.id_number, "GG") is None
+    client = connect(port)
+    for record in records.values():
+        assert client.request(record.id_number, "GG") == record.marks
+    requests = [(records[index].id_number, command) for index in range(shards.count)
+                for command in ("GG", "GMA")] + [("999", "GG")]
+    assert client.request_batch(requests) == [records[0].marks, MIDTERM_AVERAGE,
+                                              records[1].marks, MIDTERM_AVERAGE, None]
+
+
+def test_supervisor_rolling_restart(start_server, connect):
+    port = start_server("-r", "supervisor", "--workers", "2", "-m", "thread")
+    supervisor = start_server.processes[-1]
+    client = connect(port)
+    assert client.request(STUDENT, "GG") == MARKS
+    supervisor.send_signal(signal.SIGHUP)
+    deadline = time.monotonic() + 3.0
+    while time.monotonic() < deadline:
+        assert client.request(STUDENT, "GMA") == MIDTERM_AVERAGE
+        # Under the per-ID rate limit.
+        time.sleep(0.12)
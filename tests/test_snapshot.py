@@ -0,0 +1,58 @@
+import pytest
+
+from server_client_Grade_Retrieval import Client, GradeSnapshot, GradeStore, MappedGradeSnapshot
+
+STUDENT = "1803933"
+MIDTERM = 4
+
+
+@pytest.fixture
+def compiled(grades_file):
+    return MappedGradeSnapshot.compile(grades_file)
+
+
+def test_compiled_snapshot_matches_the_csv(grades_file, compiled):
+    snapshot = GradeSnapshot.from_file(grades_file, 1)
+    assert compiled.header == snapshot.header
+    assert len(compiled) == len(snapshot)
+    for record in snapshot:
+        assert compiled.find(record.id_number).as_row() == record.as_row()
+    assert compiled.find("999") is None
+    assert compiled.averages() == snapshot.averages()
+
+
+def test_mapped_rows_lookup(compiled):
+    rows = compiled.rows([STUDENT, "999", "1884159"])
+    assert [compiled.record(row).id_number for row in rows] == [STUDENT, "1884159"]
+
+
+def test_truncated_file_is_refused(compiled, tmp_path):
+    path = tmp_path / "course.grades"
+    source = bytes(compiled.map)
+    path.write_bytes(source[:len(source) // 2])
+    with pytest.raises(ValueError):
+        MappedGradeSnapshot(str(path), 1)
+    path.write_bytes(b"not a grades file")
+    with pytest.raises(ValueError):
+        MappedGradeSnapshot(str(path), 1)
+
+
+def test_update_thaws_a_mapped_store(grades_file, compiled):
+    store = GradeStore(grades_file[:-len(".csv")] + MappedGradeSnapshot.SUFFIX)
+    assert isinstance(store.snapshot, MappedGradeSnapshot)
+    store.set_marks([(STUDENT, MIDTERM, 20)])
+    assert not isinstance(store.snapshot, MappedGradeSnapshot)
+    assert store.find(STUDENT).marks[MIDTERM] == 20
+    # Compaction writes the change back into the compiled file.
+    assert store.compact()
+    assert MappedGradeSnapshot(store.file_path, 1).find(STUDENT).marks[MIDTERM] == 20
+
+
+def test_server_serves_a_compiled_file(compiled, start_server, client_keys):
+    port = start_server("-f", client_keys[:-len(".csv")] + MappedGradeSnapshot.SUFFIX)
+    client = Client(port=port, timeout=5.0, exit_on_error=False, verbose=False)
+    try:
+        assert client.request(STUDENT, "GG") == [3, 9, 9, 0, 7, 4, 5, 8, 10]
+        assert client.request(STUDENT, "GMA") == 10.45
+    finally:
+        client.socket.close()